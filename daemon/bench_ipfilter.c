@@ -0,0 +1,104 @@
+/* vim: set ts=8 sw=4 sts=4 noet: */
+/*======================================================================
+Copyright (C) 2009 OSSO B.V. <walter+lightcount@osso.nl>
+This file is part of LightCount.
+
+LightCount is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+LightCount is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with LightCount.  If not, see <http://www.gnu.org/licenses/>.
+======================================================================*/
+
+#include "lightcount.h"
+#include <assert.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <sys/time.h>
+
+/* Settings */
+#define BENCH_IPS 300000		    /* ips looked up per flush */
+#define BENCH_MAX_RANGES 100000		    /* largest range count to try */
+
+
+/* Micro-benchmark of the daemon side IP filter of the storage module. For an
+ * increasing number of ranges it times the lookups of one flush, using the
+ * old linear search and the coalesced binary search. */
+
+static int bench__linear_in_range(uint32_t const *rbegin, uint32_t const *rend, uint32_t ip) {
+    uint32_t const *pos;
+    for (pos = rbegin; pos != rend; pos += 2) {
+	if (pos[0] <= ip && ip <= pos[1])
+	    return 1;
+	if (pos[0] > ip)
+	    return 0;
+    }
+    return 0;
+}
+
+static int bench__cmp(void const *a, void const *b) {
+    uint32_t const *ra = (uint32_t const*)a, *rb = (uint32_t const*)b;
+    return ra[0] < rb[0] ? -1 : (ra[0] > rb[0]);
+}
+
+static double bench__now() {
+    struct timeval tv;
+    gettimeofday(&tv, NULL);
+    return tv.tv_sec + tv.tv_usec / 1000000.0;
+}
+
+int main() {
+    static uint32_t ips[BENCH_IPS];
+    uint32_t *ranges, *coalesced;
+    size_t count, coalesced_count, i;
+
+    if ((ranges = (uint32_t*)malloc(4 * BENCH_MAX_RANGES * sizeof(uint32_t))) == NULL) {
+	fprintf(stderr, "malloc failed\n");
+	return 1;
+    }
+    coalesced = ranges + 2 * BENCH_MAX_RANGES;
+
+    /* Customer ranges of 8 to 256 addresses anywhere in 10.0.0.0/8, like the
+     * ip addresses we look up */
+    srand(1);
+    for (i = 0; i < BENCH_IPS; ++i)
+	ips[i] = 0x0a000000 | ((uint32_t)rand() & 0xffffff);
+
+    printf("%8s %10s %14s %14s\n", "ranges", "coalesced", "linear (ms)", "binary (ms)");
+    for (count = 10; count <= BENCH_MAX_RANGES; count *= 10) {
+	double t0, t1, t2;
+	unsigned hits_linear = 0, hits_binary = 0;
+
+	for (i = 0; i < count; ++i) {
+	    ranges[2 * i] = 0x0a000000 | ((uint32_t)rand() & 0xffffff);
+	    ranges[2 * i + 1] = ranges[2 * i] + (8 << (rand() % 6)) - 1;
+	}
+	qsort(ranges, count, 2 * sizeof(uint32_t), &bench__cmp); /* like ORDER BY ip_begin */
+	for (i = 0; i < 2 * count; ++i)
+	    coalesced[i] = ranges[i];
+
+	t0 = bench__now();
+	for (i = 0; i < BENCH_IPS; ++i)
+	    hits_linear += bench__linear_in_range(ranges, ranges + 2 * count, ips[i]);
+	t1 = bench__now();
+	coalesced_count = util_ipfilter_coalesce(coalesced, count);
+	for (i = 0; i < BENCH_IPS; ++i)
+	    hits_binary += util_ipfilter_in_range(coalesced, coalesced_count, ips[i]);
+	t2 = bench__now();
+
+	if (hits_linear != hits_binary)
+	    fprintf(stderr, "warning: linear search finds %u ips, binary search %u\n", hits_linear, hits_binary);
+	printf("%8lu %10lu %14.3f %14.3f\n", (unsigned long)count, (unsigned long)coalesced_count,
+		(t1 - t0) * 1000.0, (t2 - t1) * 1000.0);
+    }
+
+    free(ranges);
+    return 0;
+}
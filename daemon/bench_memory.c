@@ -0,0 +1,123 @@
+/* vim: set ts=8 sw=4 sts=4 noet: */
+/*======================================================================
+Copyright (C) 2009 OSSO B.V. <walter+lightcount@osso.nl>
+This file is part of LightCount.
+
+LightCount is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+LightCount is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with LightCount.  If not, see <http://www.gnu.org/licenses/>.
+======================================================================*/
+
+#include "lightcount.h"
+#include <sys/resource.h>
+#include <sys/time.h>
+#include <stdio.h>
+#include <stdlib.h>
+
+/* Settings */
+#define BENCH_PACKETS (1 << 22)		    /* packets per interval (a power of two) */
+#define BENCH_INTERVALS 5		    /* intervals to add and flush */
+#define BENCH_LOCAL_IPS 65536		    /* ips in our ranges (10.0.0.0/8) */
+#define BENCH_REMOTE_IPS 250000		    /* ips they talk to */
+
+
+/* Micro-benchmark of the memory module it is linked with. Every interval it
+ * adds the same packets between local and remote ips (like the traffic on a
+ * tap) and flushes them like the timer and storage do. It reports the add
+ * rate, the flush time and the peak memory use. */
+
+static uint64_t bench__packets_in;	    /* packets seen by the enum callback */
+
+static void bench__enum_cb(uint32_t ip, struct ipcount_t const *ipcount) {
+    bench__packets_in += ipcount->packets_in;
+}
+
+static double bench__now() {
+    struct timeval tv;
+    gettimeofday(&tv, NULL);
+    return tv.tv_sec + tv.tv_usec / 1000000.0;
+}
+
+static long bench__maxrss_kb() {
+    struct rusage usage;
+    getrusage(RUSAGE_SELF, &usage);
+    return usage.ru_maxrss; /* in kB on Linux */
+}
+
+int main(int argc, char const *const *argv) {
+    uint32_t *src, *dst;
+    uint16_t *len;
+    void *memory;
+    double add_time = 0.0, flush_time = 0.0;
+    long base_rss;
+    unsigned interval;
+    uint32_t i;
+
+    if ((src = (uint32_t*)malloc(BENCH_PACKETS * sizeof(uint32_t))) == NULL
+	    || (dst = (uint32_t*)malloc(BENCH_PACKETS * sizeof(uint32_t))) == NULL
+	    || (len = (uint16_t*)malloc(BENCH_PACKETS * sizeof(uint16_t))) == NULL) {
+	fprintf(stderr, "malloc failed\n");
+	return 1;
+    }
+
+    /* Half of the packets go out, half come in. Some remote ips are popular
+     * (squaring the random number skews it towards zero). */
+    srand(1);
+    for (i = 0; i < BENCH_PACKETS; ++i) {
+	double r = (double)rand() / RAND_MAX;
+	uint32_t local = 0x0a000000 | ((uint32_t)rand() % BENCH_LOCAL_IPS);
+	uint32_t remote = 0x50000000 + (uint32_t)(r * r * BENCH_REMOTE_IPS) * 7919;
+	src[i] = (i & 1) ? local : remote;
+	dst[i] = (i & 1) ? remote : local;
+	len[i] = 64 + rand() % 1454;
+    }
+
+    /* The packets are in memory now, what comes next is ours */
+    base_rss = bench__maxrss_kb();
+    if ((memory = memory_alloc()) == NULL) {
+	fprintf(stderr, "memory_alloc failed\n");
+	return 1;
+    }
+
+    printf("%s: %u intervals of %u packets\n", argv[0], (unsigned)BENCH_INTERVALS, (unsigned)BENCH_PACKETS);
+    printf("%8s %14s %12s %14s\n", "interval", "packets/s", "ns/packet", "flush (ms)");
+    for (interval = 0; interval < BENCH_INTERVALS; ++interval) {
+	double t0, t1, t2;
+
+	t0 = bench__now();
+	for (i = 0; i < BENCH_PACKETS; ++i)
+	    memory_add(memory, src[i], dst[i], 0, len[i]);
+	t1 = bench__now();
+	bench__packets_in = 0;
+	memory_enum(memory, &bench__enum_cb);
+	memory_reset(memory);
+	t2 = bench__now();
+
+	if (bench__packets_in != BENCH_PACKETS)
+	    fprintf(stderr, "warning: added %u packets, enumerated %" SCNu64 "\n",
+		    (unsigned)BENCH_PACKETS, bench__packets_in);
+	printf("%8u %14.0f %12.1f %14.3f\n", interval, BENCH_PACKETS / (t1 - t0),
+		(t1 - t0) * 1000000000.0 / BENCH_PACKETS, (t2 - t1) * 1000.0);
+	add_time += t1 - t0;
+	flush_time += t2 - t1;
+    }
+
+    printf("%8s %14.0f %12.1f %14.3f\n", "average", BENCH_INTERVALS * BENCH_PACKETS / add_time,
+	    add_time * 1000000000.0 / (BENCH_INTERVALS * BENCH_PACKETS), flush_time * 1000.0 / BENCH_INTERVALS);
+    printf("peak rss: %ld kB (%ld kB for the memory module)\n", bench__maxrss_kb(), bench__maxrss_kb() - base_rss);
+
+    memory_free(memory);
+    free(src);
+    free(dst);
+    free(len);
+    return 0;
+}
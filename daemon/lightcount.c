@@ -35,11 +35,13 @@ int main(int argc, char const *const *argv) {
 	memory_help();
 	timer_help();
 	storage_help();
+	stats_help();
 	return 0;
     }
 
     /* Try initialization */
-    if (argc != 3 || (socket = sniff_create_socket(argv[1])) < 0 || storage_open(argv[2]) != 0) {
+    if (argc != 3 || (socket = sniff_create_socket(argv[1])) < 0 || storage_open(argv[2]) != 0
+	    || stats_open(argv[2]) != 0) {
 	if (socket >= 0)
 	    close(socket);
 	fprintf(stderr, "lightcount: Initialization failed or bad command line options. See -h for help.\n");
@@ -51,6 +53,9 @@ int main(int argc, char const *const *argv) {
     memory[1] = memory_alloc();
     assert(memory[0] != NULL && memory[1] != NULL);
 
+    /* Count in the first memory, the timer hands out the other */
+    util_handoff_init(memory[0]);
+
     /* Initialize updater thread */
     timer_loop_bg(memory[0], memory[1]);
 
@@ -64,6 +69,7 @@ int main(int argc, char const *const *argv) {
     memory_free(memory[0]);
     memory_free(memory[1]);
     storage_close();
+    stats_close();
     close(socket);
     return 0;
 }
@@ -80,6 +80,7 @@ void memory_reset(void *memory); /* reset the memory to be reused */
 void memory_free(void *memory); /* free the memory */
 void memory_add(void *memory, uint32_t src, uint32_t dst, uint16_t vlan,
 		uint16_t len); /* store intermittent values */
+void memory_merge(void *dst, void *src); /* add the values of src to dst */
 void memory_enum(void *memory, memory_enum_cb cb); /* read values */
 
 
@@ -88,14 +89,26 @@ void memory_enum(void *memory, memory_enum_cb cb); /* read values */
  |                                                                            |
  | Does the sniffing of the ethernet packets. As `sniff_loop` is the main     |
  | (foreground) loop, it listens for the quit signals: HUP, INT, TERM and     |
- | QUIT.                                                                      |
+ | QUIT. Modules that count in private memory (per capture thread) add it to  |
+ | the memory passed to `sniff_collect`, which the timer calls before         |
+ | `storage_write`.                                                           |
  |                                                                            |
- | Calls: `memory_add`                                                        |
+ | Every capture thread joins the memory handoff and counts in the memory     |
+ | that `util_handoff_poll` returns. It polls between packets or blocks and   |
+ | calls `util_handoff_idle` before it blocks.                                |
+ |                                                                            |
+ | The storage may call `sniff_ipfilter` (from the timer thread) with the     |
+ | ranges of the IPs it stores, so the others need not be captured at all.    |
+ |                                                                            |
+ | Calls: `memory_add`, `memory_merge` (from `sniff_collect`),                |
+ |        `util_handoff_*`, `packet_filter_attach`                            |
  *----------------------------------------------------------------------------*/
 void sniff_help(); /* show info */
 int sniff_create_socket(char const *iface); /* create a packet socket */
 void sniff_close_socket(int packet_socket); /* close the packet socket */
 void sniff_loop(int packet_socket, void *memory1, void *memory2); /* run */
+void sniff_collect(void *memory); /* add private counts to the switched out memory */
+void sniff_ipfilter(uint32_t const *ranges, size_t count); /* capture only these (coalesced) ranges */
 
 
 /*----------------------------------------------------------------------------*
@@ -106,34 +119,100 @@ void sniff_loop(int packet_socket, void *memory1, void *memory2); /* run */
  | to `storage_open` that can be used to read settings like (1) which IP      |
  | addresses to store/ignore or (2) to which database to connect.             |
  |                                                                            |
- | Calls: (nothing)                                                           |
+ | Calls: `sniff_ipfilter` (from `storage_write`)                             |
  *----------------------------------------------------------------------------*/
 void storage_help();
 int storage_open(char const *config_file);
 void storage_close();
-void storage_write(uint32_t unixtime_begin, uint32_t interval, void *memory);
+void storage_write(uint32_t unixtime_begin, uint32_t interval, uint32_t slots, void *memory); /* the memory
+	holds the counts of slots intervals, store their average in each */
 
 
 /*----------------------------------------------------------------------------*
  | Module: timer                                                              |
  |                                                                            |
- | Runs a thread that wakes up every interval. When waking up, it raises      |
- | SIGUSR1 to signal `sniff_loop` to begin writing to a different buffer so   |
- | it can safely give the current buffer to `storage_write` for processing.   |
+ | Runs a thread that wakes up every interval. When waking up, it publishes   |
+ | the other buffer with `util_handoff_publish` and waits until the capture   |
+ | threads have acknowledged it. Then it can safely give the current buffer   |
+ | to `storage_write` for processing. The timer may allocate more buffers to  |
+ | queue them for a flush thread, so the sniff module must not assume that    |
+ | only the two buffers passed to `sniff_loop` are published.                 |
  |                                                                            |
- | Calls: `storage_write` (from a thread)                                     |
+ | Calls: `util_handoff_*`, `sniff_collect`, `storage_write` (from a thread), |
+ |        `memory_alloc`, `memory_reset`, `memory_free`                       |
  *----------------------------------------------------------------------------*/
 void timer_help();
 int timer_loop_bg(void *memory1, void *memory2);
 void timer_loop_stop();
 
 
+/*----------------------------------------------------------------------------*
+ | Packet functions shared by the packet socket sniff modules.                |
+ |                                                                            |
+ | Calls: `memory_add`                                                        |
+ *----------------------------------------------------------------------------*/
+#define PACKET_SNAPLEN 38 /* ethernet + 802.1q + ip header bytes we look at */
+#define PACKET_FILTER_MAX_RANGES 512 /* more ip ranges get an IP frames only filter */
+int packet_socket_open(char const *iface); /* open and bind a packet socket */
+int packet_filter_attach(int packet_socket, uint32_t const *ranges,
+		size_t count); /* capture IP frames (of coalesced ranges, if not NULL) only */
+void packet_count(void *memory, uint8_t const *frame, size_t caplen,
+		uint16_t vlan); /* count an IP frame, pass an offloaded vlan tag */
+
+
 /*----------------------------------------------------------------------------*
  | Utility functions that are not module specific.                            |
  *----------------------------------------------------------------------------*/
 void util_get_safe_node_name(char *dst, size_t len);
 int util_signal_set(int signum, void (*handler)(int));
 char *util_inet_htoa(uint32_t ip4);
+size_t util_ipfilter_coalesce(uint32_t *ranges, size_t count); /* sort and merge [from, to, ...] ranges */
+int util_ipfilter_in_range(uint32_t const *ranges, size_t count, uint32_t ip); /* search coalesced ranges */
+
+/* Handoff of the memory between the timer and the capture threads. The timer
+ * publishes the memory to count in, the capture threads pick it up between
+ * packets. When `util_handoff_wait` returns 0, no thread touches the
+ * previously published memory anymore; until then, the timer must not hand
+ * that memory to storage or reset it, so it keeps waiting. Join from
+ * `sniff_loop` before starting any threads and go idle before leaving it. */
+#define UTIL_HANDOFF_TIMEOUT_MS 1000 /* how often the timer complains while waiting for the capture threads */
+void util_handoff_init(void *memory); /* set the first memory, before starting the threads */
+int util_handoff_join(); /* register a capture thread, returns its number */
+void *util_handoff_poll(int thread); /* get the memory to count the next packet(s) in */
+void util_handoff_idle(int thread); /* we're not touching the memory for a while */
+void util_handoff_publish(void *memory); /* give the capture threads new memory */
+int util_handoff_wait(unsigned timeout_ms); /* wait until all threads have let go of the old memory */
+
+
+/*----------------------------------------------------------------------------*
+ | Runtime statistics.                                                        |
+ |                                                                            |
+ | The modules update these counters from any thread, without locking. If    |
+ | the config file passed to `stats_open` has a `stats_listen=` line, a       |
+ | thread serves them in the Prometheus text format on that address.          |
+ *----------------------------------------------------------------------------*/
+enum stats_counter {
+    STATS_PACKETS,		/* frames seen by the sniff module */
+    STATS_KERNEL_DROPS,		/* frames dropped before the sniff module got them */
+    STATS_MEMORY_ALLOCATIONS,	/* extra allocations by the memory module */
+    STATS_MEMORY_OVERFLOWS,	/* counts skipped because the memory was full */
+    STATS_FLUSHES,		/* intervals handed to storage */
+    STATS_FLUSH_DROPPED,	/* intervals dropped because the flush queue was full */
+    STATS_FLUSH_MERGED,		/* intervals merged because the flush queue was full */
+    STATS_FLUSH_QUEUE_DEPTH,	/* (gauge) intervals waiting at the last flush */
+    STATS_FLUSH_LAG_SECONDS,	/* (gauge) end of the last flush minus the end of its interval */
+    STATS_FLUSH_DURATION_US,	/* (gauge) how long the last flush took */
+    STATS_STORAGE_ROWS,		/* rows written by storage */
+    STATS_STORAGE_FAILURES,	/* writes storage failed to complete */
+    STATS_STORAGE_IPS,		/* (gauge) IPs in the last interval handed to storage */
+    STATS__COUNT
+};
+void stats_help(); /* show info */
+int stats_open(char const *config_file); /* start serving, if configured */
+void stats_close(); /* stop serving */
+void stats_add(enum stats_counter counter, uint64_t value); /* add to a counter */
+void stats_set(enum stats_counter counter, uint64_t value); /* set a gauge */
+
 #if !(_BSD_SOURCE || _XOPEN_SOURCE >= 500)
 int usleep(unsigned usecs);
 #endif /* !(_BSD_SOURCE || _XOPEN_SOURCE >= 500) */
@@ -0,0 +1,270 @@
+/* vim: set ts=8 sw=4 sts=4 noet: */
+/*======================================================================
+Copyright (C) 2009 OSSO B.V. <walter+lightcount@osso.nl>
+This file is part of LightCount.
+
+LightCount is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+LightCount is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with LightCount.  If not, see <http://www.gnu.org/licenses/>.
+======================================================================*/
+
+#include "lightcount.h"
+#include <assert.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+/* Settings */
+#define MIN_HASHBITS 12			    /* the index has at least 2**N slots */
+#define MAX_HASHBITS 25			    /* and at most 2**N slots */
+
+
+/* An ip/vlan and its counts. The entries are stored densely in the order
+ * they were first seen, the index refers to them. */
+struct memory__entry {
+    uint32_t ip;
+    uint32_t slot;			    /* where the index refers to us */
+    struct ipcount_t count;
+};
+
+struct memory__table {
+    uint32_t *index;			    /* entry number + 1 per slot, 0 if free */
+    struct memory__entry *entries;
+    unsigned hashbits;			    /* the index has 2**hashbits slots */
+    uint32_t count;			    /* entries in use */
+    uint32_t max_count;			    /* entries allocated, half the slots */
+    int is_full;			    /* whether we complained about MAX_HASHBITS */
+};
+
+
+static int memory__resize(struct memory__table *table, unsigned hashbits);
+static struct ipcount_t *memory__find(struct memory__table *table, uint32_t ip, uint16_t vlan);
+static void memory__add_one(struct memory__table *table, uint32_t ip, uint16_t vlan, uint16_t len, int is_output);
+#ifdef PRINT_EVERY_PACKET
+static void memory__dump_ipcount(uint32_t ip, struct ipcount_t const *ipc);
+#endif
+
+
+void memory_help() {
+    printf(
+	"/********************* module: memory (open_hash) *****************************/\n"
+	"#define MIN_HASHBITS %" SCNu32 "\n"
+	"#define MAX_HASHBITS %" SCNu32 "\n"
+	"\n"
+	"The memory keeps the counts of every IP/VLAN in a dense array of %" SCNu32 " byte\n"
+	"entries, with an open addressing (linear probing) hash index of 2**HASHBITS\n"
+	"slots in front of it. The table grows when it is half full and shrinks again\n"
+	"at reset when only a fraction was used, so the memory use follows the number\n"
+	"of active IPs. Reset and enumeration take time in proportion to that number.\n"
+	"\n"
+	"A buffer takes at least %" SCNu64 "kB and at most %" SCNu64 "MB ram (for %" SCNu32 " IPs). Counts\n"
+	"of new IPs in a full table are dropped.\n"
+	"\n",
+	(uint32_t)MIN_HASHBITS, (uint32_t)MAX_HASHBITS,
+	(uint32_t)sizeof(struct memory__entry),
+	(uint64_t)(1 << MIN_HASHBITS) * (sizeof(uint32_t) + sizeof(struct memory__entry) / 2) / 1024,
+	(uint64_t)(1 << MAX_HASHBITS) * (sizeof(uint32_t) + sizeof(struct memory__entry) / 2) / 1024 / 1024,
+	(uint32_t)1 << (MAX_HASHBITS - 1)
+    );
+    if (MIN_HASHBITS < 2 || MIN_HASHBITS > MAX_HASHBITS || MAX_HASHBITS > 31) {
+	fprintf(stderr, "WARNING: MIN_HASHBITS/MAX_HASHBITS have the insane values of %" SCNu32 "/%" SCNu32 "!\n\n",
+		(uint32_t)MIN_HASHBITS, (uint32_t)MAX_HASHBITS);
+    }
+}
+
+void *memory_alloc() {
+    struct memory__table *table = calloc(sizeof(struct memory__table), 1);
+    if (table == NULL)
+	return NULL;
+    if (memory__resize(table, MIN_HASHBITS) != 0) {
+	free(table);
+	return NULL;
+    }
+    return table;
+}
+
+void memory_reset(void *memory) {
+    struct memory__table *table = memory;
+    unsigned hashbits = MIN_HASHBITS;
+    uint32_t count = table->count;
+    uint32_t i;
+
+    /* Shrink when the table is four times the size that holds twice the
+     * entries of this interval */
+    while (hashbits < table->hashbits && ((uint32_t)1 << (hashbits - 1)) < 2 * count)
+	++hashbits;
+    table->is_full = 0;
+    if (hashbits + 2 <= table->hashbits) {
+	table->count = 0;
+	if (memory__resize(table, hashbits) == 0)
+	    return;
+	/* We keep the old table if we can't get the smaller one (unlikely) */
+    }
+
+    /* Free only the slots that we used, the entries are overwritten when
+     * they're taken again */
+    for (i = 0; i < count; ++i)
+	table->index[table->entries[i].slot] = 0;
+    table->count = 0;
+}
+
+void memory_free(void *memory) {
+    struct memory__table *table = memory;
+    free(table->index);
+    free(table->entries);
+    free(table);
+}
+
+void memory_add(void *memory, uint32_t src, uint32_t dst, uint16_t vlan, uint16_t len) {
+#if PRINT_EVERY_PACKET
+    fprintf(stderr, "memory_add: 0x%08" PRIx32 " > 0x%08" PRIx32 " "
+	    "(len=%" SCNu16 ",vlan=%" SCNu16 ").\n", src, dst, len, vlan);
+#endif
+    memory__add_one(memory, src, vlan, len, 1); /* src == output */
+    memory__add_one(memory, dst, vlan, len, 0); /* dst == input */
+}
+
+void memory_merge(void *dst, void *src) {
+    struct memory__table const *table = src;
+    uint32_t i;
+
+    for (i = 0; i < table->count; ++i) {
+	struct memory__entry const *entry = &table->entries[i];
+	struct ipcount_t *mem = memory__find(dst, entry->ip, entry->count.vlan);
+	if (mem == NULL)
+	    continue;
+	mem->packets_in += entry->count.packets_in;
+	mem->u.bytes_in += entry->count.u.bytes_in;
+	mem->packets_out += entry->count.packets_out;
+	mem->bytes_out += entry->count.bytes_out;
+    }
+}
+
+void memory_enum(void *memory, memory_enum_cb cb) {
+    struct memory__table const *table = memory;
+    uint32_t i;
+
+    for (i = 0; i < table->count; ++i) {
+#if PRINT_EVERY_PACKET
+	memory__dump_ipcount(table->entries[i].ip, &table->entries[i].count);
+#endif
+	cb(table->entries[i].ip, &table->entries[i].count);
+    }
+}
+
+
+/* The slot to start probing at. A multiplicative hash uses all IP bits, so
+ * neighbouring addresses (a scan of a subnet) spread over the index. */
+static uint32_t memory__hash(uint32_t ip, uint16_t vlan, unsigned hashbits) {
+    return ((ip ^ ((uint32_t)vlan << 20)) * (uint32_t)0x9e3779b1) >> (32 - hashbits);
+}
+
+/* Rebuilds the index with 2**hashbits slots and resizes the entries to half
+ * of that. Returns non-zero if no memory could be allocated, leaving the table
+ * as it was. */
+static int memory__resize(struct memory__table *table, unsigned hashbits) {
+    uint32_t mask = ((uint32_t)1 << hashbits) - 1;
+    uint32_t max_count = (uint32_t)1 << (hashbits - 1);
+    uint32_t *index;
+    struct memory__entry *entries;
+    uint32_t i;
+
+    assert(table->count <= max_count);
+    if ((index = calloc(sizeof(uint32_t), (size_t)1 << hashbits)) == NULL)
+	return -1;
+    if ((entries = realloc(table->entries, sizeof(struct memory__entry) * max_count)) == NULL) {
+	free(index);
+	return -1;
+    }
+#ifndef NDEBUG
+    if (table->index != NULL)
+	fprintf(stderr, "memory__resize: Resizing from %u to %u hashbits for %" SCNu32 " IPs.\n",
+		table->hashbits, hashbits, table->count);
+#endif
+
+    for (i = 0; i < table->count; ++i) {
+	uint32_t slot = memory__hash(entries[i].ip, entries[i].count.vlan, hashbits);
+	while (index[slot] != 0)
+	    slot = (slot + 1) & mask;
+	index[slot] = i + 1;
+	entries[i].slot = slot;
+    }
+
+    free(table->index);
+    table->index = index;
+    table->entries = entries;
+    table->hashbits = hashbits;
+    table->max_count = max_count;
+    return 0;
+}
+
+/* Returns the counts of ip/vlan, taking a zeroed entry for a new one. Returns
+ * NULL if the table is full and no memory could be allocated. */
+static struct ipcount_t *memory__find(struct memory__table *table, uint32_t ip, uint16_t vlan) {
+    uint32_t mask = ((uint32_t)1 << table->hashbits) - 1;
+    uint32_t slot = memory__hash(ip, vlan, table->hashbits);
+    struct memory__entry *entry;
+
+    /* With at most half of the slots used, the probe sequences stay short */
+    while (table->index[slot] != 0) {
+	entry = &table->entries[table->index[slot] - 1];
+	if (entry->ip == ip && entry->count.vlan == vlan)
+	    return &entry->count;
+	slot = (slot + 1) & mask;
+    }
+
+    /* Not found, grow if needed (and find the new free slot) */
+    if (table->count == table->max_count) {
+	if (table->hashbits >= MAX_HASHBITS || memory__resize(table, table->hashbits + 1) != 0) {
+	    stats_add(STATS_MEMORY_OVERFLOWS, 1);
+	    if (!table->is_full) {
+		fprintf(stderr, "memory__find: Error! Table is full at %" SCNu32 " IPs! Skipping counts.\n",
+			table->count);
+		table->is_full = 1;
+	    }
+	    return NULL;
+	}
+	stats_add(STATS_MEMORY_ALLOCATIONS, 1);
+	return memory__find(table, ip, vlan);
+    }
+
+    entry = &table->entries[table->count];
+    memset(entry, 0, sizeof(struct memory__entry));
+    entry->ip = ip;
+    entry->slot = slot;
+    entry->count.ip_high = ip >> 16;
+    entry->count.vlan = vlan;
+    entry->count.is_used = 1;
+    table->index[slot] = ++table->count;
+    return &entry->count;
+}
+
+static void memory__add_one(struct memory__table *table, uint32_t ip, uint16_t vlan, uint16_t len, int is_output) {
+    struct ipcount_t *mem = memory__find(table, ip, vlan);
+    if (mem == NULL)
+	return;
+    if (is_output) {
+	mem->packets_out += (uint32_t)1;
+	mem->bytes_out += (uint64_t)len;
+    } else {
+	mem->packets_in += (uint32_t)1;
+	mem->u.bytes_in += (uint64_t)len;
+    }
+}
+
+#ifdef PRINT_EVERY_PACKET
+static void memory__dump_ipcount(uint32_t ip, struct ipcount_t const *mem) {
+    fprintf(stderr, "memory__dump_ipcount: (IP 0x%08" PRIx32 ") pi %" SCNu32 " po %" SCNu32 " bi %" SCNu64 " bo %" SCNu64
+	    " vl %" SCNu16 "\n",
+	    ip, mem->packets_in, mem->packets_out, mem->u.bytes_in, mem->bytes_out, mem->vlan);
+}
+#endif
@@ -30,6 +30,8 @@ along with LightCount.  If not, see <http://www.gnu.org/licenses/>.
 #define BUCKETS 7
 
 
+static struct ipcount_t *memory__find(void *memory, uint32_t ip, uint16_t vlan);
+static void memory__merge_one(void *memory, uint32_t ip, struct ipcount_t const *ipcount);
 static void memory__add_one(void *memory, uint32_t ip, uint16_t vlan, uint16_t len, int is_output);
 #ifdef PRINT_EVERY_PACKET
 static void memory__dump_ipcount(uint32_t ip, struct ipcount_t *ipc);
@@ -90,6 +92,24 @@ void memory_add(void *memory, uint32_t src, uint32_t dst, uint16_t vlan, uint16_
     memory__add_one(memory, dst, vlan, len, 0); /* dst == input */
 }
 
+void memory_merge(void *dst, void *src) {
+    int ip_low = 0;
+    struct ipcount_t *mem = src;
+
+    for (ip_low = 0; ip_low < (1 << HASHBITS); ++ip_low, mem += (BUCKETS + 1)) {
+	int i;
+	for (i = 0; i < BUCKETS && mem[i].is_used; ++i)
+	    memory__merge_one(dst, ip_low | (mem[i].ip_high << HASHBITS), &mem[i]);
+	if (i == BUCKETS && mem[BUCKETS].u.more_memory != NULL) {
+	    struct ipcount_t *more_mem = mem[BUCKETS].u.more_memory;
+	    while (more_mem->is_used) {
+		memory__merge_one(dst, ip_low | (more_mem->ip_high << HASHBITS), more_mem);
+		++more_mem;
+	    }
+	}
+    }
+}
+
 void memory_enum(void *memory, memory_enum_cb cb) {
     int ip_low = 0;
     struct ipcount_t *mem = memory;
@@ -116,28 +136,32 @@ void memory_enum(void *memory, memory_enum_cb cb) {
 }
 	    
 
-#define memory__add_one_first(iso, m, ih, v, l) \
-    m->is_used = 1; \
-    m->ip_high = ih; \
-    m->vlan = v; \
-    if (iso) { \
-	m->packets_out = (uint32_t)1; \
-	m->bytes_out = (uint64_t)l; \
-    } else { \
-	m->packets_in = (uint32_t)1; \
-	m->u.bytes_in = (uint64_t)l; \
+static void memory__add_one(void *memory, uint32_t ip, uint16_t vlan, uint16_t len, int is_output) {
+    struct ipcount_t *mem = memory__find(memory, ip, vlan);
+    if (mem == NULL)
+	return;
+    if (is_output) {
+	mem->packets_out += (uint32_t)1;
+	mem->bytes_out += (uint64_t)len;
+    } else {
+	mem->packets_in += (uint32_t)1;
+	mem->u.bytes_in += (uint64_t)len;
     }
+}
 
-#define memory__add_one_subsequent(iso, m, l) \
-    if (iso) { \
-	m->packets_out += (uint32_t)1; \
-	m->bytes_out += (uint64_t)l; \
-    } else { \
-	m->packets_in += (uint32_t)1; \
-	m->u.bytes_in += (uint64_t)l; \
-    }
+static void memory__merge_one(void *memory, uint32_t ip, struct ipcount_t const *ipcount) {
+    struct ipcount_t *mem = memory__find(memory, ip, ipcount->vlan);
+    if (mem == NULL)
+	return;
+    mem->packets_in += ipcount->packets_in;
+    mem->u.bytes_in += ipcount->u.bytes_in;
+    mem->packets_out += ipcount->packets_out;
+    mem->bytes_out += ipcount->bytes_out;
+}
 
-static void memory__add_one(void *memory, uint32_t ip, uint16_t vlan, uint16_t len, int is_output) {
+/* Returns the counts of ip/vlan, taking a zeroed slot for a new one. Returns
+ * NULL if no memory could be allocated. */
+static struct ipcount_t *memory__find(void *memory, uint32_t ip, uint16_t vlan) {
     int i;
     struct ipcount_t *mem = (struct ipcount_t*)memory + ((ip & ((1 << HASHBITS) - 1)) * (BUCKETS + 1));
     uint16_t ip_high = ip >> HASHBITS;
@@ -147,25 +171,28 @@ static void memory__add_one(void *memory, uint32_t ip, uint16_t vlan, uint16_t l
 	    assert(mem->packets_in == 0 && mem->packets_out == 0);
 	    assert(mem->u.bytes_in == 0 && mem->bytes_out == 0);
 	    assert(mem->vlan == 0 && mem->ip_high == 0);
-	    memory__add_one_first(is_output, mem, ip_high, vlan, len);
-	    return;
+	    mem->is_used = 1;
+	    mem->ip_high = ip_high;
+	    mem->vlan = vlan;
+	    return mem;
 	} else if (mem->ip_high == ip_high && mem->vlan == vlan) {
-	    memory__add_one_subsequent(is_output, mem, len);
-	    return;
+	    return mem;
 	}
     }
     /* We haven't returned.. memory must be full. We use BUCKET+1 to store a pointer to more memory. */
     if (mem->u.more_memory == NULL) {
 #ifndef NDEBUG
-	fprintf(stderr, "memory_add_one: Buckets are full for IP 0x%08" PRIx32 ". "
+	fprintf(stderr, "memory__find: Buckets are full for IP 0x%08" PRIx32 ". "
 		"Alloc'ing %" SCNu64 " bytes mem.\n",
 		ip, (uint64_t)sizeof(struct ipcount_t) * (1 << (32 - HASHBITS)));
 #endif
 	mem->u.more_memory = calloc(sizeof(struct ipcount_t), 1 << (32 - HASHBITS));
 	if (mem->u.more_memory == NULL) {
-	    fprintf(stderr, "memory_add_one: Error! Couldn't allocate more memory! Skipping count.\n");
-	    return;
+	    fprintf(stderr, "memory__find: Error! Couldn't allocate more memory! Skipping count.\n");
+	    stats_add(STATS_MEMORY_OVERFLOWS, 1);
+	    return NULL;
 	}
+	stats_add(STATS_MEMORY_ALLOCATIONS, 1);
     }
     mem = mem->u.more_memory;
     for (i = 0; i < (1 << (32 - HASHBITS)); ++i, ++mem) {
@@ -173,15 +200,17 @@ static void memory__add_one(void *memory, uint32_t ip, uint16_t vlan, uint16_t l
 	    assert(mem->packets_in == 0 && mem->packets_out == 0);
 	    assert(mem->u.bytes_in == 0 && mem->bytes_out == 0);
 	    assert(mem->vlan == 0 && mem->ip_high == 0);
-	    memory__add_one_first(is_output, mem, ip_high, vlan, len);
-	    return;
+	    mem->is_used = 1;
+	    mem->ip_high = ip_high;
+	    mem->vlan = vlan;
+	    return mem;
 	} else if (mem->ip_high == ip_high && mem->vlan == vlan) {
-	    memory__add_one_subsequent(is_output, mem, len);
-	    return;
+	    return mem;
 	}
     }
     /* We can't be here. We've allocated enough memory. */
     assert(0);
+    return NULL;
 }
 
 #ifdef PRINT_EVERY_PACKET
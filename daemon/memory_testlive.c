@@ -52,6 +52,9 @@ void memory_free(void *memory) {
 void memory_add(void *memory, uint32_t src, uint32_t dst, uint16_t vlan, uint16_t len) {
 }
 
+void memory_merge(void *dst, void *src) {
+}
+
 void memory_enum(void *memory, memory_enum_cb cb) {
     unsigned i;
     for (i = 0; i < sizeof(memory__testdata) / sizeof(unsigned); i += 6) {
@@ -0,0 +1,194 @@
+/* vim: set ts=8 sw=4 sts=4 noet: */
+/*======================================================================
+Copyright (C) 2008,2009 OSSO B.V. <walter+lightcount@osso.nl>
+This file is part of LightCount.
+
+LightCount is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+LightCount is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with LightCount.  If not, see <http://www.gnu.org/licenses/>.
+======================================================================*/
+
+#include "lightcount.h"
+#include "endian.h"
+#include <sys/socket.h>
+#include <netinet/in.h>
+#include <net/if.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+#include <linux/filter.h> /* linux-specific: SO_ATTACH_FILTER */
+#include <netpacket/packet.h> /* linux-specific: struct_ll and PF_PACKET */
+
+/* Static constants (also found in linux/if_ether.h) */
+#if BYTE_ORDER == LITTLE_ENDIAN
+# define ETH_P_ALL 0x0300   /* all frames */
+# define ETH_P_IP 0x0008    /* IP frames */
+# define ETH_P_8021Q 0x0081 /* 802.1q vlan frames */
+#elif BYTE_ORDER == BIG_ENDIAN
+# define ETH_P_ALL 0x0003   /* all frames */
+# define ETH_P_IP 0x0800    /* IP frames */
+# define ETH_P_8021Q 0x8100 /* 802.1q vlan frames */
+#endif
+
+/* The ethernet types as the filter loads them (in host order) */
+#define PACKET__BPF_ETH_P_IP 0x0800
+#define PACKET__BPF_ETH_P_8021Q 0x8100
+
+
+/* Ethernet header */
+struct packet__ether {
+    uint8_t dest[6];	    /* destination host address */
+    uint8_t source[6];	    /* source host address */
+    uint16_t type;	    /* ETH_P_* type */
+    uint16_t pcp_cfi_vid;   /* 3bit prio, 1bit format indic, 12bit vlan (0=no, fff=reserved) */
+    uint16_t type2;	    /* encapsulated type */
+};
+
+/* IP header */
+struct packet__ip {
+    uint8_t hl:4,	    /* header length */
+	    ver:4;	    /* version */
+    uint8_t  tos;	    /* type of service */
+    uint16_t len;	    /* total length */
+    uint16_t id;	    /* identification */
+    uint16_t off;	    /* fragment offset field */
+    uint8_t  ttl;	    /* time to live */
+    uint8_t  proto;	    /* protocol */
+    uint16_t sum;	    /* checksum */
+    uint32_t src;	    /* source address */
+    uint32_t dst;	    /* dest address */
+};
+
+
+int packet_socket_open(char const *iface) {
+    /* We could use ETH_P_IP here instead of ETH_P_ALL but we'd miss out on
+     * (1) locally generated packets and (2) 802.1q packets. */
+    int raw_socket = socket(PF_PACKET, SOCK_RAW, ETH_P_ALL);
+    if (raw_socket >= 0) {
+	if (strcmp(iface, "any") != 0) {
+	    int ifindex = if_nametoindex(iface);
+	    if (ifindex != 0) {
+		struct sockaddr_ll saddr_ll;
+		memset(&saddr_ll, 0, sizeof(struct sockaddr_ll));
+		saddr_ll.sll_family = AF_PACKET;
+		saddr_ll.sll_protocol = ETH_P_ALL;
+		saddr_ll.sll_ifindex = ifindex;
+		if (bind(raw_socket, (struct sockaddr*)&saddr_ll, sizeof(struct sockaddr_ll)) != 0)
+		    perror("bind");
+	    } else {
+		fprintf(stderr, "if_nametoindex: No such interface found, perhaps you want 'any' (all)?\n");
+		close(raw_socket);
+		return -1;
+	    }
+	}
+    } else {
+	perror("socket");
+	fprintf(stderr, "socket: Are you root? You need CAP_NET_RAW powers.\n");
+    }
+    return raw_socket;
+}
+
+int packet_filter_attach(int packet_socket, uint32_t const *ranges, size_t count) {
+    struct sock_filter *code;
+    struct sock_filter *insn;
+    struct sock_fprog filter;
+    size_t i;
+    int ip, ret;
+
+    if (ranges != NULL && count > PACKET_FILTER_MAX_RANGES) {
+	fprintf(stderr, "packet_filter_attach: %lu ip ranges is more than %u, filtering IP frames only.\n",
+		(unsigned long)count, (unsigned)PACKET_FILTER_MAX_RANGES);
+	ranges = NULL;
+    }
+    if ((code = malloc(sizeof(struct sock_filter) * (12 + 6 * (ranges == NULL ? 0 : count)))) == NULL) {
+	fprintf(stderr, "packet_filter_attach: malloc failed.\n");
+	return -1;
+    }
+
+    /* Accept only ETH_P_IP and ETH_P_8021Q/ETH_P_IP frames. The X register
+     * holds the length of the vlan tag, so we can load the addresses with
+     * it. (A tag that is stripped by the NIC is not in the frame.) All jumps
+     * are relative and forward only. */
+    insn = code;
+    *insn++ = (struct sock_filter)BPF_STMT(BPF_LDX | BPF_W | BPF_IMM, 0);
+    *insn++ = (struct sock_filter)BPF_STMT(BPF_LD | BPF_H | BPF_ABS, 12);
+    *insn++ = (struct sock_filter)BPF_JUMP(BPF_JMP | BPF_JEQ | BPF_K, PACKET__BPF_ETH_P_IP, 5, 0);
+    *insn++ = (struct sock_filter)BPF_JUMP(BPF_JMP | BPF_JEQ | BPF_K, PACKET__BPF_ETH_P_8021Q, 0, 2);
+    *insn++ = (struct sock_filter)BPF_STMT(BPF_LD | BPF_H | BPF_ABS, 16);
+    *insn++ = (struct sock_filter)BPF_JUMP(BPF_JMP | BPF_JEQ | BPF_K, PACKET__BPF_ETH_P_IP, 1, 0);
+    *insn++ = (struct sock_filter)BPF_STMT(BPF_RET | BPF_K, 0);
+    *insn++ = (struct sock_filter)BPF_STMT(BPF_LDX | BPF_W | BPF_IMM, 4);
+
+    /* Accept the frame if the source or destination is in one of the ranges.
+     * Three instructions per range keep every jump short; the kernel limits
+     * the program length to a few thousand instructions, hence the maximum
+     * number of ranges. */
+    if (ranges != NULL) {
+	for (ip = 0; ip < 2; ++ip) {
+	    *insn++ = (struct sock_filter)BPF_STMT(BPF_LD | BPF_W | BPF_IND, ip == 0 ? 26 : 30);
+	    for (i = 0; i < count; ++i) {
+		*insn++ = (struct sock_filter)BPF_JUMP(BPF_JMP | BPF_JGE | BPF_K, ranges[2 * i], 0, 2);
+		*insn++ = (struct sock_filter)BPF_JUMP(BPF_JMP | BPF_JGT | BPF_K, ranges[2 * i + 1], 1, 0);
+		*insn++ = (struct sock_filter)BPF_STMT(BPF_RET | BPF_K, PACKET_SNAPLEN);
+	    }
+	}
+	*insn++ = (struct sock_filter)BPF_STMT(BPF_RET | BPF_K, 0);
+    } else {
+	*insn++ = (struct sock_filter)BPF_STMT(BPF_RET | BPF_K, PACKET_SNAPLEN);
+    }
+
+    /* Replaces the current filter atomically */
+    filter.len = insn - code;
+    filter.filter = code;
+    if ((ret = setsockopt(packet_socket, SOL_SOCKET, SO_ATTACH_FILTER, &filter, sizeof(filter))) != 0)
+	perror("setsockopt(SO_ATTACH_FILTER)");
+#ifndef NDEBUG
+    else
+	fprintf(stderr, "packet_filter_attach: Attached a filter of %u instructions for %lu ip ranges.\n",
+		(unsigned)filter.len, (unsigned long)(ranges == NULL ? 0 : count));
+#endif
+    free(code);
+    return ret;
+}
+
+void packet_count(void *memory, uint8_t const *frame, size_t caplen, uint16_t vlan) {
+    struct packet__ether const *ether = (struct packet__ether const*)frame;
+    struct packet__ip const *ip = (struct packet__ip const*)(frame + 14);
+    struct packet__ip const *ipq = (struct packet__ip const*)(frame + 18);
+
+    /* Process only ETH_P_IP/ETH_P_8021Q packets.
+     * Make sure we count the ethernet frame lengths as well (18 resp. 22 bytes).
+     * Don't read past the end of a short frame (a truncated pcap file). */
+    if (caplen < 14)
+	return;
+    if (ether->type == ETH_P_IP) {
+	if (caplen < 14 + sizeof(struct packet__ip))
+	    return;
+	/* A vlan tag stripped by the NIC (offloading) is passed to us separately */
+	memory_add(memory, ntohl(ip->src), ntohl(ip->dst), vlan, ntohs(ip->len) + (vlan ? 22 : 18));
+    } else if (ether->type == ETH_P_8021Q && caplen >= 18 && ether->type2 == ETH_P_IP) {
+	if (caplen < 18 + sizeof(struct packet__ip))
+	    return;
+	memory_add(
+	    memory,
+	    ntohl(ipq->src),
+	    ntohl(ipq->dst),
+#if BYTE_ORDER == LITTLE_ENDIAN
+	    ((uint8_t*)&ether->pcp_cfi_vid)[1] | ((((uint8_t*)&ether->pcp_cfi_vid)[0] & 0xf) << 8),
+#elif BYTE_ORDER == BIG_ENDIAN
+	    ether->pcp_cfi_vid & 0xfff,
+#endif
+	    ntohs(ipq->len) + 22
+	);
+    }
+}
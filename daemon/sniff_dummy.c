@@ -18,7 +18,6 @@ along with LightCount.  If not, see <http://www.gnu.org/licenses/>.
 ======================================================================*/
 
 #include "lightcount.h"
-#include <signal.h>
 #include <stdio.h>
 
 
@@ -37,6 +36,11 @@ int sniff_create_socket(char const *iface) {
 }
 
 void sniff_loop(int packet_socket, void *memory1, void *memory2) {
-    /* Add signal handlers */
-    util_signal_set(SIGUSR1, SIG_IGN);
+    /* We join no memory handoff, so the timer doesn't wait for us */
+}
+
+void sniff_collect(void *memory) {
+}
+
+void sniff_ipfilter(uint32_t const *ranges, size_t count) {
 }
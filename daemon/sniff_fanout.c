@@ -0,0 +1,244 @@
+/* vim: set ts=8 sw=4 sts=4 noet: */
+/*======================================================================
+Copyright (C) 2008,2009 OSSO B.V. <walter+lightcount@osso.nl>
+This file is part of LightCount.
+
+LightCount is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+LightCount is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with LightCount.  If not, see <http://www.gnu.org/licenses/>.
+======================================================================*/
+
+#include "lightcount.h"
+#include <sys/socket.h>
+#include <sys/time.h>
+#include <assert.h>
+#include <errno.h>
+#include <pthread.h>
+#include <signal.h>
+#include <stdio.h>
+#include <string.h>
+#include <unistd.h>
+#include <linux/if_packet.h> /* linux-specific: PACKET_FANOUT */
+
+/* Settings */
+#ifndef SNIFF_WORKERS
+#   define SNIFF_WORKERS 4		    /* number of capture threads */
+#endif /* SNIFF_WORKERS */
+#define RECV_TIMEOUT_MS 100		    /* check for the quit signals every N ms */
+#define STATS_PACKETS_BATCH 1024	    /* update the shared packet counter every N packets */
+
+
+struct sniff__worker {
+    pthread_t thread;
+    int socket;
+    int handoff;			    /* our thread number in the memory handoff */
+    void *memory[2];			    /* private memory */
+    unsigned packets;			    /* packets not added to the statistics yet */
+    void *owner[2];			    /* the shared memory the private memory is counted for */
+    int memidx;				    /* the private memory we count in */
+};
+
+static char sniff__iface[256];		    /* the interface to listen on */
+static int sniff__fanout_id;		    /* the fanout group of our sockets */
+static struct sniff__worker sniff__workers[SNIFF_WORKERS];
+static int sniff__worker_count;		    /* number of running workers */
+static volatile int sniff__done;	    /* whether we're done */
+
+
+static int sniff__open_socket();
+static void *sniff__run(void *thread_arg);
+static void sniff__loop_done(int signum);
+
+
+void sniff_help() {
+    printf(
+	"/********************* module: sniff (packet_fanout) **************************/\n"
+	"#define SNIFF_WORKERS %u\n"
+	"\n"
+	"Sniff runs SNIFF_WORKERS capture threads, each with its own packet socket. The\n"
+	"sockets are joined in a PACKET_FANOUT group in hash mode, so the kernel spreads\n"
+	"the packets over the threads by flow. Specify the interface name as IFACE or\n"
+	"'any' if you want to listen on all interfaces.\n"
+	"\n"
+	"Every thread counts in a private pair of memory buffers. At every interval the\n"
+	"timer adds them up before storing, so the totals are the same as with a single\n"
+	"capture thread. Keep in mind that this takes SNIFF_WORKERS times the memory of\n"
+	"the memory module.\n"
+	"\n"
+	"The notes of the packet_socket module apply as well, the socket filter is\n"
+	"attached to every socket.\n"
+	"\n",
+	(unsigned)SNIFF_WORKERS
+    );
+}
+
+int sniff_create_socket(char const *iface) {
+    strncpy(sniff__iface, iface, sizeof(sniff__iface) - 1);
+    sniff__iface[sizeof(sniff__iface) - 1] = '\0';
+    sniff__fanout_id = getpid() & 0xffff;
+    return sniff__open_socket();
+}
+
+void sniff_loop(int packet_socket, void *memory1, void *memory2) {
+    int i;
+
+    /* Set globals */
+    sniff__done = 0;
+
+    /* Add signal handlers */
+    util_signal_set(SIGINT, sniff__loop_done);
+    util_signal_set(SIGHUP, sniff__loop_done);
+    util_signal_set(SIGQUIT, sniff__loop_done);
+    util_signal_set(SIGTERM, sniff__loop_done);
+
+    /* Open the sockets of the other workers and get everyone memory. The
+     * first worker uses the passed socket and runs in this thread. */
+    for (i = 0; i < SNIFF_WORKERS; ++i) {
+	struct sniff__worker *worker = &sniff__workers[i];
+	if ((worker->socket = (i == 0 ? packet_socket : sniff__open_socket())) < 0)
+	    break;
+	worker->memory[0] = memory_alloc();
+	worker->memory[1] = memory_alloc();
+	assert(worker->memory[0] != NULL && worker->memory[1] != NULL);
+	worker->owner[0] = worker->owner[1] = NULL;
+	worker->memidx = 0;
+	worker->packets = 0;
+	worker->handoff = util_handoff_join();
+	if (i != 0 && pthread_create(&worker->thread, NULL, &sniff__run, worker) != 0) {
+	    perror("pthread_create");
+	    close(worker->socket);
+	    break;
+	}
+	sniff__worker_count = i + 1;
+    }
+
+#ifndef NDEBUG
+    fprintf(stderr, "sniff_loop: Starting loop with %d workers (mem %p/%p).\n",
+	    sniff__worker_count, memory1, memory2);
+#endif
+
+    sniff__run(&sniff__workers[0]);
+
+    /* Wait for the other workers. Their memory stays: the timer may collect
+     * from it until it is stopped. */
+    for (i = 1; i < sniff__worker_count; ++i) {
+	if (pthread_join(sniff__workers[i].thread, NULL) != 0)
+	    perror("pthread_join");
+	close(sniff__workers[i].socket);
+    }
+#ifndef NDEBUG
+    fprintf(stderr, "sniff_loop: Ended loop at user/system request.\n");
+#endif
+
+    /* Remove signal handlers */
+    util_signal_set(SIGINT, SIG_IGN);
+    util_signal_set(SIGHUP, SIG_IGN);
+    util_signal_set(SIGQUIT, SIG_IGN);
+    util_signal_set(SIGTERM, SIG_IGN);
+}
+
+void sniff_ipfilter(uint32_t const *ranges, size_t count) {
+    int i;
+    /* The workers are started long before the first interval is stored */
+    for (i = 0; i < sniff__worker_count; ++i)
+	packet_filter_attach(sniff__workers[i].socket, ranges, count);
+}
+
+void sniff_collect(void *memory) {
+    struct tpacket_stats stats;
+    socklen_t len;
+    int i, j;
+    /* The timer hands out more than two memories when it queues intervals for
+     * storage, so look up the private memory that was counted for this one */
+    for (i = 0; i < sniff__worker_count; ++i) {
+	struct sniff__worker *worker = &sniff__workers[i];
+	for (j = 0; j < 2; ++j) {
+	    if (worker->owner[j] == memory) {
+		memory_merge(memory, worker->memory[j]);
+		memory_reset(worker->memory[j]);
+		worker->owner[j] = NULL;
+	    }
+	}
+	/* Reading the kernel statistics resets them */
+	len = sizeof(stats);
+	if (getsockopt(worker->socket, SOL_PACKET, PACKET_STATISTICS, &stats, &len) == 0)
+	    stats_add(STATS_KERNEL_DROPS, stats.tp_drops);
+    }
+}
+
+static int sniff__open_socket() {
+    struct timeval timeout;
+    int fanout = sniff__fanout_id | (PACKET_FANOUT_HASH << 16);
+    int raw_socket;
+
+    if ((raw_socket = packet_socket_open(sniff__iface)) < 0)
+	return -1;
+
+    /* Don't block forever, so we notice when we're done */
+    timeout.tv_sec = 0;
+    timeout.tv_usec = RECV_TIMEOUT_MS * 1000;
+    if (setsockopt(raw_socket, SOL_SOCKET, SO_RCVTIMEO, &timeout, sizeof(timeout)) != 0
+	    || setsockopt(raw_socket, SOL_PACKET, PACKET_FANOUT, &fanout, sizeof(fanout)) != 0) {
+	perror("setsockopt");
+	close(raw_socket);
+	return -1;
+    }
+    packet_filter_attach(raw_socket, NULL, 0); /* ignore return value */
+    return raw_socket;
+}
+
+static void *sniff__run(void *thread_arg) {
+    struct sniff__worker *worker = (struct sniff__worker*)thread_arg;
+    uint8_t datagram[PACKET_SNAPLEN];
+    ssize_t ret;
+
+    while (!sniff__done) {
+	/* Try without blocking first: while the packets keep coming we stay
+	 * busy, which costs no memory barriers */
+	ret = recv(worker->socket, datagram, PACKET_SNAPLEN, MSG_DONTWAIT);
+	if (ret < 0 && (errno == EAGAIN || errno == EWOULDBLOCK)) {
+	    /* We're idle while blocking in recv, so the timer need not wait
+	     * for us to get the next packet. A quiet moment too, so bring the
+	     * statistics up to date. */
+	    util_handoff_idle(worker->handoff);
+	    if (worker->packets != 0) {
+		stats_add(STATS_PACKETS, worker->packets);
+		worker->packets = 0;
+	    }
+	    ret = recv(worker->socket, datagram, PACKET_SNAPLEN, 0);
+	}
+	if (ret > 0) {
+	    void *memp = util_handoff_poll(worker->handoff);
+	    if (memp != worker->owner[worker->memidx]) {
+		/* The other private memory was collected when the timer
+		 * handed out the memory we counted for last */
+		worker->memidx = !worker->memidx;
+		worker->owner[worker->memidx] = memp;
+	    }
+	    packet_count(worker->memory[worker->memidx], datagram, ret, 0);
+	    if (++worker->packets == STATS_PACKETS_BATCH) {
+		stats_add(STATS_PACKETS, worker->packets);
+		worker->packets = 0;
+	    }
+	} else if (ret < 0 && errno != EAGAIN && errno != EWOULDBLOCK && errno != EINTR) {
+	    perror("recv");
+	    sniff__done = 1; /* stop the others as well */
+	}
+    }
+    util_handoff_idle(worker->handoff);
+    stats_add(STATS_PACKETS, worker->packets);
+    return 0;
+}
+
+static void sniff__loop_done(int signum) {
+    sniff__done = 1;
+}
@@ -0,0 +1,228 @@
+/* vim: set ts=8 sw=4 sts=4 noet: */
+/*======================================================================
+Copyright (C) 2008,2009 OSSO B.V. <walter+lightcount@osso.nl>
+This file is part of LightCount.
+
+LightCount is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+LightCount is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with LightCount.  If not, see <http://www.gnu.org/licenses/>.
+======================================================================*/
+
+#include "lightcount.h"
+#include <sys/mman.h>
+#include <sys/socket.h>
+#include <errno.h>
+#include <poll.h>
+#include <signal.h>
+#include <stdio.h>
+#include <unistd.h>
+#include <linux/if_packet.h> /* linux-specific: TPACKET_V3 and PACKET_RX_RING */
+
+/* Settings */
+#define RING_BLOCK_SIZE (1 << 20)	    /* bytes per ring block (a multiple of the page size) */
+#define RING_BLOCK_COUNT 64		    /* blocks in the ring */
+#define RING_FRAME_SIZE 128		    /* (minimum) bytes per frame: header + snaplen */
+#define RING_BLOCK_TIMEOUT 100		    /* hand over partially filled blocks after N ms */
+
+
+static uint8_t *sniff__ring;		    /* the mmapped rx ring */
+static int sniff__socket;		    /* the packet socket, for the filter */
+static volatile int sniff__done;	    /* whether we're done */
+
+
+static void sniff__loop_done(int signum);
+static void sniff__print_stats(int packet_socket);
+static void sniff__read_block(struct tpacket_block_desc *block, void *memory);
+
+
+void sniff_help() {
+    printf(
+	"/********************* module: sniff (packet_mmap) ****************************/\n"
+	"#define RING_BLOCK_SIZE %u\n"
+	"#define RING_BLOCK_COUNT %u\n"
+	"#define RING_BLOCK_TIMEOUT %u\n"
+	"\n"
+	"Sniff uses a packet socket with a memory mapped receive ring (TPACKET_V3) to\n"
+	"listen for all inbound and outbound packets. Specify the interface name as\n"
+	"IFACE or 'any' if you want to listen on all interfaces.\n"
+	"\n"
+	"The kernel copies the first %u bytes of every frame into blocks of\n"
+	"RING_BLOCK_SIZE bytes. We wake up once per filled block (or after\n"
+	"RING_BLOCK_TIMEOUT milliseconds) and count all frames in it, instead of doing\n"
+	"a system call per packet like the packet_socket module. Use this module on\n"
+	"busy links. The ring takes RING_BLOCK_SIZE * RING_BLOCK_COUNT bytes of memory.\n"
+	"\n"
+	"At every memory switch the number of packets the kernel dropped because the\n"
+	"ring was full is printed to stderr.\n"
+	"\n"
+	"The notes of the packet_socket module (including the socket filter) apply as\n"
+	"well, except that vlan tags stripped by hardware VLAN acceleration are\n"
+	"recovered from the ring.\n"
+	"\n",
+	RING_BLOCK_SIZE, RING_BLOCK_COUNT, RING_BLOCK_TIMEOUT, PACKET_SNAPLEN
+    );
+}
+
+int sniff_create_socket(char const *iface) {
+    int version = TPACKET_V3;
+    struct tpacket_req3 req;
+    int raw_socket;
+
+    if ((raw_socket = packet_socket_open(iface)) < 0)
+	return -1;
+
+    /* Copy only the headers of IP frames into the ring */
+    if (setsockopt(raw_socket, SOL_PACKET, PACKET_VERSION, &version, sizeof(version)) != 0) {
+	perror("setsockopt");
+	close(raw_socket);
+	return -1;
+    }
+    if (packet_filter_attach(raw_socket, NULL, 0) != 0) {
+	close(raw_socket);
+	return -1;
+    }
+
+    /* Create and map the ring */
+    req.tp_block_size = RING_BLOCK_SIZE;
+    req.tp_block_nr = RING_BLOCK_COUNT;
+    req.tp_frame_size = RING_FRAME_SIZE;
+    req.tp_frame_nr = (RING_BLOCK_SIZE / RING_FRAME_SIZE) * RING_BLOCK_COUNT;
+    req.tp_retire_blk_tov = RING_BLOCK_TIMEOUT;
+    req.tp_sizeof_priv = 0;
+    req.tp_feature_req_word = 0;
+    if (setsockopt(raw_socket, SOL_PACKET, PACKET_RX_RING, &req, sizeof(req)) != 0) {
+	perror("setsockopt(PACKET_RX_RING)");
+	close(raw_socket);
+	return -1;
+    }
+    sniff__ring = (uint8_t*)mmap(NULL, RING_BLOCK_SIZE * RING_BLOCK_COUNT, PROT_READ | PROT_WRITE,
+	    MAP_SHARED, raw_socket, 0);
+    if (sniff__ring == MAP_FAILED) {
+	perror("mmap");
+	close(raw_socket);
+	return -1;
+    }
+    sniff__socket = raw_socket;
+    return raw_socket;
+}
+
+void sniff_loop(int packet_socket, void *memory1, void *memory2) {
+    struct pollfd pfd;
+    unsigned block_num = 0;
+    void *memp = NULL;
+    int thread;
+
+    /* Set globals and get the memory from the timer */
+    sniff__done = 0;
+    thread = util_handoff_join();
+
+    /* Add signal handlers */
+    util_signal_set(SIGINT, sniff__loop_done);
+    util_signal_set(SIGHUP, sniff__loop_done);
+    util_signal_set(SIGQUIT, sniff__loop_done);
+    util_signal_set(SIGTERM, sniff__loop_done);
+
+    /* FIXME: Put the interfaces in promiscuous mode.. you must do this
+     * by hand for now (/sbin/ip link set eth0 up promisc on). */
+
+#ifndef NDEBUG
+    fprintf(stderr, "sniff_loop: Starting loop (mem %p/%p).\n", memory1, memory2);
+#endif
+
+    pfd.fd = packet_socket;
+    pfd.events = POLLIN | POLLERR;
+    pfd.revents = 0;
+
+    while (!sniff__done) {
+	struct tpacket_block_desc *block = (struct tpacket_block_desc*)(sniff__ring + block_num * RING_BLOCK_SIZE);
+
+	void *new_memp = util_handoff_poll(thread);
+
+	if (new_memp != memp) {
+	    if (memp != NULL)
+		sniff__print_stats(packet_socket);
+	    memp = new_memp;
+	}
+
+	/* Wait for the kernel to hand over the block (wake up now and then to
+	 * print the stats of an idle link) */
+	if ((block->hdr.bh1.block_status & TP_STATUS_USER) == 0) {
+	    util_handoff_idle(thread);
+	    if (poll(&pfd, 1, RING_BLOCK_TIMEOUT) < 0 && errno != EINTR) {
+		perror("poll");
+		break;
+	    }
+	    continue;
+	}
+
+	/* Count the frames and give the block back */
+	sniff__read_block(block, memp);
+	__sync_synchronize();
+	block->hdr.bh1.block_status = TP_STATUS_KERNEL;
+	block_num = (block_num + 1) % RING_BLOCK_COUNT;
+    }
+#ifndef NDEBUG
+    if (sniff__done)
+	fprintf(stderr, "sniff_loop: Ended loop at user/system request.\n");
+#endif
+    util_handoff_idle(thread);
+
+    /* Remove signal handlers */
+    util_signal_set(SIGINT, SIG_IGN);
+    util_signal_set(SIGHUP, SIG_IGN);
+    util_signal_set(SIGQUIT, SIG_IGN);
+    util_signal_set(SIGTERM, SIG_IGN);
+
+    /* Unmap the ring, the socket is closed by the caller */
+    if (munmap(sniff__ring, RING_BLOCK_SIZE * RING_BLOCK_COUNT) != 0)
+	perror("munmap");
+}
+
+static void sniff__read_block(struct tpacket_block_desc *block, void *memory) {
+    struct tpacket3_hdr *frame = (struct tpacket3_hdr*)((uint8_t*)block + block->hdr.bh1.offset_to_first_pkt);
+    uint32_t i;
+
+    stats_add(STATS_PACKETS, block->hdr.bh1.num_pkts);
+    for (i = 0; i < block->hdr.bh1.num_pkts; ++i) {
+	uint16_t vlan = 0;
+	if ((frame->tp_status & TP_STATUS_VLAN_VALID) != 0)
+	    vlan = frame->hv1.tp_vlan_tci & 0xfff;
+	packet_count(memory, (uint8_t*)frame + frame->tp_mac, frame->tp_snaplen, vlan);
+	frame = (struct tpacket3_hdr*)((uint8_t*)frame + frame->tp_next_offset);
+    }
+}
+
+static void sniff__print_stats(int packet_socket) {
+    struct tpacket_stats_v3 stats;
+    socklen_t len = sizeof(stats);
+
+    /* Reading the statistics resets them */
+    if (getsockopt(packet_socket, SOL_PACKET, PACKET_STATISTICS, &stats, &len) != 0) {
+	perror("getsockopt(PACKET_STATISTICS)");
+	return;
+    }
+    fprintf(stderr, "sniff_loop: Kernel received %u packets and dropped %u in this interval (ring full %u times).\n",
+	    stats.tp_packets, stats.tp_drops, stats.tp_freeze_q_cnt);
+    stats_add(STATS_KERNEL_DROPS, stats.tp_drops);
+}
+
+void sniff_collect(void *memory) {
+    /* We count directly in the passed memory */
+}
+
+void sniff_ipfilter(uint32_t const *ranges, size_t count) {
+    packet_filter_attach(sniff__socket, ranges, count);
+}
+
+static void sniff__loop_done(int signum) {
+    sniff__done = 1;
+}
@@ -0,0 +1,217 @@
+/* vim: set ts=8 sw=4 sts=4 noet: */
+/*======================================================================
+Copyright (C) 2009 OSSO B.V. <walter+lightcount@osso.nl>
+This file is part of LightCount.
+
+LightCount is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+LightCount is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with LightCount.  If not, see <http://www.gnu.org/licenses/>.
+======================================================================*/
+
+#include "lightcount.h"
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <sys/time.h>
+#include <fcntl.h>
+#include <signal.h>
+#include <stdio.h>
+#include <unistd.h>
+
+/* Settings */
+#ifndef REPLAY_PPS
+#   define REPLAY_PPS 0			    /* packets per second, 0 for as fast as possible */
+#endif /* REPLAY_PPS */
+#ifndef REPLAY_LOOPS
+#   define REPLAY_LOOPS 1		    /* replay the file N times */
+#endif /* REPLAY_LOOPS */
+#define REPLAY_PACE_PACKETS 1000	    /* check the replay rate every N packets */
+#define STATS_PACKETS_BATCH 1024	    /* update the shared packet counter every N packets */
+
+/* The pcap file format (native, not pcapng) */
+#define SNIFF__PCAP_MAGIC 0xa1b2c3d4	    /* microsecond timestamps */
+#define SNIFF__PCAP_MAGIC_NSEC 0xa1b23c4d   /* nanosecond timestamps */
+#define SNIFF__PCAP_LINKTYPE_ETHERNET 1
+
+struct sniff__pcap_header {
+    uint32_t magic;
+    uint16_t version_major;
+    uint16_t version_minor;
+    int32_t thiszone;
+    uint32_t sigfigs;
+    uint32_t snaplen;
+    uint32_t linktype;
+};
+
+struct sniff__pcap_record {
+    uint32_t ts_sec;
+    uint32_t ts_usec;
+    uint32_t caplen;			    /* bytes in the file */
+    uint32_t len;			    /* bytes on the wire */
+};
+
+
+static volatile int sniff__done;	    /* whether we're done */
+
+
+static uint32_t sniff__swap32(uint32_t value);
+static double sniff__now();
+static void sniff__loop_done(int signum);
+
+
+void sniff_help() {
+    printf(
+	"/********************* module: sniff (pcap_file) ******************************/\n"
+	"#define REPLAY_PPS %u\n"
+	"#define REPLAY_LOOPS %u\n"
+	"\n"
+	"Sniff replays the ethernet frames of a pcap file instead of listening on an\n"
+	"interface. Specify the file name as IFACE. Only the native pcap format is\n"
+	"read (tcpdump -w writes it), no libpcap is needed.\n"
+	"\n"
+	"The frames are replayed REPLAY_LOOPS times, at REPLAY_PPS packets per second\n"
+	"or as fast as possible if that is 0. The capture timestamps are ignored. When\n"
+	"done, the replay rate is printed and the loop ends, as if interrupted. Combine\n"
+	"this with the oneshot timer to store a single interval (set LISTEN_SECONDS\n"
+	"long enough) and time the whole capture path of a memory module.\n"
+	"\n"
+	"The IP ranges passed by the storage engine are ignored.\n"
+	"\n",
+	(unsigned)REPLAY_PPS, (unsigned)REPLAY_LOOPS
+    );
+}
+
+int sniff_create_socket(char const *iface) {
+    int fd = open(iface, O_RDONLY);
+    if (fd < 0)
+	perror("open");
+    return fd;
+}
+
+void sniff_loop(int packet_socket, void *memory1, void *memory2) {
+    struct sniff__pcap_header const *header;
+    struct stat st;
+    void *file = MAP_FAILED;
+    uint8_t const *end, *pos;
+    uint64_t packets = 0, bytes = 0;
+    double begin_time, elapsed;
+    int is_swapped = 0, loop, thread;
+
+    /* Set globals and get the memory from the timer */
+    sniff__done = 0;
+    thread = util_handoff_join();
+
+    /* Add signal handlers */
+    util_signal_set(SIGINT, sniff__loop_done);
+    util_signal_set(SIGHUP, sniff__loop_done);
+    util_signal_set(SIGQUIT, sniff__loop_done);
+    util_signal_set(SIGTERM, sniff__loop_done);
+
+    /* Map the entire file, so we don't time the reads */
+    if (fstat(packet_socket, &st) != 0) {
+	perror("fstat");
+	sniff__done = 1;
+    } else if ((size_t)st.st_size < sizeof(struct sniff__pcap_header)) {
+	fprintf(stderr, "sniff_loop: File is too small to be a pcap file.\n");
+	sniff__done = 1;
+    } else if ((file = mmap(NULL, st.st_size, PROT_READ, MAP_PRIVATE, packet_socket, 0)) == MAP_FAILED) {
+	perror("mmap");
+	sniff__done = 1;
+    }
+
+    header = (struct sniff__pcap_header const*)file;
+    end = (uint8_t const*)file + (file == MAP_FAILED ? 0 : st.st_size);
+    if (!sniff__done) {
+	is_swapped = (header->magic == sniff__swap32(SNIFF__PCAP_MAGIC)
+		|| header->magic == sniff__swap32(SNIFF__PCAP_MAGIC_NSEC));
+	if (!is_swapped && header->magic != SNIFF__PCAP_MAGIC && header->magic != SNIFF__PCAP_MAGIC_NSEC) {
+	    fprintf(stderr, "sniff_loop: File is not a pcap file (pcapng is not supported).\n");
+	    sniff__done = 1;
+	} else if ((is_swapped ? sniff__swap32(header->linktype) : header->linktype) != SNIFF__PCAP_LINKTYPE_ETHERNET) {
+	    fprintf(stderr, "sniff_loop: File does not contain ethernet frames.\n");
+	    sniff__done = 1;
+	}
+#ifndef NDEBUG
+	fprintf(stderr, "sniff_loop: Starting loop (mem %p/%p).\n", memory1, memory2);
+#endif
+    }
+
+    begin_time = sniff__now();
+    for (loop = 0; loop < REPLAY_LOOPS && !sniff__done; ++loop) {
+	pos = (uint8_t const*)file + sizeof(struct sniff__pcap_header);
+	while (pos + sizeof(struct sniff__pcap_record) <= end && !sniff__done) {
+	    struct sniff__pcap_record const *record = (struct sniff__pcap_record const*)pos;
+	    uint32_t caplen = (is_swapped ? sniff__swap32(record->caplen) : record->caplen);
+
+	    pos += sizeof(struct sniff__pcap_record);
+	    if (caplen > (size_t)(end - pos)) {
+		fprintf(stderr, "sniff_loop: File ends in the middle of a frame.\n");
+		break;
+	    }
+	    packet_count(util_handoff_poll(thread), pos, caplen, 0);
+	    pos += caplen;
+	    bytes += caplen;
+	    if (++packets % STATS_PACKETS_BATCH == 0)
+		stats_add(STATS_PACKETS, STATS_PACKETS_BATCH);
+
+#if REPLAY_PPS != 0
+	    /* Sleep when we're ahead of schedule, we're idle meanwhile */
+	    if (packets % REPLAY_PACE_PACKETS == 0) {
+		double ahead = (double)packets / REPLAY_PPS - (sniff__now() - begin_time);
+		if (ahead > 0) {
+		    util_handoff_idle(thread);
+		    usleep((unsigned)(ahead * 1000000));
+		}
+	    }
+#endif /* REPLAY_PPS != 0 */
+	}
+    }
+    util_handoff_idle(thread);
+    stats_add(STATS_PACKETS, packets % STATS_PACKETS_BATCH);
+
+    if (file != MAP_FAILED) {
+	elapsed = sniff__now() - begin_time;
+	fprintf(stderr, "sniff_loop: Replayed %" SCNu64 " packets (%" SCNu64 " bytes captured) in %.3f seconds, "
+		"%.0f packets/s, %.1f ns/packet.\n",
+		packets, bytes, elapsed, elapsed > 0 ? packets / elapsed : 0.0,
+		packets != 0 ? elapsed * 1000000000.0 / packets : 0.0);
+	if (munmap(file, st.st_size) != 0)
+	    perror("munmap");
+    }
+
+    /* Remove signal handlers */
+    util_signal_set(SIGINT, SIG_IGN);
+    util_signal_set(SIGHUP, SIG_IGN);
+    util_signal_set(SIGQUIT, SIG_IGN);
+    util_signal_set(SIGTERM, SIG_IGN);
+}
+
+void sniff_collect(void *memory) {
+    /* We count directly in the passed memory */
+}
+
+void sniff_ipfilter(uint32_t const *ranges, size_t count) {
+    /* There is no kernel to filter for us */
+}
+
+static uint32_t sniff__swap32(uint32_t value) {
+    return (value >> 24) | ((value >> 8) & 0xff00) | ((value << 8) & 0xff0000) | (value << 24);
+}
+
+static double sniff__now() {
+    struct timeval tv;
+    gettimeofday(&tv, NULL);
+    return tv.tv_sec + tv.tv_usec / 1000000.0;
+}
+
+static void sniff__loop_done(int signum) {
+    sniff__done = 1;
+}
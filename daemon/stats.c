@@ -0,0 +1,284 @@
+/* vim: set ts=8 sw=4 sts=4 noet: */
+/*======================================================================
+Copyright (C) 2009 OSSO B.V. <walter+lightcount@osso.nl>
+This file is part of LightCount.
+
+LightCount is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+LightCount is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with LightCount.  If not, see <http://www.gnu.org/licenses/>.
+======================================================================*/
+
+#include "lightcount.h"
+#include <sys/socket.h>
+#include <sys/un.h>
+#include <netinet/in.h>
+#include <arpa/inet.h>
+#include <errno.h>
+#include <poll.h>
+#include <pthread.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+
+/* Settings */
+#define BUFSIZE 4096			    /* all counters fit in this */
+#define ACCEPT_TIMEOUT_MS 500		    /* check whether we're done every N ms */
+
+
+/* How to present a counter */
+struct stats__info {
+    char const *name;
+    char const *type;			    /* counter or gauge */
+    double scale;			    /* divide the value by this */
+    char const *help;
+};
+
+static struct stats__info const stats__infos[STATS__COUNT] = {
+    {"lightcount_packets_total", "counter", 1,
+	"Frames seen by the sniff module."},
+    {"lightcount_kernel_drops_total", "counter", 1,
+	"Frames the kernel dropped before the sniff module got them."},
+    {"lightcount_memory_allocations_total", "counter", 1,
+	"Extra allocations by the memory module for busy hash buckets or a bigger table."},
+    {"lightcount_memory_overflows_total", "counter", 1,
+	"Counts the memory module skipped because it was full."},
+    {"lightcount_flushes_total", "counter", 1,
+	"Intervals handed to the storage module."},
+    {"lightcount_flush_dropped_total", "counter", 1,
+	"Intervals dropped because the flush queue was full."},
+    {"lightcount_flush_merged_total", "counter", 1,
+	"Intervals merged with the next because the flush queue was full."},
+    {"lightcount_flush_queue_depth", "gauge", 1,
+	"Intervals waiting for the storage module at the last flush."},
+    {"lightcount_flush_lag_seconds", "gauge", 1,
+	"Time between the end of the last stored interval and the end of its flush."},
+    {"lightcount_flush_duration_seconds", "gauge", 1000000,
+	"Time the last flush took."},
+    {"lightcount_storage_rows_total", "counter", 1,
+	"Rows written by the storage module."},
+    {"lightcount_storage_failures_total", "counter", 1,
+	"Writes the storage module failed to complete."},
+    {"lightcount_storage_ips", "gauge", 1,
+	"IPs in the last interval handed to the storage module."}
+};
+
+static uint64_t volatile stats__values[STATS__COUNT];
+static char stats__listen[256];		    /* the address to listen on, if any */
+static int stats__socket = -1;		    /* the listening socket */
+static pthread_t stats__thread;
+static volatile int stats__done;	    /* whether we're done */
+
+
+static int stats__read_config(char const *config_file);
+static int stats__open_socket();
+static void *stats__run(void *thread_arg);
+static void stats__serve(int client);
+
+
+void stats_help() {
+    printf(
+	"/********************* statistics *********************************************/\n"
+	"The capture, memory, timer and storage modules keep counters of what they do,\n"
+	"like the number of packets seen, the packets the kernel dropped and how long\n"
+	"the storage took. When the configuration file has a line like:\n"
+	"  stats_listen=/run/lightcount.sock (a unix socket), or\n"
+	"  stats_listen=127.0.0.1:9120 (a TCP socket)\n"
+	"they are served in the Prometheus text format over HTTP on that address. Try\n"
+	"curl --unix-socket /run/lightcount.sock http://localhost/metrics\n"
+	"\n"
+    );
+}
+
+int stats_open(char const *config_file) {
+    if (stats__read_config(config_file) != 0 || stats__listen[0] == '\0')
+	return 0; /* no config, no statistics server */
+
+    if ((stats__socket = stats__open_socket()) < 0)
+	return -1;
+    stats__done = 0;
+    if (pthread_create(&stats__thread, NULL, &stats__run, NULL) != 0) {
+	perror("pthread_create");
+	close(stats__socket);
+	stats__socket = -1;
+	return -1;
+    }
+#ifndef NDEBUG
+    fprintf(stderr, "stats_open: Serving statistics on %s.\n", stats__listen);
+#endif
+    return 0;
+}
+
+void stats_close() {
+    if (stats__socket < 0)
+	return;
+    stats__done = 1;
+    if (pthread_join(stats__thread, NULL) != 0)
+	perror("pthread_join");
+    close(stats__socket);
+    stats__socket = -1;
+    if (stats__listen[0] == '/')
+	unlink(stats__listen);
+}
+
+void stats_add(enum stats_counter counter, uint64_t value) {
+    __sync_add_and_fetch(&stats__values[counter], value);
+}
+
+void stats_set(enum stats_counter counter, uint64_t value) {
+    __sync_lock_test_and_set(&stats__values[counter], value); /* a plain store may tear on 32-bit targets */
+}
+
+static int stats__read_config(char const *config_file) {
+    FILE *fp;
+    char buf[BUFSIZE];
+
+    stats__listen[0] = '\0';
+    if ((fp = fopen(config_file, "r")) == NULL)
+	return -1;
+    while (fgets(buf, BUFSIZE, fp) != NULL) {
+	if (strncmp(buf, "stats_listen=", 13) == 0) {
+	    char *p;
+	    strncpy(stats__listen, buf + 13, sizeof(stats__listen) - 1);
+	    stats__listen[sizeof(stats__listen) - 1] = '\0';
+	    for (p = stats__listen + strlen(stats__listen); p > stats__listen && p[-1] <= ' '; --p)
+		p[-1] = '\0';
+	}
+    }
+    fclose(fp);
+    return 0;
+}
+
+/* Listens on a unix socket if the address is a path, on HOST:PORT otherwise */
+static int stats__open_socket() {
+    int listen_socket;
+
+    if (stats__listen[0] == '/') {
+	struct sockaddr_un saddr_un;
+	memset(&saddr_un, 0, sizeof(struct sockaddr_un));
+	saddr_un.sun_family = AF_UNIX;
+	if (strlen(stats__listen) >= sizeof(saddr_un.sun_path)) {
+	    fprintf(stderr, "stats__open_socket: Unix socket path '%s' is too long.\n", stats__listen);
+	    return -1;
+	}
+	strcpy(saddr_un.sun_path, stats__listen);
+	if ((listen_socket = socket(AF_UNIX, SOCK_STREAM, 0)) < 0) {
+	    perror("socket");
+	    return -1;
+	}
+	unlink(stats__listen); /* left behind by an earlier run */
+	if (bind(listen_socket, (struct sockaddr*)&saddr_un, sizeof(struct sockaddr_un)) != 0) {
+	    perror("bind");
+	    close(listen_socket);
+	    return -1;
+	}
+    } else {
+	struct sockaddr_in saddr_in;
+	char *colon = strrchr(stats__listen, ':');
+	int one = 1;
+	memset(&saddr_in, 0, sizeof(struct sockaddr_in));
+	saddr_in.sin_family = AF_INET;
+	if (colon == NULL || atoi(colon + 1) <= 0 || atoi(colon + 1) > 65535) {
+	    fprintf(stderr, "stats__open_socket: Expected a /path or HOST:PORT to listen on, got '%s'.\n",
+		    stats__listen);
+	    return -1;
+	}
+	*colon = '\0';
+	saddr_in.sin_port = htons(atoi(colon + 1));
+	saddr_in.sin_addr.s_addr = inet_addr(stats__listen);
+	*colon = ':';
+	if (saddr_in.sin_addr.s_addr == INADDR_NONE) {
+	    fprintf(stderr, "stats__open_socket: Expected an IPv4 address in '%s'.\n", stats__listen);
+	    return -1;
+	}
+	if ((listen_socket = socket(AF_INET, SOCK_STREAM, 0)) < 0) {
+	    perror("socket");
+	    return -1;
+	}
+	setsockopt(listen_socket, SOL_SOCKET, SO_REUSEADDR, &one, sizeof(one));
+	if (bind(listen_socket, (struct sockaddr*)&saddr_in, sizeof(struct sockaddr_in)) != 0) {
+	    perror("bind");
+	    close(listen_socket);
+	    return -1;
+	}
+    }
+
+    if (listen(listen_socket, 8) != 0) {
+	perror("listen");
+	close(listen_socket);
+	return -1;
+    }
+    return listen_socket;
+}
+
+static void *stats__run(void *thread_arg) {
+    struct pollfd pfd;
+
+    pfd.fd = stats__socket;
+    pfd.events = POLLIN;
+    while (!stats__done) {
+	int client;
+	if (poll(&pfd, 1, ACCEPT_TIMEOUT_MS) <= 0)
+	    continue;
+	if ((client = accept(stats__socket, NULL, NULL)) < 0) {
+	    if (errno != EINTR && errno != EAGAIN)
+		perror("accept");
+	    continue;
+	}
+	stats__serve(client);
+	close(client);
+    }
+    return 0;
+}
+
+/* Answers any request with the counters, so curl and Prometheus (which speak
+ * HTTP) are as happy as a plain `nc` */
+static void stats__serve(int client) {
+    struct pollfd pfd;
+    char header[128];
+    char buf[BUFSIZE];
+    size_t len = 0;
+    int header_len, i;
+
+    /* Read (the start of) the request, if the client sends one */
+    pfd.fd = client;
+    pfd.events = POLLIN;
+    if (poll(&pfd, 1, ACCEPT_TIMEOUT_MS) > 0 && recv(client, buf, sizeof(buf), 0) < 0)
+	return;
+
+    for (i = 0; i < STATS__COUNT; ++i) {
+	struct stats__info const *info = &stats__infos[i];
+	uint64_t value = __sync_add_and_fetch(&stats__values[i], 0); /* read it in one piece */
+	int ret;
+	ret = snprintf(buf + len, sizeof(buf) - len, "# HELP %s %s\n# TYPE %s %s\n",
+		info->name, info->help, info->name, info->type);
+	if (ret >= 0 && (size_t)ret < sizeof(buf) - len) {
+	    len += ret;
+	    if (info->scale == 1)
+		ret = snprintf(buf + len, sizeof(buf) - len, "%s %" SCNu64 "\n", info->name, value);
+	    else
+		ret = snprintf(buf + len, sizeof(buf) - len, "%s %.6f\n", info->name, value / info->scale);
+	}
+	if (ret < 0 || (size_t)ret >= sizeof(buf) - len) {
+	    fprintf(stderr, "stats__serve: Counters don't fit in %u bytes.\n", (unsigned)BUFSIZE);
+	    return;
+	}
+	len += ret;
+    }
+
+    header_len = snprintf(header, sizeof(header),
+	    "HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %u\r\n\r\n",
+	    (unsigned)len);
+    if (send(client, header, header_len, MSG_NOSIGNAL) != header_len
+	    || send(client, buf, len, MSG_NOSIGNAL) != (ssize_t)len)
+	perror("send");
+}
@@ -42,9 +42,9 @@ void storage_close() {
     printf("Finishing storage!\n");
 }
 
-void storage_write(uint32_t unixtime_begin, uint32_t interval, void *memory) {
-    printf("Storage output: unixtime_begin=%" SCNu32 ", interval=%" SCNu32 ", memory=%p\n",
-	    unixtime_begin, interval, memory);
+void storage_write(uint32_t unixtime_begin, uint32_t interval, uint32_t slots, void *memory) {
+    printf("Storage output: unixtime_begin=%" SCNu32 ", interval=%" SCNu32 ", slots=%" SCNu32 ", memory=%p\n",
+	    unixtime_begin, interval, slots, memory);
     memory_enum(memory, &storage__write_ip);
 }
 
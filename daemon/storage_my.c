@@ -19,42 +19,122 @@ along with LightCount.  If not, see <http://www.gnu.org/licenses/>.
 
 #include "lightcount.h"
 #include <mysql/mysql.h>
+#include <sys/time.h>
 #include <assert.h>
+#include <dirent.h>
+#include <errno.h>
+#include <pthread.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <time.h>
+#include <unistd.h>
 
 /* Settings */
 #define DONT_STORE_ZERO_ENTRIES 1	    /* delete all entries with all values zero */
 #define USE_DAEMON_IP_FILTER 1		    /* filter IP addresses daemon-side */
+#define USE_KERNEL_IP_FILTER 1		    /* let the kernel drop the packets of other IPs */
 #define USE_PREPARED_STATEMENTS 1	    /* use MySQL prepared statements */
+#define USE_MULTIROW_INSERTS 1		    /* insert many rows per statement (in a transaction) */
 #define BUFSIZE 2048			    /* all sprintfs below are calculated to fit in this */
+#define ROW_BUFSIZE 128			    /* a row of a multirow insert fits in this */
+#define DEFAULT_BATCH_ROWS 1000		    /* rows per multirow insert, unless configured */
+#define SPOOL_RETRY_MIN_SECONDS 10	    /* first retry after a failed upload */
+#define SPOOL_RETRY_MAX_SECONDS 600	    /* double the wait up to this */
+
+#if defined(USE_MULTIROW_INSERTS) && !defined(USE_DAEMON_IP_FILTER)
+#   error USE_MULTIROW_INSERTS requires USE_DAEMON_IP_FILTER
+#endif
+#if defined(USE_KERNEL_IP_FILTER) && !defined(USE_DAEMON_IP_FILTER)
+#   error USE_KERNEL_IP_FILTER requires USE_DAEMON_IP_FILTER
+#endif
+
+/* Static constants */
+#define STORAGE__ON_DUPLICATE \
+    " ON DUPLICATE KEY UPDATE in_pps=VALUES(in_pps),in_bps=VALUES(in_bps)," \
+    "out_pps=VALUES(out_pps),out_bps=VALUES(out_bps)" /* replays replace the rows */
+#define STORAGE__SPOOL_MAGIC "LCSPOOL1"
+#define STORAGE__SPOOL_RECORDS 1024	    /* records read at once */
+
+
+/* Spool segment file layout: a header followed by `count` records, in host
+ * byte order. The counts are raw, so the upload is the same as a direct
+ * write of the memory. */
+struct storage__spool_header {
+    char magic[8];			    /* STORAGE__SPOOL_MAGIC */
+    uint32_t unixtime_begin;
+    uint32_t interval;
+    uint32_t count;			    /* number of records */
+    uint32_t slots;			    /* see storage_write (0 in old segments, read as 1) */
+    char node_name[256];		    /* safe node name of the writer */
+};
+struct storage__spool_record {
+    uint32_t ip;
+    uint16_t vlan;
+    uint16_t reserved;
+    uint32_t packets_in;
+    uint32_t packets_out;
+    uint64_t bytes_in;
+    uint64_t bytes_out;
+};
 
 
 static char const *storage__config_file;    /* configuration file name */
 static MYSQL *storage__mysql;		    /* gets reinitialized every write */
 static int storage__node_id;		    /* may vary per write */
 static uint32_t storage__unixtime_begin;    /* varies per write */
-static uint32_t storage__interval;	    /* may vary per write */
+static uint32_t storage__slot_interval;	    /* may vary per write */
+static uint32_t storage__slots;		    /* samples to store the average in */
+static uint32_t storage__interval;	    /* the counted time, slot interval times slots */
 static uint32_t storage__intervald2;	    /* interval divided by two */
+static unsigned long storage__stat_rows;    /* rows written in this write */
+static unsigned long storage__stat_queries; /* statements executed in this write */
+static unsigned long storage__stat_ips;	    /* ips enumerated in this write */
+static double storage__stat_time_begin;	    /* when this write started */
+static double storage__stat_time_insert;    /* when this write started inserting */
+
+static char storage__spool_dir[256];	    /* spool directory, if any (read at open) */
+static FILE *storage__spool_fp;		    /* segment that is being written */
+static uint32_t storage__spool_count;	    /* records in that segment */
+static pthread_t storage__spool_thread;	    /* the uploader */
+static pthread_mutex_t storage__spool_mutex = PTHREAD_MUTEX_INITIALIZER;
+static pthread_mutex_t storage__db_mutex = PTHREAD_MUTEX_INITIALIZER; /* the uploader or a direct write */
+static pthread_cond_t storage__spool_cond = PTHREAD_COND_INITIALIZER;
+static int storage__spool_pending;	    /* segments written since the last upload */
+static int storage__spool_done;		    /* whether the uploader must stop */
 
 #ifdef USE_DAEMON_IP_FILTER
 static uint32_t *storage__ipfilter_rbegin;  /* ip ranges to filter [from, to, from, to, ...] */
 static uint32_t *storage__ipfilter_rend;    /* end of ip ranges to filter */
+static size_t storage__ipfilter_count;	    /* number of (coalesced) ip ranges */
 #endif /* !USE_DAEMON_IP_FILTER */
 
-#ifdef USE_PREPARED_STATEMENTS
+#ifdef USE_KERNEL_IP_FILTER
+static uint32_t *storage__kfilter_ranges;   /* ip ranges passed to sniff_ipfilter */
+static size_t storage__kfilter_count;	    /* number of ip ranges passed */
+#endif /* USE_KERNEL_IP_FILTER */
+
+#if defined(USE_PREPARED_STATEMENTS) && !defined(USE_MULTIROW_INSERTS)
 static MYSQL_STMT *storage__mysqlps;	    /* prepared statement handle */
-static MYSQL_BIND storage__mysqlbind[8];    /* prepared statement bind handles */
+static MYSQL_BIND storage__mysqlbind[9];    /* prepared statement bind handles */
+static uint32_t storage__mysqldataunixtime; /* prepared statement data container for unixtime */
 static uint32_t storage__mysqldataip;	    /* prepared statement data container for ip */
 static struct ipcount_t storage__mysqldata; /* prepared statement data container for rest */
-#endif /* USE_PREPARED_STATEMENTS */
+#endif /* USE_PREPARED_STATEMENTS && !USE_MULTIROW_INSERTS */
+
+#ifdef USE_MULTIROW_INSERTS
+static char *storage__batch;		    /* the multirow insert being built */
+static char *storage__batch_end;	    /* end of the statement built so far */
+static unsigned storage__batch_rows;	    /* number of rows in the statement */
+#endif /* USE_MULTIROW_INSERTS */
 
 static char storage__conf_host[256];	    /* db hostname/ip */
 static int storage__conf_port;		    /* db port */
 static char storage__conf_user[256];	    /* db username */
 static char storage__conf_pass[256];	    /* db password */
 static char storage__conf_dbase[256];	    /* db database */
+static unsigned storage__conf_batch_rows;   /* rows per multirow insert */
+static char storage__conf_spool_dir[256];   /* spool directory, empty for none */
 
 
 static int storage__db_connect();
@@ -63,6 +143,17 @@ static int storage__db_get_node_id(char const *safe_node_name);
 static int storage__read_config(char const *config_file);
 static void storage__rtrim(char *io);
 static void storage__write_ip(uint32_t ip, struct ipcount_t const *ipcount);
+static double storage__now();
+static int storage__db_write_begin(uint32_t unixtime_begin, uint32_t interval, uint32_t slots,
+	char const *safe_node_name);
+static int storage__db_write_end();
+static void storage__db_write_abort();
+
+static int storage__spool_write(uint32_t unixtime_begin, uint32_t interval, uint32_t slots, void *memory);
+static void storage__spool_write_ip(uint32_t ip, struct ipcount_t const *ipcount);
+static void *storage__spool_run(void *thread_arg);
+static int storage__spool_upload_all();
+static int storage__spool_upload(char const *filename);
 
 #ifdef USE_DAEMON_IP_FILTER
 static int storage__ipfilter_begin();
@@ -70,17 +161,29 @@ static void storage__ipfilter_end();
 static int storage__ipfilter_in_range(uint32_t ip);
 #endif /* USE_DAEMON_IP_FILTER */
 
-#ifndef USE_PREPARED_STATEMENTS
+#ifdef USE_KERNEL_IP_FILTER
+static void storage__kfilter_update();
+#endif /* USE_KERNEL_IP_FILTER */
+
+#if !defined(USE_PREPARED_STATEMENTS) && !defined(USE_MULTIROW_INSERTS)
 static void storage__write_record_sql(uint32_t unixtime, int node_id, uint16_t vlan, uint32_t ip,
         uint32_t in_pps, uint64_t in_bps, uint32_t out_pps, uint64_t out_bps);
-#endif /* !USE_PREPARED_STATEMENTS */
+#endif /* !USE_PREPARED_STATEMENTS && !USE_MULTIROW_INSERTS */
 
-#ifdef USE_PREPARED_STATEMENTS
+#ifdef USE_MULTIROW_INSERTS
+static int storage__db_batch_begin();
+static int storage__db_batch_end();
+static void storage__db_batch_flush();
+static void storage__write_record_batch(uint32_t unixtime, uint16_t vlan, uint32_t ip,
+        uint32_t in_pps, uint64_t in_bps, uint32_t out_pps, uint64_t out_bps);
+#endif /* USE_MULTIROW_INSERTS */
+
+#if defined(USE_PREPARED_STATEMENTS) && !defined(USE_MULTIROW_INSERTS)
 static int storage__db_prepstmt_begin();
 static void storage__db_prepstmt_end();
-static void storage__write_record_prepstmt(uint16_t vlan, uint32_t ip,
+static void storage__write_record_prepstmt(uint32_t unixtime, uint16_t vlan, uint32_t ip,
         uint32_t in_pps, uint64_t in_bps, uint32_t out_pps, uint64_t out_bps);
-#endif /* USE_PREPARED_STATEMENTS */
+#endif /* USE_PREPARED_STATEMENTS && !USE_MULTIROW_INSERTS */
 
 
 
@@ -89,7 +192,9 @@ void storage_help() {
 	"/********************* module: storage (mysql) ********************************/\n"
 	"#%s DONT_STORE_ZERO_ENTRIES\n"
 	"#%s USE_DAEMON_IP_FILTER\n"
+	"#%s USE_KERNEL_IP_FILTER\n"
 	"#%s USE_PREPARED_STATEMENTS\n"
+	"#%s USE_MULTIROW_INSERTS\n"
 	"\n"
 	"Stores average values in the MySQL database as specified in the supplied\n"
 	"configuration file. This file gets reloaded on every write, so you can switch\n"
@@ -101,6 +206,8 @@ void storage_help() {
 	"  storage_user=USERNAME\n"
 	"  storage_pass=PASSWORD\n"
 	"  storage_dbase=DATABASE\n"
+	"  storage_batch_rows=ROWS (optional, defaults to %u)\n"
+	"  storage_spool_dir=DIRECTORY (optional)\n"
 	"\n"
 	"Only counts for IP addresses that are listed in the `ip_range_tbl` table are\n"
 	"stored. Those ranges can be specified on a `node_id` basis if desired. See\n"
@@ -113,13 +220,37 @@ void storage_help() {
 	"\n"
 	"Define or undefine USE_DAEMON_IP_FILTER to select whether you want to do the\n"
 	"filtering of the IP addresses in ip_range_tbl by the daemon or by the SQL\n"
-	"server respectively. Filtering by SQL is probably only better if you have\n"
-	"really many or very large IP ranges (covering 10+ percent of the entire IP\n"
-	"space).\n"
+	"server respectively. The daemon merges the ranges and binary searches them,\n"
+	"so it copes with many thousands of ranges (see `make bench`).\n"
+	"\n"
+	"With USE_KERNEL_IP_FILTER (requires USE_DAEMON_IP_FILTER) the ranges are\n"
+	"passed to the sniff module as well, which compiles them into a socket filter.\n"
+	"The packets of other IPs are then dropped by the kernel, which saves a lot of\n"
+	"work on mirror ports that mostly see transit traffic. The filter is rebuilt\n"
+	"when the ranges have changed after a write, so new ranges are counted from\n"
+	"the next interval on.\n"
 	"\n"
 	"You can define or undefine USE_PREPARED_STATEMENTS to enable/disable use of\n"
 	"MySQL prepared statements. Using them is recommended as it reduces the amount of\n"
 	"traffic sent to the server and the server only has to parse the query once.\n"
+	"\n"
+	"Define USE_MULTIROW_INSERTS to insert storage_batch_rows rows per INSERT\n"
+	"statement, all in a single transaction. This saves a round trip per IP, which\n"
+	"adds up on a slow link to the database. It overrides USE_PREPARED_STATEMENTS\n"
+	"and requires USE_DAEMON_IP_FILTER.\n"
+	"\n"
+	"After every write the number of rows and the time it took are printed (unless\n"
+	"built with NDEBUG, the statistics hold them as well).\n"
+	"\n"
+	"When storage_spool_dir is set (it is read at startup only), every interval is\n"
+	"written to a segment file in that directory instead. An uploader thread moves\n"
+	"the segments to the database, oldest first. When that fails it retries after\n"
+	"%u seconds, doubling the wait up to %u seconds. Segments left behind by an\n"
+	"earlier run are uploaded at startup. Rows that were stored already are\n"
+	"replaced, so a replay causes no duplicate key errors. When a segment can't be\n"
+	"written (a full disk), the interval is written to the database directly. A\n"
+	"truncated segment is not stored at all but renamed to .bad, like any other\n"
+	"broken segment. Both count as storage failures.\n"
 	"\n",
 #ifdef DONT_STORE_ZERO_ENTRIES
 	"define",
@@ -131,11 +262,23 @@ void storage_help() {
 #else /* !USE_DAEMON_IP_FILTER */
 	"undef",
 #endif /* !USE_DAEMON_IP_FILTER */
+#ifdef USE_KERNEL_IP_FILTER
+	"define",
+#else /* !USE_KERNEL_IP_FILTER */
+	"undef",
+#endif /* !USE_KERNEL_IP_FILTER */
 #ifdef USE_PREPARED_STATEMENTS
-	"define"
+	"define",
 #else /* !USE_PREPARED_STATEMENTS */
-	"undef"
+	"undef",
 #endif /* !USE_PREPARED_STATEMENTS */
+#ifdef USE_MULTIROW_INSERTS
+	"define",
+#else /* !USE_MULTIROW_INSERTS */
+	"undef",
+#endif /* !USE_MULTIROW_INSERTS */
+	(unsigned)DEFAULT_BATCH_ROWS,
+	(unsigned)SPOOL_RETRY_MIN_SECONDS, (unsigned)SPOOL_RETRY_MAX_SECONDS
     );
 }
 
@@ -151,55 +294,145 @@ int storage_open(char const *config_file) {
 	fprintf(stderr, "mysql_library_init: Failed to initialize.\n");
 	return -1;
     }
+    /* Start the uploader, it uploads the segments of an earlier run first */
+    strcpy(storage__spool_dir, storage__conf_spool_dir);
+    if (storage__spool_dir[0] != '\0') {
+	storage__spool_pending = 1;
+	storage__spool_done = 0;
+	if (pthread_create(&storage__spool_thread, NULL, &storage__spool_run, NULL) != 0) {
+	    perror("pthread_create");
+	    mysql_library_end();
+	    return -1;
+	}
+    }
     return 0;
 }
 
 void storage_close() {
+    /* Stop the uploader, the segments it didn't get to stay for the next run */
+    if (storage__spool_dir[0] != '\0') {
+	pthread_mutex_lock(&storage__spool_mutex);
+	storage__spool_done = 1;
+	pthread_cond_signal(&storage__spool_cond);
+	pthread_mutex_unlock(&storage__spool_mutex);
+	if (pthread_join(storage__spool_thread, NULL) != 0)
+	    perror("pthread_join");
+    }
+#ifdef USE_KERNEL_IP_FILTER
+    free(storage__kfilter_ranges);
+#endif /* USE_KERNEL_IP_FILTER */
     /* Finish mysql lib */
     mysql_library_end();
 }
 
-void storage_write(uint32_t unixtime_begin, uint32_t interval, void *memory) {
+void storage_write(uint32_t unixtime_begin, uint32_t interval, uint32_t slots, void *memory) {
     char buf[BUFSIZE];
 
+    /* Leave the database to the uploader */
+    if (storage__spool_dir[0] != '\0') {
+	if (storage__spool_write(unixtime_begin, interval, slots, memory) == 0)
+	    return;
+	/* The spool is full or unwritable, try the database before dropping them */
+	stats_add(STATS_STORAGE_FAILURES, 1);
+	fprintf(stderr, "storage_write: Could not spool %" SCNu32 ", writing it to the database.\n", unixtime_begin);
+    }
+
+    util_get_safe_node_name(buf, 256); /* 256 < BUFSIZE */
+    pthread_mutex_lock(&storage__db_mutex);
+    if (storage__db_write_begin(unixtime_begin, interval, slots, buf) != 0) {
+	pthread_mutex_unlock(&storage__db_mutex);
+	stats_add(STATS_STORAGE_FAILURES, 1);
+	if (storage__spool_dir[0] != '\0')
+	    fprintf(stderr, "storage_write: Dropping the counts of %" SCNu32 ".\n", unixtime_begin);
+	return;
+    }
+    memory_enum(memory, &storage__write_ip);
+    stats_set(STATS_STORAGE_IPS, storage__stat_ips);
+    storage__db_write_end();
+    pthread_mutex_unlock(&storage__db_mutex);
+}
+
+/* Connects and prepares for `storage__write_ip` calls. Returns non-zero on
+ * failure, in which case we're disconnected again. */
+static int storage__db_write_begin(uint32_t unixtime_begin, uint32_t interval, uint32_t slots,
+	char const *safe_node_name) {
+    storage__stat_time_begin = storage__now();
+
     /* Connect to database */
     if (storage__db_connect() != 0)
-	return;
+	return -1;
 
     /* Store values to use when running `memory_enum`. */
     storage__unixtime_begin = unixtime_begin;
-    storage__interval = interval;
-    storage__intervald2 = interval >> 1;
-    util_get_safe_node_name(buf, 256); /* 256 < BUFSIZE */
-    storage__node_id = storage__db_get_node_id(buf);
+    storage__slot_interval = interval;
+    storage__slots = slots;
+    storage__interval = interval * slots;
+    storage__intervald2 = storage__interval >> 1;
+    storage__node_id = storage__db_get_node_id(safe_node_name);
     if (storage__node_id == -1) {
 	storage__db_disconnect();
-	return;
+	return -1;
     }
 
 #ifdef USE_DAEMON_IP_FILTER
     /* Get IP addresses to filter */
     if (storage__ipfilter_begin() != 0) {
 	storage__db_disconnect();
-	return;
+	return -1;
     }
 #endif /* USE_DAEMON_IP_FILTER */
 
-#ifdef USE_PREPARED_STATEMENTS
+#if defined(USE_MULTIROW_INSERTS)
+    /* Start the transaction */
+    if (storage__db_batch_begin() != 0) {
+	storage__ipfilter_end();
+	storage__db_disconnect();
+	return -1;
+    }
+#elif defined(USE_PREPARED_STATEMENTS)
     /* Prepare MyMSQL prepared statement */
     if (storage__db_prepstmt_begin() != 0) {
+#   ifdef USE_DAEMON_IP_FILTER
+	storage__ipfilter_end();
+#   endif /* USE_DAEMON_IP_FILTER */
 	storage__db_disconnect();
-	return;
+	return -1;
     }
 #endif /* USE_PREPARED_STATEMENTS */
-    
-    /* Finally! Insert data! */
-    memory_enum(memory, &storage__write_ip);
 
-#ifdef USE_PREPARED_STATEMENTS
-    /* Free MyMSQL prepared statement */
+    /* Finally! Insert data! (By the caller.) */
+    storage__stat_rows = storage__stat_queries = storage__stat_ips = 0;
+    storage__stat_time_insert = storage__now();
+    return 0;
+}
+
+/* Finishes the inserts and disconnects. Returns non-zero if not all rows
+ * were stored. */
+static int storage__db_write_end() {
+    int ret;
+
+#if defined(USE_MULTIROW_INSERTS)
+    /* Insert the last rows and commit */
+    ret = storage__db_batch_end();
+#elif defined(USE_PREPARED_STATEMENTS)
+    /* Free MyMSQL prepared statement (it is gone after a failure) */
+    ret = (storage__mysqlps == NULL ? -1 : 0);
     storage__db_prepstmt_end();
-#endif /* USE_PREPARED_STATEMENTS */
+#else /* !USE_PREPARED_STATEMENTS */
+    /* The connection is gone after a failure */
+    ret = (storage__mysql == NULL ? -1 : 0);
+#endif /* !USE_PREPARED_STATEMENTS */
+
+#ifndef NDEBUG
+    fprintf(stderr, "storage_write: Wrote %lu rows in %lu statements in %.3f seconds "
+	    "(%.3f seconds before inserting).\n",
+	    storage__stat_rows, storage__stat_queries,
+	    storage__now() - storage__stat_time_begin,
+	    storage__stat_time_insert - storage__stat_time_begin);
+#endif
+    stats_add(STATS_STORAGE_ROWS, storage__stat_rows);
+    if (ret != 0)
+	stats_add(STATS_STORAGE_FAILURES, 1);
 
 #ifdef USE_DAEMON_IP_FILTER
     /* Free IP filter memory */
@@ -208,6 +441,20 @@ void storage_write(uint32_t unixtime_begin, uint32_t interval, void *memory) {
 
     /* Disconnect */
     storage__db_disconnect();
+    return ret;
+}
+
+/* Makes the write fail, so `storage__db_write_end` rolls back what it can
+ * (all of it with USE_MULTIROW_INSERTS) and returns non-zero. */
+static void storage__db_write_abort() {
+#if defined(USE_MULTIROW_INSERTS)
+    free(storage__batch);
+    storage__batch = NULL;
+#elif defined(USE_PREPARED_STATEMENTS)
+    storage__db_prepstmt_end();
+#else /* !USE_PREPARED_STATEMENTS */
+    storage__db_disconnect();
+#endif /* !USE_PREPARED_STATEMENTS */
 }
 
 static int storage__db_connect() {
@@ -285,6 +532,9 @@ static int storage__read_config(char const *config_file) {
     strncpy(storage__conf_pass, "", sizeof(storage__conf_pass) - 1);
     storage__conf_dbase[sizeof(storage__conf_dbase)-1] = '\0';
     strncpy(storage__conf_dbase, "", sizeof(storage__conf_dbase) - 1);
+    storage__conf_batch_rows = DEFAULT_BATCH_ROWS;
+    storage__conf_spool_dir[sizeof(storage__conf_spool_dir)-1] = '\0';
+    strncpy(storage__conf_spool_dir, "", sizeof(storage__conf_spool_dir) - 1);
 
     /* Open file to find user values */
     if ((fp = fopen(config_file, "r")) == NULL) {
@@ -306,9 +556,12 @@ static int storage__read_config(char const *config_file) {
 	    check(buf, "storage_user=", storage__conf_user)
 	    check(buf, "storage_pass=", storage__conf_pass)
 	    check(buf, "storage_dbase=", storage__conf_dbase)
+	    check(buf, "storage_spool_dir=", storage__conf_spool_dir)
 #undef check
 	    if (strncmp(buf, "storage_port=", 13) == 0)
 		storage__conf_port = atoi(buf + 13);
+	    else if (strncmp(buf, "storage_batch_rows=", 19) == 0 && atoi(buf + 19) > 0)
+		storage__conf_batch_rows = (unsigned)atoi(buf + 19);
 	}
     }
     fclose(fp);
@@ -321,6 +574,12 @@ static int storage__read_config(char const *config_file) {
     return 0;
 }
 
+static double storage__now() {
+    struct timeval tv;
+    gettimeofday(&tv, NULL);
+    return tv.tv_sec + tv.tv_usec / 1000000.0;
+}
+
 static void storage__rtrim(char *io) {
     char *p = io + strlen(io);
     while (--p && p >= io && *p <= ' ')
@@ -332,7 +591,9 @@ static void storage__write_ip(uint32_t ip, struct ipcount_t const *ipcount) {
     uint64_t rnd_bytes_in = (ipcount->u.bytes_in + storage__intervald2) / storage__interval;
     uint32_t rnd_packets_out = (ipcount->packets_out + storage__intervald2) / storage__interval;
     uint64_t rnd_bytes_out = (ipcount->bytes_out + storage__intervald2) / storage__interval;
+    uint32_t slot;
 
+    ++storage__stat_ips;
 #ifdef DONT_STORE_ZERO_ENTRIES
     if (rnd_packets_in != 0 || rnd_bytes_in != 0 || rnd_packets_out != 0 || rnd_bytes_out != 0)
 #endif /* DONT_STORE_ZERO_ENTRIES */
@@ -340,12 +601,17 @@ static void storage__write_ip(uint32_t ip, struct ipcount_t const *ipcount) {
 #   ifdef USE_DAEMON_IP_FILTER 
 	if (storage__ipfilter_in_range(ip) != 0)
 #   endif /* !USE_DAEMON_IP_FILTER */
-	{
-#       ifdef USE_PREPARED_STATEMENTS
-	    storage__write_record_prepstmt(ipcount->vlan, ip,
+	/* The same average for every sample of a merged interval */
+	for (slot = 0; slot < storage__slots; ++slot) {
+	    uint32_t unixtime = storage__unixtime_begin + slot * storage__slot_interval;
+#       if defined(USE_MULTIROW_INSERTS)
+	    storage__write_record_batch(unixtime, ipcount->vlan, ip,
+		    rnd_packets_in, rnd_bytes_in, rnd_packets_out, rnd_bytes_out);
+#       elif defined(USE_PREPARED_STATEMENTS)
+	    storage__write_record_prepstmt(unixtime, ipcount->vlan, ip,
 		    rnd_packets_in, rnd_bytes_in, rnd_packets_out, rnd_bytes_out);
 #       else /* !USE_PREPARED_STATEMENTS */
-	    storage__write_record_sql(storage__unixtime_begin, storage__node_id, ipcount->vlan, ip,
+	    storage__write_record_sql(unixtime, storage__node_id, ipcount->vlan, ip,
 		    rnd_packets_in, rnd_bytes_in, rnd_packets_out, rnd_bytes_out);
         #endif
 	}
@@ -353,6 +619,214 @@ static void storage__write_ip(uint32_t ip, struct ipcount_t const *ipcount) {
 }
 
 
+/* Writes a segment for the uploader. Returns non-zero if it couldn't. */
+static int storage__spool_write(uint32_t unixtime_begin, uint32_t interval, uint32_t slots, void *memory) {
+    char filename[BUFSIZE], tmp_filename[BUFSIZE];
+    struct storage__spool_header header;
+
+    sprintf(filename, "%s/%010" SCNu32 ".spool", storage__spool_dir, unixtime_begin);
+    sprintf(tmp_filename, "%s/%010" SCNu32 ".spool.tmp", storage__spool_dir, unixtime_begin);
+
+    memset(&header, 0, sizeof(header));
+    memcpy(header.magic, STORAGE__SPOOL_MAGIC, sizeof(header.magic));
+    header.unixtime_begin = unixtime_begin;
+    header.interval = interval;
+    header.slots = slots;
+    util_get_safe_node_name(header.node_name, sizeof(header.node_name));
+
+    /* Write the segment under a temporary name, the uploader only sees
+     * complete segments */
+    if ((storage__spool_fp = fopen(tmp_filename, "wb")) == NULL) {
+	perror("fopen");
+	return -1;
+    }
+    storage__spool_count = 0;
+    if (fwrite(&header, sizeof(header), 1, storage__spool_fp) == 1)
+	memory_enum(memory, &storage__spool_write_ip);
+    header.count = storage__spool_count;
+    if (ferror(storage__spool_fp)
+	    || fseek(storage__spool_fp, 0, SEEK_SET) != 0
+	    || fwrite(&header, sizeof(header), 1, storage__spool_fp) != 1
+	    || fflush(storage__spool_fp) != 0
+	    || fsync(fileno(storage__spool_fp)) != 0) {
+	perror("storage__spool_write");
+	fclose(storage__spool_fp);
+	unlink(tmp_filename);
+	return -1;
+    }
+    fclose(storage__spool_fp);
+    if (rename(tmp_filename, filename) != 0) {
+	perror("rename");
+	unlink(tmp_filename);
+	return -1;
+    }
+    stats_set(STATS_STORAGE_IPS, header.count);
+#ifndef NDEBUG
+    fprintf(stderr, "storage__spool_write: Wrote %" SCNu32 " records to %s.\n", header.count, filename);
+#endif
+
+    /* Poke the uploader */
+    pthread_mutex_lock(&storage__spool_mutex);
+    storage__spool_pending = 1;
+    pthread_cond_signal(&storage__spool_cond);
+    pthread_mutex_unlock(&storage__spool_mutex);
+    return 0;
+}
+
+static void storage__spool_write_ip(uint32_t ip, struct ipcount_t const *ipcount) {
+    struct storage__spool_record record;
+    record.ip = ip;
+    record.vlan = ipcount->vlan;
+    record.reserved = 0;
+    record.packets_in = ipcount->packets_in;
+    record.packets_out = ipcount->packets_out;
+    record.bytes_in = ipcount->u.bytes_in;
+    record.bytes_out = ipcount->bytes_out;
+    if (fwrite(&record, sizeof(record), 1, storage__spool_fp) == 1)
+	++storage__spool_count;
+}
+
+/* The uploader thread. Uploads whenever a segment was written, or retries
+ * with an increasing delay after a failure. */
+static void *storage__spool_run(void *thread_arg) {
+    unsigned retry_seconds = 0;
+
+    mysql_thread_init();
+    pthread_mutex_lock(&storage__spool_mutex);
+    while (!storage__spool_done) {
+	if (retry_seconds == 0) {
+	    /* Wait for a new segment */
+	    while (!storage__spool_done && !storage__spool_pending)
+		pthread_cond_wait(&storage__spool_cond, &storage__spool_mutex);
+	} else {
+	    /* Back off, but do stop when asked */
+	    struct timespec until;
+	    until.tv_sec = time(NULL) + retry_seconds;
+	    until.tv_nsec = 0;
+	    while (!storage__spool_done
+		    && pthread_cond_timedwait(&storage__spool_cond, &storage__spool_mutex, &until) != ETIMEDOUT)
+		continue;
+	}
+	if (storage__spool_done)
+	    break;
+	storage__spool_pending = 0;
+	pthread_mutex_unlock(&storage__spool_mutex);
+
+	if (storage__spool_upload_all() == 0) {
+	    retry_seconds = 0;
+	} else {
+	    retry_seconds = (retry_seconds == 0 ? SPOOL_RETRY_MIN_SECONDS : 2 * retry_seconds);
+	    if (retry_seconds > SPOOL_RETRY_MAX_SECONDS)
+		retry_seconds = SPOOL_RETRY_MAX_SECONDS;
+	    fprintf(stderr, "storage__spool_run: Upload failed, retrying in %u seconds.\n", retry_seconds);
+	}
+
+	pthread_mutex_lock(&storage__spool_mutex);
+    }
+    pthread_mutex_unlock(&storage__spool_mutex);
+    mysql_thread_end();
+    return 0;
+}
+
+static int storage__spool_select(struct dirent const *entry) {
+    size_t len = strlen(entry->d_name);
+    return len > 6 && strcmp(entry->d_name + len - 6, ".spool") == 0;
+}
+
+/* Uploads all segments, oldest first (the names sort by time). Returns
+ * non-zero when an upload failed. */
+static int storage__spool_upload_all() {
+    struct dirent **entries;
+    int count, i, ret = 0;
+
+    if ((count = scandir(storage__spool_dir, &entries, &storage__spool_select, &alphasort)) < 0) {
+	perror("scandir");
+	return -1;
+    }
+    for (i = 0; i < count; ++i) {
+	char filename[BUFSIZE];
+	if (ret == 0 && !storage__spool_done) {
+	    sprintf(filename, "%s/%s", storage__spool_dir, entries[i]->d_name); /* 256 + 256 < BUFSIZE */
+	    ret = storage__spool_upload(filename);
+	}
+	free(entries[i]);
+    }
+    free(entries);
+    return ret;
+}
+
+/* Uploads and removes one segment. Returns non-zero if the database
+ * couldn't take it or the segment is truncated. Broken segments are renamed
+ * and skipped. */
+static int storage__spool_upload(char const *filename) {
+    static struct storage__spool_record records[STORAGE__SPOOL_RECORDS];
+    struct storage__spool_header header;
+    char bad_filename[BUFSIZE];
+    uint32_t todo;
+    FILE *fp;
+    int ret;
+
+    if ((fp = fopen(filename, "rb")) == NULL) {
+	perror("fopen");
+	return -1;
+    }
+    if (fread(&header, sizeof(header), 1, fp) != 1
+	    || memcmp(header.magic, STORAGE__SPOOL_MAGIC, sizeof(header.magic)) != 0) {
+	fprintf(stderr, "storage__spool_upload: %s is not a spool segment, renaming it to .bad.\n", filename);
+	fclose(fp);
+	sprintf(bad_filename, "%s.bad", filename);
+	if (rename(filename, bad_filename) != 0)
+	    perror("rename");
+	return 0;
+    }
+    header.node_name[sizeof(header.node_name) - 1] = '\0';
+
+    pthread_mutex_lock(&storage__db_mutex);
+    if (storage__db_write_begin(header.unixtime_begin, header.interval, header.slots == 0 ? 1 : header.slots,
+	    header.node_name) != 0) {
+	pthread_mutex_unlock(&storage__db_mutex);
+	stats_add(STATS_STORAGE_FAILURES, 1);
+	fclose(fp);
+	return -1;
+    }
+    for (todo = header.count; todo != 0; ) {
+	size_t i, n = fread(records, sizeof(records[0]),
+		todo < STORAGE__SPOOL_RECORDS ? todo : STORAGE__SPOOL_RECORDS, fp);
+	if (n == 0) {
+	    /* Store none of it, the missing records won't come back */
+	    fprintf(stderr, "storage__spool_upload: %s is truncated, renaming it to .bad.\n", filename);
+	    storage__db_write_abort();
+	    break;
+	}
+	for (i = 0; i < n; ++i) {
+	    struct ipcount_t ipcount;
+	    memset(&ipcount, 0, sizeof(ipcount));
+	    ipcount.vlan = records[i].vlan;
+	    ipcount.packets_in = records[i].packets_in;
+	    ipcount.packets_out = records[i].packets_out;
+	    ipcount.u.bytes_in = records[i].bytes_in;
+	    ipcount.bytes_out = records[i].bytes_out;
+	    storage__write_ip(records[i].ip, &ipcount);
+	}
+	todo -= n;
+    }
+    fclose(fp);
+
+    /* Keep the segment if the database didn't take all of it */
+    ret = storage__db_write_end();
+    pthread_mutex_unlock(&storage__db_mutex);
+    if (todo != 0) {
+	sprintf(bad_filename, "%s.bad", filename);
+	if (rename(filename, bad_filename) != 0)
+	    perror("rename");
+	return -1;
+    }
+    if (ret == 0 && unlink(filename) != 0)
+	perror("unlink");
+    return ret;
+}
+
+
 #ifdef USE_DAEMON_IP_FILTER
 static int storage__ipfilter_begin() {
     char buf[BUFSIZE];
@@ -362,7 +836,7 @@ static int storage__ipfilter_begin() {
     int ret;
 
     /* Get an ordered list of the ip ranges.
-     * Order by ip_begin so we can stop the linear search when ip_begin > ip. */
+     * They are coalesced below, ordering by ip_begin saves the sort. */
     sprintf(
 	buf,
 	"SELECT ip_begin, ip_end FROM ip_range_tbl "
@@ -401,6 +875,20 @@ static int storage__ipfilter_begin() {
     ret = (int)mysql_errno(storage__mysql); /* fetch_row returns NULL for both error and eof */
     assert(storage__ipfilter_rend - storage__ipfilter_rbegin == 2 * rows);
 
+    /* Merge overlapping and adjacent ranges so we can binary search them */
+    storage__ipfilter_count = util_ipfilter_coalesce(storage__ipfilter_rbegin, rows);
+    storage__ipfilter_rend = storage__ipfilter_rbegin + 2 * storage__ipfilter_count;
+#ifndef NDEBUG
+    fprintf(stderr, "storage__ipfilter_begin: Coalesced %lu ip ranges into %lu.\n",
+	    rows, (unsigned long)storage__ipfilter_count);
+#endif
+
+#ifdef USE_KERNEL_IP_FILTER
+    /* Tell the sniff module if something changed */
+    if (ret == 0)
+	storage__kfilter_update();
+#endif /* USE_KERNEL_IP_FILTER */
+
     /* Clean up */
     mysql_free_result(res);
     return ret;
@@ -411,20 +899,127 @@ static void storage__ipfilter_end() {
 }
 
 static int storage__ipfilter_in_range(uint32_t ip) {
-    uint32_t *pos;
-    /* Partial optimization by skipping rest of search when ip_begin > ip. */
-    for (pos = storage__ipfilter_rbegin; pos != storage__ipfilter_rend; pos += 2) {
-	if (pos[0] <= ip && ip <= pos[1])
-	    return 1;
-	if (pos[0] > ip)
-	    return 0;
+    return util_ipfilter_in_range(storage__ipfilter_rbegin, storage__ipfilter_count, ip);
+}
+#endif /* USE_DAEMON_IP_FILTER */
+
+
+#ifdef USE_KERNEL_IP_FILTER
+static void storage__kfilter_update() {
+    size_t size = 2 * storage__ipfilter_count * sizeof(uint32_t);
+    uint32_t *ranges;
+
+    /* Compare with the ranges we passed last time (if any) */
+    if (storage__kfilter_ranges != NULL && storage__kfilter_count == storage__ipfilter_count
+	    && memcmp(storage__kfilter_ranges, storage__ipfilter_rbegin, size) == 0)
+	return;
+    if ((ranges = (uint32_t*)realloc(storage__kfilter_ranges, size + 1)) == NULL) {
+	fprintf(stderr, "storage__kfilter_update: realloc failed, keeping the old filter.\n");
+	return;
+    }
+    memcpy(ranges, storage__ipfilter_rbegin, size);
+    storage__kfilter_ranges = ranges;
+    storage__kfilter_count = storage__ipfilter_count;
+
+    fprintf(stderr, "storage__kfilter_update: Passing %lu ip ranges to the socket filter.\n",
+	    (unsigned long)storage__kfilter_count);
+    sniff_ipfilter(storage__kfilter_ranges, storage__kfilter_count);
+}
+#endif /* USE_KERNEL_IP_FILTER */
+
+
+#ifdef USE_MULTIROW_INSERTS
+static int storage__db_batch_begin() {
+    /* One statement holds up to storage__conf_batch_rows rows */
+    if ((storage__batch = (char*)malloc(BUFSIZE + storage__conf_batch_rows * ROW_BUFSIZE)) == NULL) {
+	fprintf(stderr, "malloc failed for multirow insert (tried to get %lu bytes)\n",
+		(unsigned long)BUFSIZE + storage__conf_batch_rows * ROW_BUFSIZE);
+	return -1;
+    }
+    storage__batch_end = storage__batch;
+    storage__batch_rows = 0;
+
+    /* Insert everything in one transaction */
+    if (mysql_autocommit(storage__mysql, 0) != 0) {
+	fprintf(stderr, "mysql_autocommit: %s\n", mysql_error(storage__mysql));
+	free(storage__batch);
+	storage__batch = NULL;
+	return -1;
     }
     return 0;
 }
-#endif /* USE_DAEMON_IP_FILTER */
 
+static int storage__db_batch_end() {
+    int ret = 0;
 
-#ifndef USE_PREPARED_STATEMENTS
+    /* Insert the remaining rows */
+    storage__db_batch_flush();
+
+    /* After a failure, all inserts of this run are rolled back */
+    if (storage__batch == NULL) {
+	if (mysql_rollback(storage__mysql) != 0)
+	    fprintf(stderr, "mysql_rollback: %s\n", mysql_error(storage__mysql));
+	storage__stat_rows = 0;
+	return -1;
+    }
+    if (mysql_commit(storage__mysql) != 0) {
+	fprintf(stderr, "mysql_commit: %s\n", mysql_error(storage__mysql));
+	storage__stat_rows = 0;
+	ret = -1;
+    }
+    free(storage__batch);
+    storage__batch = NULL;
+    return ret;
+}
+
+static void storage__db_batch_flush() {
+    /* After a failure, we won't try again this run */
+    if (storage__batch == NULL || storage__batch_rows == 0)
+	return;
+
+    strcpy(storage__batch_end, STORAGE__ON_DUPLICATE); /* BUFSIZE leaves room for this */
+    storage__batch_end += sizeof(STORAGE__ON_DUPLICATE) - 1;
+    if (mysql_real_query(storage__mysql, storage__batch, storage__batch_end - storage__batch) != 0) {
+	fprintf(stderr, "mysql_real_query: %s\n", mysql_error(storage__mysql));
+	free(storage__batch);
+	storage__batch = NULL;
+	return;
+    }
+#   ifdef PRINT_EVERY_PACKET
+    fprintf(stderr, "storage__db_batch_flush: Data stored for %u IPs\n", storage__batch_rows);
+#   endif /* PRINT_EVERY_PACKET */
+    storage__stat_rows += storage__batch_rows;
+    ++storage__stat_queries;
+    storage__batch_end = storage__batch;
+    storage__batch_rows = 0;
+}
+
+static void storage__write_record_batch(uint32_t unixtime, uint16_t vlan, uint32_t ip,
+        uint32_t in_pps, uint64_t in_bps, uint32_t out_pps, uint64_t out_bps) {
+    /* After a failure, we won't try again this run */
+    if (storage__batch == NULL)
+	return;
+
+    if (storage__batch_rows == 0) {
+	storage__batch_end += sprintf(storage__batch_end,
+	    "INSERT INTO sample_tbl (unixtime,node_id,vlan_id,ip,in_pps,in_bps,out_pps,out_bps) VALUES "
+	    "(%" SCNu32 ",%d,%" SCNu16 ",%" SCNu32 ",%" SCNu32 ",%" SCNu64 ",%" SCNu32 ",%" SCNu64 ")",
+	    unixtime, storage__node_id, vlan, ip, in_pps, in_bps, out_pps, out_bps
+	); /* 90 bytes + ROW_BUFSIZE is way smaller than BUFSIZE */
+    } else {
+	storage__batch_end += sprintf(storage__batch_end,
+	    ",(%" SCNu32 ",%d,%" SCNu16 ",%" SCNu32 ",%" SCNu32 ",%" SCNu64 ",%" SCNu32 ",%" SCNu64 ")",
+	    unixtime, storage__node_id, vlan, ip, in_pps, in_bps, out_pps, out_bps
+	); /* 10 bytes + 2 * 20 + 6 * 10 is smaller than ROW_BUFSIZE */
+    }
+
+    if (++storage__batch_rows == storage__conf_batch_rows)
+	storage__db_batch_flush();
+}
+#endif /* USE_MULTIROW_INSERTS */
+
+
+#if !defined(USE_PREPARED_STATEMENTS) && !defined(USE_MULTIROW_INSERTS)
 static void storage__write_record_sql(uint32_t unixtime, int node_id, uint16_t vlan, uint32_t ip,
         uint32_t in_pps, uint64_t in_bps, uint32_t out_pps, uint64_t out_bps) {
     char buf[BUFSIZE];
@@ -444,26 +1039,28 @@ static void storage__write_record_sql(uint32_t unixtime, int node_id, uint16_t v
 	    "SELECT ip_begin FROM ip_range_tbl "
 	    "WHERE ip_begin <= %" SCNu32 " AND %" SCNu32 " <= ip_end"
 	    " AND (node_id IS NULL OR node_id = %d)"
-	")",
-	storage__unixtime_begin, node_id, vlan, ip, in_pps, in_bps, out_pps, out_bps,
+	")" STORAGE__ON_DUPLICATE,
+	unixtime, node_id, vlan, ip, in_pps, in_bps, out_pps, out_bps,
 	ip, ip, node_id
-    ); /* 240 bytes + 11 args * len("18446744073709551615") way smaller than BUFSIZE */
+    ); /* 360 bytes + 11 args * len("18446744073709551615") way smaller than BUFSIZE */
     if (mysql_query(storage__mysql, buf)) {
 	fprintf(stderr, "mysql_query: %s\n", mysql_error(storage__mysql));
 	storage__db_disconnect();
 	return;
     }
+    storage__stat_rows += mysql_affected_rows(storage__mysql);
+    ++storage__stat_queries;
 #   ifdef PRINT_EVERY_PACKET
     if (mysql_affected_rows(storage__mysql) >= 1) {
-	assert(mysql_affected_rows(storage__mysql) == 1);
+	assert(mysql_affected_rows(storage__mysql) <= 2); /* 2 for a replaced row */
 	fprintf(stderr, "storage__write_ip: %s\n", buf);
     }
 #   endif /* PRINT_EVERY_PACKET */
 }
-#endif /* !USE_PREPARED_STATEMENTS */
+#endif /* !USE_PREPARED_STATEMENTS && !USE_MULTIROW_INSERTS */
 
 
-#ifdef USE_PREPARED_STATEMENTS
+#if defined(USE_PREPARED_STATEMENTS) && !defined(USE_MULTIROW_INSERTS)
 static int storage__db_prepstmt_begin() {
     char buf[BUFSIZE];
 
@@ -476,21 +1073,21 @@ static int storage__db_prepstmt_begin() {
     /* Simple INSERT statement */
     sprintf(buf, 
 	"INSERT INTO sample_tbl (unixtime,node_id,vlan_id,ip,in_pps,in_bps,out_pps,out_bps) "
-	"VALUES (%" SCNu32 ",%d,?,?,?,?,?,?)",
-	storage__unixtime_begin, storage__node_id
+	"VALUES (?,%d,?,?,?,?,?,?)" STORAGE__ON_DUPLICATE,
+	storage__node_id
     );
 #else /* !USE_DAEMON_IP_FILTER */
     /* Include SELECT that checks whether IP is in range */
     sprintf(buf, 
 	"INSERT INTO sample_tbl (unixtime,node_id,vlan_id,ip,in_pps,in_bps,out_pps,out_bps) "
-	"SELECT %" SCNu32 ",%d,?,?,?,?,?,? "
+	"SELECT ?,%d,?,?,?,?,?,? "
 	"FROM DUAL WHERE EXISTS ("
 	    "SELECT ip_begin FROM ip_range_tbl "
 	    "WHERE ip_begin <= ? AND ? <= ip_end"
 	    " AND (node_id IS NULL OR node_id = %d)"
-	")",
-	storage__unixtime_begin, storage__node_id, storage__node_id
-    ); /* 240 bytes + 3 args is way smaller than BUFSIZE */
+	")" STORAGE__ON_DUPLICATE,
+	storage__node_id, storage__node_id
+    ); /* 360 bytes + 3 args is way smaller than BUFSIZE */
 #endif /* !USE_DAEMON_IP_FILTER */
 
     if (mysql_stmt_prepare(storage__mysqlps, buf, strlen(buf)) != 0) {
@@ -500,36 +1097,38 @@ static int storage__db_prepstmt_begin() {
     }
 
 #ifdef USE_DAEMON_IP_FILTER
-    assert(mysql_stmt_param_count(storage__mysqlps) == 6);
+    assert(mysql_stmt_param_count(storage__mysqlps) == 7);
 #else /* !USE_DAEMON_IP_FILTER */
-    assert(mysql_stmt_param_count(storage__mysqlps) == 8);
+    assert(mysql_stmt_param_count(storage__mysqlps) == 9);
 #endif /* !USE_DAEMON_IP_FILTER */
 
     /* Initialize bind values */
     memset(storage__mysqlbind, 0, sizeof(storage__mysqlbind));
-    storage__mysqlbind[0].buffer_type = MYSQL_TYPE_SHORT;
-    storage__mysqlbind[0].buffer = (char*)&storage__mysqldata.vlan;
-    storage__mysqlbind[1].buffer_type = MYSQL_TYPE_LONG; 
-    storage__mysqlbind[1].buffer = (char*)&storage__mysqldataip;
-    storage__mysqlbind[2].buffer_type = MYSQL_TYPE_LONG;
-    storage__mysqlbind[2].buffer = (char*)&storage__mysqldata.packets_in;
-    storage__mysqlbind[3].buffer_type = MYSQL_TYPE_LONGLONG;
-    storage__mysqlbind[3].buffer = (char*)&storage__mysqldata.u.bytes_in;
-    storage__mysqlbind[4].buffer_type = MYSQL_TYPE_LONG;
-    storage__mysqlbind[4].buffer = (char*)&storage__mysqldata.packets_out;
-    storage__mysqlbind[5].buffer_type = MYSQL_TYPE_LONGLONG;
-    storage__mysqlbind[5].buffer = (char*)&storage__mysqldata.bytes_out;
+    storage__mysqlbind[0].buffer_type = MYSQL_TYPE_LONG;
+    storage__mysqlbind[0].buffer = (char*)&storage__mysqldataunixtime;
+    storage__mysqlbind[1].buffer_type = MYSQL_TYPE_SHORT;
+    storage__mysqlbind[1].buffer = (char*)&storage__mysqldata.vlan;
+    storage__mysqlbind[2].buffer_type = MYSQL_TYPE_LONG; 
+    storage__mysqlbind[2].buffer = (char*)&storage__mysqldataip;
+    storage__mysqlbind[3].buffer_type = MYSQL_TYPE_LONG;
+    storage__mysqlbind[3].buffer = (char*)&storage__mysqldata.packets_in;
+    storage__mysqlbind[4].buffer_type = MYSQL_TYPE_LONGLONG;
+    storage__mysqlbind[4].buffer = (char*)&storage__mysqldata.u.bytes_in;
+    storage__mysqlbind[5].buffer_type = MYSQL_TYPE_LONG;
+    storage__mysqlbind[5].buffer = (char*)&storage__mysqldata.packets_out;
+    storage__mysqlbind[6].buffer_type = MYSQL_TYPE_LONGLONG;
+    storage__mysqlbind[6].buffer = (char*)&storage__mysqldata.bytes_out;
     storage__mysqlbind[0].is_unsigned = storage__mysqlbind[1].is_unsigned
 	    = storage__mysqlbind[2].is_unsigned = storage__mysqlbind[3].is_unsigned
 	    = storage__mysqlbind[4].is_unsigned = storage__mysqlbind[5].is_unsigned
-	    = (my_bool)-1;
+	    = storage__mysqlbind[6].is_unsigned = (my_bool)-1;
 
 #ifndef USE_DAEMON_IP_FILTER
-    storage__mysqlbind[6].buffer_type = MYSQL_TYPE_LONG; 
-    storage__mysqlbind[6].buffer = (char*)&storage__mysqldataip;
     storage__mysqlbind[7].buffer_type = MYSQL_TYPE_LONG; 
     storage__mysqlbind[7].buffer = (char*)&storage__mysqldataip;
-    storage__mysqlbind[6].is_unsigned = storage__mysqlbind[7].is_unsigned = (my_bool)-1;
+    storage__mysqlbind[8].buffer_type = MYSQL_TYPE_LONG; 
+    storage__mysqlbind[8].buffer = (char*)&storage__mysqldataip;
+    storage__mysqlbind[7].is_unsigned = storage__mysqlbind[8].is_unsigned = (my_bool)-1;
 #endif /* !USE_DAEMON_IP_FILTER */
 
     if (mysql_stmt_bind_param(storage__mysqlps, storage__mysqlbind) != 0) {
@@ -548,13 +1147,14 @@ static void storage__db_prepstmt_end() {
     }
 }
 
-static void storage__write_record_prepstmt(uint16_t vlan, uint32_t ip,
+static void storage__write_record_prepstmt(uint32_t unixtime, uint16_t vlan, uint32_t ip,
         uint32_t in_pps, uint64_t in_bps, uint32_t out_pps, uint64_t out_bps) {
     /* After a failure, we won't try again this run */
     if (storage__mysqlps == NULL)
 	return;
 
     /* Set values in the locations that the prepared statement will be looking at */
+    storage__mysqldataunixtime = unixtime;
     storage__mysqldata.vlan = vlan;
     storage__mysqldataip = ip;
     storage__mysqldata.packets_in = in_pps;
@@ -567,11 +1167,13 @@ static void storage__write_record_prepstmt(uint16_t vlan, uint32_t ip,
 	storage__db_prepstmt_end();
 	return;
     }
+    storage__stat_rows += mysql_stmt_affected_rows(storage__mysqlps);
+    ++storage__stat_queries;
 #   ifdef PRINT_EVERY_PACKET
     if (mysql_stmt_affected_rows(storage__mysqlps) >= 1) {
-	assert(mysql_stmt_affected_rows(storage__mysqlps) == 1);
+	assert(mysql_stmt_affected_rows(storage__mysqlps) <= 2); /* 2 for a replaced row */
 	fprintf(stderr, "storage__write_ip: Data stored for IP %" SCNu32 "\n", ip);
     }
 #   endif /* PRINT_EVERY_PACKET */
 }
-#endif /* USE_PREPARED_STATEMENTS */
+#endif /* USE_PREPARED_STATEMENTS && !USE_MULTIROW_INSERTS */
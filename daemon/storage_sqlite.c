@@ -0,0 +1,410 @@
+/* vim: set ts=8 sw=4 sts=4 noet: */
+/*======================================================================
+Copyright (C) 2009 OSSO B.V. <walter+lightcount@osso.nl>
+This file is part of LightCount.
+
+LightCount is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+LightCount is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with LightCount.  If not, see <http://www.gnu.org/licenses/>.
+======================================================================*/
+
+#include "lightcount.h"
+#include <sqlite3.h>
+#include <sys/time.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+/* Settings */
+#define DONT_STORE_ZERO_ENTRIES 1	    /* delete all entries with all values zero */
+#define USE_KERNEL_IP_FILTER 1		    /* let the kernel drop the packets of other IPs */
+#define BUSY_TIMEOUT_MS 10000		    /* wait this long for readers of the database */
+#define BUFSIZE 2048			    /* a config file line fits in this */
+
+/* Static constants */
+#define STORAGE__INSERT \
+    "INSERT INTO sample_tbl (unixtime,node_id,vlan_id,ip,in_pps,in_bps,out_pps,out_bps) " \
+    "VALUES (?,?,?,?,?,?,?,?) ON CONFLICT (unixtime,node_id,vlan_id,ip) DO UPDATE SET " \
+    "in_pps=excluded.in_pps,in_bps=excluded.in_bps," \
+    "out_pps=excluded.out_pps,out_bps=excluded.out_bps" /* rewrites replace the rows */
+
+
+static sqlite3 *storage__db;		    /* opened at storage_open */
+static sqlite3_stmt *storage__insert;	    /* the insert statement of this write */
+static int storage__node_id;		    /* may vary per write */
+static uint32_t storage__unixtime_begin;    /* varies per write */
+static uint32_t storage__slot_interval;	    /* may vary per write */
+static uint32_t storage__slots;		    /* samples to store the average in */
+static uint32_t storage__interval;	    /* the counted time, slot interval times slots */
+static uint32_t storage__intervald2;	    /* interval divided by two */
+static int storage__failed;		    /* whether an insert of this write failed */
+static unsigned long storage__stat_rows;    /* rows written in this write */
+static unsigned long storage__stat_ips;	    /* ips enumerated in this write */
+
+static uint32_t *storage__ipfilter_ranges;  /* ip ranges to store [from, to, from, to, ...] */
+static size_t storage__ipfilter_count;	    /* number of (coalesced) ip ranges */
+
+#ifdef USE_KERNEL_IP_FILTER
+static uint32_t *storage__kfilter_ranges;   /* ip ranges passed to sniff_ipfilter */
+static size_t storage__kfilter_count;	    /* number of ip ranges passed */
+#endif /* USE_KERNEL_IP_FILTER */
+
+static char storage__conf_file[256];	    /* the database file */
+
+
+static int storage__read_config(char const *config_file);
+static void storage__rtrim(char *io);
+#ifndef NDEBUG
+static double storage__now();
+#endif
+static int storage__db_exec(char const *sql);
+static int storage__db_get_node_id(char const *safe_node_name);
+static int storage__db_insert_begin();
+static void storage__write_ip(uint32_t ip, struct ipcount_t const *ipcount);
+static int storage__ipfilter_begin();
+static void storage__ipfilter_end();
+
+#ifdef USE_KERNEL_IP_FILTER
+static void storage__kfilter_update();
+#endif /* USE_KERNEL_IP_FILTER */
+
+
+void storage_help() {
+    printf(
+	"/********************* module: storage (sqlite) *******************************/\n"
+	"#%s DONT_STORE_ZERO_ENTRIES\n"
+	"#%s USE_KERNEL_IP_FILTER\n"
+	"#define BUSY_TIMEOUT_MS %u\n"
+	"\n"
+	"Stores average values in a local SQLite database file, for nodes that keep\n"
+	"their own data or to try lightcount without a database server. The file must\n"
+	"have the tables of lightcount.storage_sqlite.sql, which are the same as those\n"
+	"of the MySQL module. The interface reads it with storage_type=sqlite.\n"
+	"\n"
+	"The configuration file must look like:\n"
+	"  storage_file=FILENAME\n"
+	"It is read at startup only.\n"
+	"\n"
+	"Only counts for IP addresses that are listed in the `ip_range_tbl` table are\n"
+	"stored, like the MySQL module does with USE_DAEMON_IP_FILTER. Every interval\n"
+	"is written in a single transaction; rows that were stored already are\n"
+	"replaced. The database is switched to write-ahead logging, so the interface\n"
+	"can read while the daemon writes. A write waits at most BUSY_TIMEOUT_MS for\n"
+	"other writers.\n"
+	"\n"
+	"See the MySQL module for DONT_STORE_ZERO_ENTRIES and USE_KERNEL_IP_FILTER.\n"
+	"\n",
+#ifdef DONT_STORE_ZERO_ENTRIES
+	"define",
+#else /* !DONT_STORE_ZERO_ENTRIES */
+	"undef",
+#endif /* !DONT_STORE_ZERO_ENTRIES */
+#ifdef USE_KERNEL_IP_FILTER
+	"define",
+#else /* !USE_KERNEL_IP_FILTER */
+	"undef",
+#endif /* !USE_KERNEL_IP_FILTER */
+	(unsigned)BUSY_TIMEOUT_MS
+    );
+}
+
+int storage_open(char const *config_file) {
+    if (storage__read_config(config_file) != 0 || storage__conf_file[0] == '\0') {
+	fprintf(stderr, "storage_open: Specify the database file as storage_file in the configuration file.\n");
+	return -1;
+    }
+    /* Don't create the file, it needs the tables anyway */
+    if (sqlite3_open_v2(storage__conf_file, &storage__db, SQLITE_OPEN_READWRITE, NULL) != SQLITE_OK) {
+	fprintf(stderr, "sqlite3_open_v2: %s: %s\n", storage__conf_file, sqlite3_errmsg(storage__db));
+	sqlite3_close(storage__db);
+	storage__db = NULL;
+	return -1;
+    }
+    sqlite3_busy_timeout(storage__db, BUSY_TIMEOUT_MS);
+    if (storage__db_exec("PRAGMA journal_mode=WAL") != 0) {
+	sqlite3_close(storage__db);
+	storage__db = NULL;
+	return -1;
+    }
+#ifndef NDEBUG
+    fprintf(stderr, "storage_open: Using database file %s.\n", storage__conf_file);
+#endif
+    return 0;
+}
+
+void storage_close() {
+#ifdef USE_KERNEL_IP_FILTER
+    free(storage__kfilter_ranges);
+#endif /* USE_KERNEL_IP_FILTER */
+    if (sqlite3_close(storage__db) != SQLITE_OK)
+	fprintf(stderr, "sqlite3_close: %s\n", sqlite3_errmsg(storage__db));
+    storage__db = NULL;
+}
+
+void storage_write(uint32_t unixtime_begin, uint32_t interval, uint32_t slots, void *memory) {
+    char safe_node_name[256];
+#ifndef NDEBUG
+    double time_begin = storage__now();
+#endif
+
+    storage__unixtime_begin = unixtime_begin;
+    storage__slot_interval = interval;
+    storage__slots = slots;
+    storage__interval = interval * slots;
+    storage__intervald2 = storage__interval >> 1;
+    storage__stat_rows = storage__stat_ips = 0;
+    storage__failed = 0;
+    util_get_safe_node_name(safe_node_name, sizeof(safe_node_name));
+
+    /* Everything in one transaction: it is much faster and a failure stores nothing */
+    if (storage__db_exec("BEGIN IMMEDIATE") != 0) {
+	stats_add(STATS_STORAGE_FAILURES, 1);
+	return;
+    }
+    if ((storage__node_id = storage__db_get_node_id(safe_node_name)) == -1
+	    || storage__ipfilter_begin() != 0) {
+	storage__db_exec("ROLLBACK");
+	stats_add(STATS_STORAGE_FAILURES, 1);
+	return;
+    }
+    if (storage__db_insert_begin() != 0) {
+	storage__ipfilter_end();
+	storage__db_exec("ROLLBACK");
+	stats_add(STATS_STORAGE_FAILURES, 1);
+	return;
+    }
+
+    memory_enum(memory, &storage__write_ip);
+    stats_set(STATS_STORAGE_IPS, storage__stat_ips);
+
+    sqlite3_finalize(storage__insert);
+    storage__insert = NULL;
+    storage__ipfilter_end();
+    if (storage__failed || storage__db_exec("COMMIT") != 0) {
+	storage__db_exec("ROLLBACK");
+	storage__stat_rows = 0;
+	stats_add(STATS_STORAGE_FAILURES, 1);
+    }
+
+#ifndef NDEBUG
+    fprintf(stderr, "storage_write: Wrote %lu rows in %.3f seconds.\n",
+	    storage__stat_rows, storage__now() - time_begin);
+#endif
+    stats_add(STATS_STORAGE_ROWS, storage__stat_rows);
+}
+
+static int storage__read_config(char const *config_file) {
+    FILE *fp;
+    char buf[BUFSIZE];
+
+    storage__conf_file[0] = '\0';
+    if ((fp = fopen(config_file, "r")) == NULL) {
+	perror("fopen");
+	return -1;
+    }
+    while (fgets(buf, BUFSIZE, fp) != NULL) {
+	if (strncmp(buf, "storage_file=", 13) == 0) {
+	    strncpy(storage__conf_file, buf + 13, sizeof(storage__conf_file) - 1);
+	    storage__conf_file[sizeof(storage__conf_file) - 1] = '\0';
+	    storage__rtrim(storage__conf_file);
+	}
+    }
+    fclose(fp);
+    return 0;
+}
+
+static void storage__rtrim(char *io) {
+    char *p = io + strlen(io);
+    while (--p && p >= io && *p <= ' ')
+	*p = '\0';
+}
+
+#ifndef NDEBUG
+static double storage__now() {
+    struct timeval tv;
+    gettimeofday(&tv, NULL);
+    return tv.tv_sec + tv.tv_usec / 1000000.0;
+}
+#endif
+
+static int storage__db_exec(char const *sql) {
+    char *errmsg;
+    if (sqlite3_exec(storage__db, sql, NULL, NULL, &errmsg) != SQLITE_OK) {
+	fprintf(stderr, "sqlite3_exec: %s: %s\n", sql, errmsg);
+	sqlite3_free(errmsg);
+	return -1;
+    }
+    return 0;
+}
+
+static int storage__db_get_node_id(char const *safe_node_name) {
+    sqlite3_stmt *stmt;
+    int ret = -1;
+
+    if (sqlite3_prepare_v2(storage__db, "SELECT node_id FROM node_tbl WHERE node_name = ?", -1, &stmt, NULL) != SQLITE_OK) {
+	fprintf(stderr, "sqlite3_prepare_v2: %s\n", sqlite3_errmsg(storage__db));
+	return -1;
+    }
+    sqlite3_bind_text(stmt, 1, safe_node_name, -1, SQLITE_STATIC);
+    if (sqlite3_step(stmt) == SQLITE_ROW)
+	ret = sqlite3_column_int(stmt, 0);
+    sqlite3_finalize(stmt);
+    if (ret != -1)
+	return ret;
+
+    if (sqlite3_prepare_v2(storage__db, "INSERT INTO node_tbl (node_name) VALUES (?)", -1, &stmt, NULL) != SQLITE_OK) {
+	fprintf(stderr, "sqlite3_prepare_v2: %s\n", sqlite3_errmsg(storage__db));
+	return -1;
+    }
+    sqlite3_bind_text(stmt, 1, safe_node_name, -1, SQLITE_STATIC);
+    if (sqlite3_step(stmt) == SQLITE_DONE)
+	ret = (int)sqlite3_last_insert_rowid(storage__db);
+    else
+	fprintf(stderr, "sqlite3_step: %s\n", sqlite3_errmsg(storage__db));
+    sqlite3_finalize(stmt);
+    return ret;
+}
+
+/* Prepares the insert; the node is the same for every row */
+static int storage__db_insert_begin() {
+    if (sqlite3_prepare_v2(storage__db, STORAGE__INSERT, -1, &storage__insert, NULL) != SQLITE_OK) {
+	fprintf(stderr, "sqlite3_prepare_v2: %s\n", sqlite3_errmsg(storage__db));
+	return -1;
+    }
+    sqlite3_bind_int(storage__insert, 2, storage__node_id);
+    return 0;
+}
+
+static void storage__write_ip(uint32_t ip, struct ipcount_t const *ipcount) {
+    uint32_t rnd_packets_in = (ipcount->packets_in + storage__intervald2) / storage__interval;
+    uint64_t rnd_bytes_in = (ipcount->u.bytes_in + storage__intervald2) / storage__interval;
+    uint32_t rnd_packets_out = (ipcount->packets_out + storage__intervald2) / storage__interval;
+    uint64_t rnd_bytes_out = (ipcount->bytes_out + storage__intervald2) / storage__interval;
+    uint32_t slot;
+
+    ++storage__stat_ips;
+    /* After a failure, we won't try again this write */
+    if (storage__failed)
+	return;
+#ifdef DONT_STORE_ZERO_ENTRIES
+    if (rnd_packets_in == 0 && rnd_bytes_in == 0 && rnd_packets_out == 0 && rnd_bytes_out == 0)
+	return;
+#endif /* DONT_STORE_ZERO_ENTRIES */
+    if (!util_ipfilter_in_range(storage__ipfilter_ranges, storage__ipfilter_count, ip))
+	return;
+
+    sqlite3_bind_int(storage__insert, 3, ipcount->vlan);
+    sqlite3_bind_int64(storage__insert, 4, ip);
+    sqlite3_bind_int64(storage__insert, 5, rnd_packets_in);
+    sqlite3_bind_int64(storage__insert, 6, (sqlite3_int64)rnd_bytes_in);
+    sqlite3_bind_int64(storage__insert, 7, rnd_packets_out);
+    sqlite3_bind_int64(storage__insert, 8, (sqlite3_int64)rnd_bytes_out);
+    /* The same average for every sample of a merged interval */
+    for (slot = 0; slot < storage__slots && !storage__failed; ++slot) {
+	sqlite3_bind_int64(storage__insert, 1, storage__unixtime_begin + slot * storage__slot_interval);
+	if (sqlite3_step(storage__insert) != SQLITE_DONE) {
+	    fprintf(stderr, "sqlite3_step: %s\n", sqlite3_errmsg(storage__db));
+	    storage__failed = 1;
+	} else {
+	    ++storage__stat_rows;
+	}
+	sqlite3_reset(storage__insert);
+    }
+#ifdef PRINT_EVERY_PACKET
+    fprintf(stderr, "storage__write_ip: Data stored for %s\n", util_inet_htoa(ip));
+#endif /* PRINT_EVERY_PACKET */
+}
+
+static int storage__ipfilter_begin() {
+    sqlite3_stmt *stmt;
+    size_t rows = 0, size = 64;
+    int ret;
+
+    if ((storage__ipfilter_ranges = (uint32_t*)malloc(2 * size * sizeof(uint32_t))) == NULL) {
+	fprintf(stderr, "malloc failed for daemon side ip filter\n");
+	return -1;
+    }
+    /* The ranges are coalesced below, ordering by ip_begin saves the sort */
+    if (sqlite3_prepare_v2(storage__db,
+	    "SELECT ip_begin, ip_end FROM ip_range_tbl WHERE node_id IS NULL OR node_id = ? ORDER BY ip_begin",
+	    -1, &stmt, NULL) != SQLITE_OK) {
+	fprintf(stderr, "sqlite3_prepare_v2: %s\n", sqlite3_errmsg(storage__db));
+	storage__ipfilter_end();
+	return -1;
+    }
+    sqlite3_bind_int(stmt, 1, storage__node_id);
+    while ((ret = sqlite3_step(stmt)) == SQLITE_ROW) {
+	if (rows == size) {
+	    uint32_t *ranges = (uint32_t*)realloc(storage__ipfilter_ranges, 4 * size * sizeof(uint32_t));
+	    if (ranges == NULL) {
+		fprintf(stderr, "realloc failed for daemon side ip filter (tried to get %lu bytes)\n",
+			(unsigned long)(4 * size * sizeof(uint32_t)));
+		break;
+	    }
+	    storage__ipfilter_ranges = ranges;
+	    size *= 2;
+	}
+	storage__ipfilter_ranges[2 * rows] = (uint32_t)sqlite3_column_int64(stmt, 0);
+	storage__ipfilter_ranges[2 * rows + 1] = (uint32_t)sqlite3_column_int64(stmt, 1);
+	++rows;
+    }
+    sqlite3_finalize(stmt);
+    if (ret != SQLITE_DONE) {
+	if (ret != SQLITE_ROW)
+	    fprintf(stderr, "sqlite3_step: %s\n", sqlite3_errmsg(storage__db));
+	storage__ipfilter_end();
+	return -1;
+    }
+
+    /* Merge overlapping and adjacent ranges so we can binary search them */
+    storage__ipfilter_count = util_ipfilter_coalesce(storage__ipfilter_ranges, rows);
+#ifndef NDEBUG
+    fprintf(stderr, "storage__ipfilter_begin: Coalesced %lu ip ranges into %lu.\n",
+	    (unsigned long)rows, (unsigned long)storage__ipfilter_count);
+#endif
+
+#ifdef USE_KERNEL_IP_FILTER
+    /* Tell the sniff module if something changed */
+    storage__kfilter_update();
+#endif /* USE_KERNEL_IP_FILTER */
+    return 0;
+}
+
+static void storage__ipfilter_end() {
+    free(storage__ipfilter_ranges);
+    storage__ipfilter_ranges = NULL;
+    storage__ipfilter_count = 0;
+}
+
+
+#ifdef USE_KERNEL_IP_FILTER
+static void storage__kfilter_update() {
+    size_t size = 2 * storage__ipfilter_count * sizeof(uint32_t);
+    uint32_t *ranges;
+
+    /* Compare with the ranges we passed last time (if any) */
+    if (storage__kfilter_ranges != NULL && storage__kfilter_count == storage__ipfilter_count
+	    && memcmp(storage__kfilter_ranges, storage__ipfilter_ranges, size) == 0)
+	return;
+    if ((ranges = (uint32_t*)realloc(storage__kfilter_ranges, size + 1)) == NULL) {
+	fprintf(stderr, "storage__kfilter_update: realloc failed, keeping the old filter.\n");
+	return;
+    }
+    memcpy(ranges, storage__ipfilter_ranges, size);
+    storage__kfilter_ranges = ranges;
+    storage__kfilter_count = storage__ipfilter_count;
+
+    fprintf(stderr, "storage__kfilter_update: Passing %lu ip ranges to the socket filter.\n",
+	    (unsigned long)storage__kfilter_count);
+    sniff_ipfilter(storage__kfilter_ranges, storage__kfilter_count);
+}
+#endif /* USE_KERNEL_IP_FILTER */
@@ -19,8 +19,8 @@ along with LightCount.  If not, see <http://www.gnu.org/licenses/>.
 
 #include "lightcount.h"
 #include <sys/time.h>
+#include <assert.h>
 #include <pthread.h>
-#include <signal.h>
 #include <stdio.h>
 #include <time.h>
 #include <unistd.h>
@@ -29,6 +29,12 @@ along with LightCount.  If not, see <http://www.gnu.org/licenses/>.
 #ifndef INTERVAL_SECONDS
 #   define INTERVAL_SECONDS 300		/* wake the storage engine every N seconds */
 #endif /* INTERVAL_SECONDS */
+#ifndef FLUSH_BUFFERS
+#   define FLUSH_BUFFERS 4		/* memory buffers: counting, flushing and queued */
+#endif /* FLUSH_BUFFERS */
+#ifndef FLUSH_MERGE_ON_OVERLOAD
+#   define FLUSH_MERGE_ON_OVERLOAD 1	/* merge intervals (1) instead of dropping the oldest (0) */
+#endif /* FLUSH_MERGE_ON_OVERLOAD */
 
 #define TIMER__METHOD_NSLEEP 1
 #define TIMER__METHOD_SEMAPHORE 2
@@ -41,9 +47,29 @@ along with LightCount.  If not, see <http://www.gnu.org/licenses/>.
 #endif
 
 
+/* An interval that waits for the flush thread */
+struct timer__job {
+    void *memory;
+    uint32_t unixtime_begin;
+    uint32_t interval;
+};
+
 static pthread_t timer__thread;
-static void *timer__memory[2];		/* memory to store in non-volatile space */
+static void *timer__memory[FLUSH_BUFFERS]; /* memory to store in non-volatile space */
 static void *timer__memp;		/* memory that's currently written to */
+
+static pthread_t timer__flush_thread;
+static pthread_mutex_t timer__flush_mutex = PTHREAD_MUTEX_INITIALIZER;
+static pthread_cond_t timer__flush_cond = PTHREAD_COND_INITIALIZER;
+static void *timer__free[FLUSH_BUFFERS]; /* memory that is not in use */
+static int timer__free_count;
+static struct timer__job timer__jobs[FLUSH_BUFFERS]; /* queued intervals (a ring) */
+static int timer__jobs_first;
+static int timer__jobs_count;
+static int timer__flush_done;		/* whether the flush thread must stop */
+static int timer__stat_max_depth;	/* most intervals ever queued */
+static unsigned timer__stat_dropped;	/* intervals dropped on overload */
+static unsigned timer__stat_merged;	/* intervals merged on overload */
 #if TIMER__METHOD == TIMER__METHOD_NSLEEP
 static volatile int timer__done;	/* whether we're done */
 #elif TIMER__METHOD == TIMER__METHOD_SEMAPHORE
@@ -52,6 +78,10 @@ static sem_t timer__semaphore;		/* semaphore to synchronize the threads */
 
 
 static void *timer__run(void *thread_arg);
+static void *timer__flush_run(void *thread_arg);
+static void *timer__flush_get_memory();
+static void timer__flush_put(void *memory, uint32_t unixtime_begin, uint32_t interval);
+static void timer__flush_release(void *memory);
 
 
 void timer_help() {
@@ -59,10 +89,23 @@ void timer_help() {
 	"/********************* module: timer (interval) *******************************/\n"
 	"#%s USE_NSLEEP_TIMER\n"
 	"#define INTERVAL_SECONDS %" SCNu32 "\n"
+	"#define FLUSH_BUFFERS %u\n"
+	"#define FLUSH_MERGE_ON_OVERLOAD %u\n"
 	"\n"
 	"Sleeps until the specified interval of %.2f minutes have passed and wakes up\n"
 	"to tell the storage engine to write averages.\n"
 	"\n"
+	"The writing is done by a separate flush thread, so counting continues in a\n"
+	"fresh buffer while the storage engine is busy. Up to FLUSH_BUFFERS - 2\n"
+	"intervals wait for a slow storage engine. When they're all taken, the next\n"
+	"interval is merged into the one that is being counted when\n"
+	"FLUSH_MERGE_ON_OVERLOAD is 1: its average is stored once for every interval\n"
+	"it covers, so the totals stay right. That is a single write (and spool\n"
+	"segment), one transaction with more rows. When it is 0, the oldest waiting\n"
+	"interval is dropped. Set it with make CPPFLAGS=-DFLUSH_MERGE_ON_OVERLOAD=0.\n"
+	"Each flush prints the queue depth and how long after the end of the interval\n"
+	"it was stored (the lag).\n"
+	"\n"
 	"The USE_NSLEEP_TIMER define forces the module to use a polling sleep loop even\n"
 	"when the (probably) less cpu intensive and more accurate sem_timedwait()\n"
 	"function is available. The currently compiled in timer method is: %s\n"
@@ -72,7 +115,8 @@ void timer_help() {
 #else /* !USE_NSLEEP_TIMER */
 	"undef",
 #endif
-	(uint32_t)INTERVAL_SECONDS, (float)INTERVAL_SECONDS / 60,
+	(uint32_t)INTERVAL_SECONDS, (unsigned)FLUSH_BUFFERS, (unsigned)FLUSH_MERGE_ON_OVERLOAD,
+	(float)INTERVAL_SECONDS / 60,
 #if TIMER__METHOD == TIMER__METHOD_NSLEEP
 	"n_sleep"
 #elif TIMER__METHOD == TIMER__METHOD_SEMAPHORE
@@ -83,11 +127,23 @@ void timer_help() {
 
 int timer_loop_bg(void *memory1, void *memory2) {
     pthread_attr_t attr;
+    int i;
+    assert(FLUSH_BUFFERS >= 2);
     
-    /* Set internal config */
+    /* Set internal config, we add the memory for the flush queue */
     timer__memory[0] = memory1;
     timer__memory[1] = memory2;
     timer__memp = memory1; /* sniff_loop writes to memory1 first */
+    timer__free_count = 0;
+    for (i = 1; i < FLUSH_BUFFERS; ++i) {
+	if (i >= 2 && (timer__memory[i] = memory_alloc()) == NULL) {
+	    fprintf(stderr, "timer_loop_bg: Failed to allocate memory for the flush queue.\n");
+	    return -1;
+	}
+	timer__free[timer__free_count++] = timer__memory[i];
+    }
+    timer__jobs_first = timer__jobs_count = 0;
+    timer__flush_done = 0;
 
 #if TIMER__METHOD == TIMER__METHOD_NSLEEP
     /* Initialize polling variable */
@@ -106,8 +162,9 @@ int timer_loop_bg(void *memory1, void *memory2) {
 	return -1;
     }
     
-    /* Run thread */
-    if (pthread_create(&timer__thread, &attr, &timer__run, NULL) != 0) {
+    /* Run threads */
+    if (pthread_create(&timer__flush_thread, &attr, &timer__flush_run, NULL) != 0
+	    || pthread_create(&timer__thread, &attr, &timer__run, NULL) != 0) {
 	perror("pthread_create");
 	return -1;
     }
@@ -119,6 +176,7 @@ int timer_loop_bg(void *memory1, void *memory2) {
 
 void timer_loop_stop() {
     void *ret;
+    int i;
 
     /* Tell our thread that it is time */
 #if TIMER__METHOD == TIMER__METHOD_NSLEEP
@@ -134,6 +192,16 @@ void timer_loop_stop() {
     fprintf(stderr, "timer_loop_stop: Thread %p joined.\n", (void*)timer__thread);
 #endif
 
+    /* Let the flush thread store what's queued and stop */
+    pthread_mutex_lock(&timer__flush_mutex);
+    timer__flush_done = 1;
+    pthread_cond_signal(&timer__flush_cond);
+    pthread_mutex_unlock(&timer__flush_mutex);
+    if (pthread_join(timer__flush_thread, &ret) != 0)
+	perror("pthread_join");
+    for (i = 2; i < FLUSH_BUFFERS; ++i)
+	memory_free(timer__memory[i]);
+
 #if TIMER__METHOD == TIMER__METHOD_SEMAPHORE
     /* Destroy semaphore */
     if (sem_destroy(&timer__semaphore) != 0)
@@ -144,6 +212,8 @@ void timer_loop_stop() {
 /* The timers job is to run storage function after after every INTERVAL_SECONDS time. */
 static void *timer__run(void *thread_arg) {
     int first_run_skipped = 0; /* do not store the first run because the interval is wrong */
+    int memp_begin_time = 0;   /* when we started counting in timer__memp */
+    int is_merging = 0;	       /* whether timer__memp holds an earlier interval too */
 
 #ifndef NDEBUG
     fprintf(stderr, "timer__run: Thread started.\n");
@@ -152,6 +222,7 @@ static void *timer__run(void *thread_arg) {
     while (1) {
 	struct timeval current_time; /* current time is in UTC */
 	int sample_begin_time;
+	void *next_memp;
 #if TIMER__METHOD == TIMER__METHOD_NSLEEP
 	int sleep_useconds;
 #elif TIMER__METHOD == TIMER__METHOD_SEMAPHORE
@@ -165,8 +236,10 @@ static void *timer__run(void *thread_arg) {
 	    return (void*)-1;
 	}
     
-	/* Yes, we started sampling when SIGUSR1 fired, so this is correct */
+	/* Yes, we started sampling when the memory was handed over, so this is correct */
 	sample_begin_time = current_time.tv_sec - (current_time.tv_sec % INTERVAL_SECONDS);
+	if (!is_merging)
+	    memp_begin_time = sample_begin_time;
 
 	/* Calculate how long to sleep */
 #if TIMER__METHOD == TIMER__METHOD_NSLEEP
@@ -223,24 +296,37 @@ static void *timer__run(void *thread_arg) {
 		(int)current_time.tv_usec);
 #endif
 
-	/* Poke other thread to switch memory */
-	raise(SIGUSR1);
-	sleep(1); /* wait a second to let other thread finish switching memory */
+	/* Get memory for the next interval. If there is none, we keep counting
+	 * in the current memory and store the intervals as one. */
+	if ((next_memp = timer__flush_get_memory()) == NULL) {
+	    fprintf(stderr, "timer__run: Flush queue is full, merging interval %i with the next.\n",
+		    sample_begin_time);
+	    is_merging = 1;
+	    continue;
+	}
+	is_merging = 0;
+
+	/* Hand the next memory to the capture threads and wait until they let
+	 * go of ours */
+	util_handoff_publish(next_memp);
+	while (util_handoff_wait(UTIL_HANDOFF_TIMEOUT_MS) != 0)
+	    fprintf(stderr, "timer__run: Capture threads did not let go of memory %p in %u ms, still waiting.\n",
+		    timer__memp, (unsigned)UTIL_HANDOFF_TIMEOUT_MS);
+
+	/* Let the sniffer add the counts it keeps elsewhere */
+	sniff_collect(timer__memp);
 
 	if (first_run_skipped) {
-	    /* Delegate the actual writing to storage. */
-	    storage_write(sample_begin_time, INTERVAL_SECONDS, timer__memp);
+	    /* Delegate the actual writing to storage (in the flush thread). */
+	    timer__flush_put(timer__memp, memp_begin_time,
+		    sample_begin_time + INTERVAL_SECONDS - memp_begin_time);
 	} else {
 	    /* On first run, we started too late in the interval. Ignore those counts. */
 	    first_run_skipped = 1;
+	    memory_reset(timer__memp);
+	    timer__flush_release(timer__memp);
 	}
-
-	/* Reset mem for next run */
-	memory_reset(timer__memp);
-	if (timer__memp == timer__memory[0])
-	    timer__memp = timer__memory[1];
-	else
-	    timer__memp = timer__memory[0];
+	timer__memp = next_memp;
     }
     
 #ifndef NDEBUG
@@ -248,3 +334,116 @@ static void *timer__run(void *thread_arg) {
 #endif
     return 0;
 }
+
+/* The flush thread stores the queued intervals, oldest first. When asked to
+ * stop, it stores what's left in the queue first. */
+static void *timer__flush_run(void *thread_arg) {
+    pthread_mutex_lock(&timer__flush_mutex);
+    while (1) {
+	struct timer__job job;
+	struct timeval begin_time, current_time;
+	int depth, lag;
+
+	while (timer__jobs_count == 0 && !timer__flush_done)
+	    pthread_cond_wait(&timer__flush_cond, &timer__flush_mutex);
+	if (timer__jobs_count == 0)
+	    break;
+	depth = timer__jobs_count;
+	job = timer__jobs[timer__jobs_first];
+	timer__jobs_first = (timer__jobs_first + 1) % FLUSH_BUFFERS;
+	--timer__jobs_count;
+	pthread_mutex_unlock(&timer__flush_mutex);
+	stats_set(STATS_FLUSH_QUEUE_DEPTH, depth);
+
+	if (gettimeofday(&begin_time, NULL) != 0)
+	    perror("gettimeofday");
+	/* The interface expects a sample every INTERVAL_SECONDS, so a merged
+	 * interval stores its average in every slot it covers (in one write) */
+	storage_write(job.unixtime_begin, INTERVAL_SECONDS, job.interval / INTERVAL_SECONDS, job.memory);
+	memory_reset(job.memory);
+	if (gettimeofday(&current_time, NULL) != 0)
+	    perror("gettimeofday");
+
+	lag = (int)(current_time.tv_sec - (job.unixtime_begin + job.interval));
+	stats_add(STATS_FLUSHES, 1);
+	stats_set(STATS_FLUSH_LAG_SECONDS, lag < 0 ? 0 : lag);
+	stats_set(STATS_FLUSH_DURATION_US, (current_time.tv_sec - begin_time.tv_sec) * (uint64_t)1000000
+		+ current_time.tv_usec - begin_time.tv_usec);
+
+	if (depth > 1 || lag >= INTERVAL_SECONDS) {
+	    /* We're falling behind */
+	    fprintf(stderr, "timer__flush_run: Stored interval %" SCNu32 " with a lag of %i seconds. "
+		    "Queue depth was %i (max %i), %u intervals dropped, %u merged.\n",
+		    job.unixtime_begin, lag, depth, timer__stat_max_depth, timer__stat_dropped, timer__stat_merged);
+	}
+#ifndef NDEBUG
+	else {
+	    fprintf(stderr, "timer__flush_run: Stored interval %" SCNu32 " with a lag of %i seconds.\n",
+		    job.unixtime_begin, lag);
+	}
+#endif
+
+	pthread_mutex_lock(&timer__flush_mutex);
+	timer__free[timer__free_count++] = job.memory;
+    }
+    pthread_mutex_unlock(&timer__flush_mutex);
+    return 0;
+}
+
+/* Returns free memory for the next interval, or NULL if the queue is full
+ * and we should merge the intervals. */
+static void *timer__flush_get_memory() {
+    void *memory = NULL;
+    int is_dropped = 0;
+
+    pthread_mutex_lock(&timer__flush_mutex);
+    if (timer__free_count != 0) {
+	memory = timer__free[--timer__free_count];
+    } else {
+#if FLUSH_MERGE_ON_OVERLOAD
+	++timer__stat_merged;
+	stats_add(STATS_FLUSH_MERGED, 1);
+#else /* !FLUSH_MERGE_ON_OVERLOAD */
+	if (timer__jobs_count != 0) {
+	    /* Drop the oldest interval that is not being stored yet */
+	    memory = timer__jobs[timer__jobs_first].memory;
+	    fprintf(stderr, "timer__flush_get_memory: Flush queue is full, dropping interval %" SCNu32 ".\n",
+		    timer__jobs[timer__jobs_first].unixtime_begin);
+	    timer__jobs_first = (timer__jobs_first + 1) % FLUSH_BUFFERS;
+	    --timer__jobs_count;
+	    ++timer__stat_dropped;
+	    stats_add(STATS_FLUSH_DROPPED, 1);
+	    is_dropped = 1;
+	} else {
+	    ++timer__stat_merged; /* the only other memory is being stored */
+	    stats_add(STATS_FLUSH_MERGED, 1);
+	}
+#endif /* !FLUSH_MERGE_ON_OVERLOAD */
+    }
+    pthread_mutex_unlock(&timer__flush_mutex);
+
+    if (is_dropped)
+	memory_reset(memory); /* it's ours now, so we can reset it unlocked */
+    return memory;
+}
+
+static void timer__flush_put(void *memory, uint32_t unixtime_begin, uint32_t interval) {
+    struct timer__job *job;
+
+    pthread_mutex_lock(&timer__flush_mutex);
+    assert(timer__jobs_count < FLUSH_BUFFERS);
+    job = &timer__jobs[(timer__jobs_first + timer__jobs_count) % FLUSH_BUFFERS];
+    job->memory = memory;
+    job->unixtime_begin = unixtime_begin;
+    job->interval = interval;
+    if (++timer__jobs_count > timer__stat_max_depth)
+	timer__stat_max_depth = timer__jobs_count;
+    pthread_cond_signal(&timer__flush_cond);
+    pthread_mutex_unlock(&timer__flush_mutex);
+}
+
+static void timer__flush_release(void *memory) {
+    pthread_mutex_lock(&timer__flush_mutex);
+    timer__free[timer__free_count++] = memory;
+    pthread_mutex_unlock(&timer__flush_mutex);
+}
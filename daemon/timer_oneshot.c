@@ -18,9 +18,9 @@ along with LightCount.  If not, see <http://www.gnu.org/licenses/>.
 ======================================================================*/
 
 #include "lightcount.h"
+#include <sys/time.h>
 #include <assert.h>
 #include <pthread.h>
-#include <signal.h>
 #include <stdio.h>
 #include <time.h>
 #include <unistd.h>
@@ -111,13 +111,14 @@ void timer_loop_stop() {
 /* The timers job is to run storage function after after INTERVAL_SECONDS time. */
 static void *timer__run(void *thread_arg) {
     int sleep_seconds = (int)LISTEN_SECONDS;
+    struct timeval begin_time, end_time;
 
 #ifndef NDEBUG
     fprintf(stderr, "timer__run: Thread started.\n");
 #endif
 
 #if LISTEN_SECONDS == 0
-    /* Yield once so the other thread gets to initialize its signal handlers */
+    /* Yield once so the capture threads get to join the memory handoff */
     sleep(1);
 #endif /* LISTEN_SECONDS == 0 */
 
@@ -131,12 +132,25 @@ static void *timer__run(void *thread_arg) {
 	sleep_seconds -= 1;
     }
 
-    /* Poke other thread to switch memory */
-    raise(SIGUSR1);
-    sleep(1); /* wait a second to let other thread finish switching memory */
+    /* Hand the other memory to the capture threads and wait until they let
+     * go of ours */
+    util_handoff_publish(timer__memp == timer__memory[0] ? timer__memory[1] : timer__memory[0]);
+    while (util_handoff_wait(UTIL_HANDOFF_TIMEOUT_MS) != 0)
+	fprintf(stderr, "timer__run: Capture threads did not let go of memory %p in %u ms, still waiting.\n",
+		timer__memp, (unsigned)UTIL_HANDOFF_TIMEOUT_MS);
+
+    /* Let the sniffer add the counts it keeps elsewhere */
+    sniff_collect(timer__memp);
 
     /* Delegate the actual writing to storage. */
-    storage_write(time(NULL), FAKE_INTERVAL_SECONDS, timer__memp);
+    if (gettimeofday(&begin_time, NULL) != 0)
+	perror("gettimeofday");
+    storage_write(time(NULL), FAKE_INTERVAL_SECONDS, 1, timer__memp);
+    if (gettimeofday(&end_time, NULL) != 0)
+	perror("gettimeofday");
+    stats_add(STATS_FLUSHES, 1);
+    stats_set(STATS_FLUSH_DURATION_US, (end_time.tv_sec - begin_time.tv_sec) * (uint64_t)1000000
+	    + end_time.tv_usec - begin_time.tv_usec);
 
     /* Reset memory (not needed really, but consistent with a looping timer) */
     memory_reset(timer__memp);
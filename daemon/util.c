@@ -23,7 +23,13 @@ along with LightCount.  If not, see <http://www.gnu.org/licenses/>.
 #include <assert.h>
 #include <signal.h>
 #include <stdio.h>
+#include <stdlib.h>
 #include <string.h>
+#include <unistd.h>
+
+/* Settings */
+#define UTIL__HANDOFF_MAX_THREADS 64	/* capture threads that may join the handoff */
+#define UTIL__HANDOFF_POLL_USECONDS 10	/* check for acknowledgements every N us */
 
 /* Includes for select(2) when usleep(3) is unavailable */
 #if !(_BSD_SOURCE || _XOPEN_SOURCE >= 500)
@@ -47,6 +53,19 @@ void util__signal_helper(int signum) {
 }
 #endif /* !(__USE_POSIX || __USE_BSD) */
 
+/* The memory handoff state of a capture thread. It is padded to a cache line
+ * so the threads don't slow each other down when writing it. */
+struct util__handoff_thread {
+    void *memory;		/* the memory this thread counts in */
+    volatile unsigned seq;	/* the last publication this thread saw */
+    volatile int idle;		/* whether it is outside of the memory */
+    char padding[64 - sizeof(void*) - sizeof(unsigned) - sizeof(int)];
+};
+static void *volatile util__handoff_memory;	/* the published memory */
+static volatile unsigned util__handoff_seq;	/* incremented on every publication */
+static volatile int util__handoff_threads;	/* number of joined threads */
+static struct util__handoff_thread util__handoff_thread[UTIL__HANDOFF_MAX_THREADS];
+
 void util_get_safe_node_name(char *dst, size_t len) {
     struct utsname uname_info;
     char *p;
@@ -123,6 +142,119 @@ char *util_inet_htoa(uint32_t ip4) {
     return static_buf;
 }
 
+static int util__ipfilter_cmp(void const *a, void const *b) {
+    uint32_t const *ra = (uint32_t const*)a, *rb = (uint32_t const*)b;
+    if (ra[0] != rb[0])
+	return ra[0] < rb[0] ? -1 : 1;
+    return ra[1] < rb[1] ? -1 : (ra[1] > rb[1]);
+}
+
+size_t util_ipfilter_coalesce(uint32_t *ranges, size_t count) {
+    size_t src, dst;
+    if (count == 0)
+	return 0;
+
+    /* Sort by begin, then merge every range that overlaps or touches the
+     * previous one. The merged ranges are disjoint and ordered, so they can
+     * be binary searched. */
+    qsort(ranges, count, 2 * sizeof(uint32_t), &util__ipfilter_cmp);
+    for (src = 1, dst = 0; src < count; ++src) {
+	uint32_t begin = ranges[2 * src], end = ranges[2 * src + 1];
+	if (ranges[2 * dst + 1] == 0xffffffff || begin <= ranges[2 * dst + 1] + 1) {
+	    if (end > ranges[2 * dst + 1])
+		ranges[2 * dst + 1] = end;
+	} else {
+	    ++dst;
+	    ranges[2 * dst] = begin;
+	    ranges[2 * dst + 1] = end;
+	}
+    }
+    return dst + 1;
+}
+
+int util_ipfilter_in_range(uint32_t const *ranges, size_t count, uint32_t ip) {
+    size_t low = 0, high = count;
+    /* Find the first range that begins after ip, the one before it is the
+     * only one that may contain ip. */
+    while (low < high) {
+	size_t mid = low + (high - low) / 2;
+	if (ranges[2 * mid] <= ip)
+	    low = mid + 1;
+	else
+	    high = mid;
+    }
+    return low != 0 && ip <= ranges[2 * (low - 1) + 1];
+}
+
+void util_handoff_init(void *memory) {
+    util__handoff_memory = memory;
+    util__handoff_seq = 0;
+    util__handoff_threads = 0;
+    __sync_synchronize();
+}
+
+int util_handoff_join() {
+    int thread = util__handoff_threads;
+    assert(thread < UTIL__HANDOFF_MAX_THREADS);
+    util__handoff_thread[thread].memory = NULL;
+    util__handoff_thread[thread].seq = 0;
+    util__handoff_thread[thread].idle = 1;
+    __sync_synchronize(); /* initialize the slot before the timer looks at it */
+    util__handoff_threads = thread + 1;
+    return thread;
+}
+
+void *util_handoff_poll(int thread) {
+    struct util__handoff_thread *self = &util__handoff_thread[thread];
+    unsigned seq;
+
+    /* Leave the idle state before looking at the sequence. Either we see a
+     * publication or the waiting timer sees that we're busy, never neither. */
+    if (self->idle) {
+	self->idle = 0;
+	__sync_synchronize();
+    }
+    seq = util__handoff_seq;
+    if (self->memory == NULL || self->seq != seq) {
+	__sync_synchronize(); /* finish writing to the old memory before the ack */
+	self->memory = util__handoff_memory;
+	self->seq = seq;
+    }
+    return self->memory;
+}
+
+void util_handoff_idle(int thread) {
+    __sync_synchronize(); /* finish writing to the memory first */
+    util__handoff_thread[thread].idle = 1;
+}
+
+void util_handoff_publish(void *memory) {
+    util__handoff_memory = memory;
+    __sync_add_and_fetch(&util__handoff_seq, 1); /* a full barrier as well */
+}
+
+int util_handoff_wait(unsigned timeout_ms) {
+    unsigned seq = util__handoff_seq;
+    unsigned waited_us = 0;
+    int i = 0;
+
+    /* Every thread must be idle or have seen the publication, after which it
+     * does not touch the previous memory anymore */
+    while (i < util__handoff_threads) {
+	struct util__handoff_thread const *thread = &util__handoff_thread[i];
+	if (thread->idle || thread->seq == seq) {
+	    ++i;
+	    continue;
+	}
+	if (waited_us >= timeout_ms * 1000)
+	    return -1;
+	usleep(UTIL__HANDOFF_POLL_USECONDS);
+	waited_us += UTIL__HANDOFF_POLL_USECONDS;
+    }
+    __sync_synchronize(); /* see everything the threads wrote */
+    return 0;
+}
+
 #if !(_BSD_SOURCE || _XOPEN_SOURCE >= 500)
 int usleep(unsigned usec) {
     struct timeval timeout;
@@ -28,11 +28,16 @@ class Config:
         ''' Supply a file name to read values from. '''
         f = open(filename, 'r')
         d = {
+            'storage_type': 'my',
+            'storage_file': '',
             'storage_host': 'localhost',
             'storage_port': 3306,
             'storage_user': 'root',
             'storage_pass': '',
             'storage_dbase': 'lightcount',
+            'storage_pool_size': 1,
+            'series_cache_dir': '',
+            'series_cache_settle_seconds': 900,
         }
         for line in f:
             k, v = line.split('=', 1)
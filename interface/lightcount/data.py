@@ -16,13 +16,35 @@
 # You should have received a copy of the GNU General Public License
 # along with LightCount.  If not, see <http://www.gnu.org/licenses/>.
 #=======================================================================
-import MySQLdb as db, lightcount, math, re
-from _mysql_exceptions import ProgrammingError
-from time import sleep
-from lightcount import bits
+import fcntl, lightcount, math, numpy, os, re, struct, threading
+from hashlib import sha1
+from time import sleep, time
+from lightcount import bits, downsample
 from lightcount.timeutil import *
 
 
+# The tables holding the samples, keyed by their resolution in seconds. The
+# hour and day tables are rollups of sample_tbl: they hold the sums of the
+# samples in that hour or day (see lightcount.storage_my.sql).
+SAMPLE_TABLES = {
+    lightcount.INTERVAL_SECONDS: 'sample_tbl',
+    3600: 'sample_hour_tbl',
+    86400: 'sample_day_tbl',
+}
+# A rollup is only used if it still yields at least this many samples.
+ROLLUP_MIN_SAMPLES = 1000
+# Pooled connections that have been idle for this many seconds are pinged
+# before they are handed out again.
+POOL_PING_AFTER_SECONDS = 60
+# MySQL client errors after which we reconnect and retry the query once.
+RECONNECT_ERRORS = (
+    2006, # CR_SERVER_GONE_ERROR
+    2013, # CR_SERVER_LOST
+)
+# The values of at most this many queries are summed in one scan over the samples.
+QUERIES_PER_SCAN = 64
+
+
 def mpl_range(begin_date, end_date, interval):
     ''' Does what matplotlib.dates.drange does but does not choke on daylight saving. '''
     from matplotlib.dates import date2num
@@ -35,6 +57,16 @@ def mpl_range(begin_date, end_date, interval):
     return ret
 
 
+def select_percentile(values, percentile):
+    ''' Returns the value that sorting values and taking the percentile would yield, but does it in linear time
+        using a selection algorithm. Values must not contain unknown (None or masked) values. '''
+    values = numpy.array(values, dtype=numpy.int64)
+    if len(values) == 0:
+        return 0L
+    sample = int(math.ceil(len(values) * float(percentile) / 100.0) - 1)
+    return long(numpy.partition(values, sample)[sample])
+
+
 class DataException(Exception):
     pass
 
@@ -43,33 +75,174 @@ class Data(object):
     ''' LightCount data reader. Reads data from the SQL database found in the supplied Config object. '''
 
     class Storage(object):
-        ''' Minor database abstraction. '''
-        def __init__(self, type, host, port, user, passwd, dbase):
-            assert type == 'my', 'Only MySQL storage support is implemented'
-            try: self.conn = db.connect(host=host, port=int(port), user=user, passwd=passwd, db=dbase, connect_timeout=30)
-            except db.OperationalError, e: raise DataException(e)
-
-        def execute(self, *args, **kwargs):
-            cursor = self.conn.cursor()
+        ''' Minor database abstraction. Keeps a pool of at most pool_size idle connections, so it can be shared by
+            several threads. The backends below connect to a database and take care of the differences between
+            the DB-API modules. The queries are written with MySQLdb style %s and %(name)s parameters. '''
+        def __init__(self, module, pool_size=1):
+            self.module = module # the DB-API module, for its exceptions
+            self.pool_size = max(int(pool_size), 1)
+            self.pool = [] # (connection, last use) tuples
+            self.pool_lock = threading.Lock()
+            # Connect right away to report bad settings early
+            self.release(self.connect())
+
+        def connect(self):
+            raise NotImplementedError()
+        def ping(self, conn):
+            pass
+        def cursor(self, conn, unbuffered=False):
+            return conn.cursor()
+        def prepare_query(self, query):
+            return query
+        def explain(self, query, params=None):
+            ''' Returns the query plan of the query as a list of dictionaries, one per row. '''
+            raise NotImplementedError()
+
+        def acquire(self):
+            ''' Returns an idle connection from the pool or a new one. Hand it back with release(). '''
+            self.pool_lock.acquire()
+            try:
+                if not self.pool:
+                    return self.connect()
+                conn, last_use = self.pool.pop()
+            finally:
+                self.pool_lock.release()
+            if last_use + POOL_PING_AFTER_SECONDS < time():
+                try:
+                    self.ping(conn)
+                except self.module.OperationalError:
+                    self.close(conn)
+                    conn = self.connect()
+            return conn
+        def release(self, conn):
+            self.pool_lock.acquire()
+            try:
+                if len(self.pool) < self.pool_size:
+                    self.pool.append((conn, time()))
+                    return
+            finally:
+                self.pool_lock.release()
+            self.close(conn)
+        def close(self, conn):
+            try: conn.close()
+            except self.module.Error: pass
+
+        def execute(self, read, *args, **kwargs):
+            ''' Runs the query and returns read(cursor). The connection goes back to the pool after read() is
+                done with the cursor, so no other thread gets it while the rows are still being fetched. '''
+            conn, cursor = self.execute_acquire(False, *args, **kwargs)
+            try:
+                return read(cursor)
+            finally:
+                cursor.close()
+                self.release(conn)
+        def execute_acquire(self, unbuffered, *args, **kwargs):
+            ''' Runs the query on a cursor of a pooled connection. If the server went away, the query is run once
+                more on a new connection. Returns the connection and the cursor; release() the connection when
+                done with the cursor. '''
+            conn = self.acquire()
             try:
-                cursor.execute(*args, **kwargs)
+                try:
+                    return conn, self.execute_cursor(self.cursor(conn, unbuffered), *args, **kwargs)
+                except self.module.OperationalError, e:
+                    if e.args[0] not in RECONNECT_ERRORS:
+                        raise
+            except:
+                self.release(conn)
+                raise
+            self.close(conn)
+            conn = self.connect()
+            try:
+                return conn, self.execute_cursor(self.cursor(conn, unbuffered), *args, **kwargs)
+            except:
+                self.release(conn)
+                raise
+        def execute_cursor(self, cursor, query, *args, **kwargs):
+            try:
+                cursor.execute(self.prepare_query(query), *args, **kwargs)
             except (KeyboardInterrupt, SystemExit):
                 # Catch a programming error ;)
                 try: cursor.close()
-                except ProgrammingError: cursor.connection = None
+                except self.module.ProgrammingError: cursor.connection = None
                 raise
             return cursor
         def fetch_all(self, *args, **kwargs):
-            cursor = self.execute(*args, **kwargs)
-            return cursor.fetchall()
+            return self.execute(lambda cursor: cursor.fetchall(), *args, **kwargs)
+        def fetch_iter(self, *args, **kwargs):
+            ''' Yields the rows one by one using an unbuffered (server side) cursor, so the result set is never
+                stored client side. The generator holds on to its own connection until it is exhausted or closed. '''
+            conn, cursor = self.execute_acquire(True, *args, **kwargs)
+            try:
+                while True:
+                    rows = cursor.fetchmany(1000)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield row
+            finally:
+                cursor.close()
+                self.release(conn)
         def fetch_atom(self, *args, **kwargs):
             row = self.fetch_atom_row(*args, **kwargs)
             assert len(row) == 1, 'Now exactly one column was returned'
             return row[0]
         def fetch_atom_row(self, *args, **kwargs):
-            cursor = self.execute(*args, **kwargs)
-            assert cursor.rowcount == 1 or cursor.rowcount == -1, 'Not exactly one row was returned'
-            return cursor.fetchone()
+            def read(cursor):
+                assert cursor.rowcount == 1 or cursor.rowcount == -1, 'Not exactly one row was returned'
+                return cursor.fetchone()
+            return self.execute(read, *args, **kwargs)
+
+
+    class MyStorage(Storage):
+        ''' Storage in MySQL (storage_type=my), see lightcount.storage_my.sql. '''
+        def __init__(self, host, port, user, passwd, dbase, pool_size=1):
+            try: import MySQLdb
+            except ImportError: raise DataException('The MySQLdb module is needed for storage_type=my')
+            self.connect_args = {'host': host, 'port': int(port), 'user': user, 'passwd': passwd, 'db': dbase}
+            Data.Storage.__init__(self, MySQLdb, pool_size)
+        def connect(self):
+            try: conn = self.module.connect(connect_timeout=30, **self.connect_args)
+            except self.module.OperationalError, e: raise DataException(e)
+            # Don't let a pooled connection look at an old snapshot
+            conn.autocommit(True)
+            return conn
+        def ping(self, conn):
+            conn.ping()
+        def cursor(self, conn, unbuffered=False):
+            from MySQLdb.cursors import SSCursor
+            return conn.cursor((None, SSCursor)[unbuffered])
+        def explain(self, query, params=None):
+            def read(cursor):
+                names = [column[0] for column in cursor.description]
+                return [dict(zip(names, row)) for row in cursor.fetchall()]
+            return self.execute(read, 'EXPLAIN ' + query, params)
+
+    class SqliteStorage(Storage):
+        ''' Storage in an SQLite database file (storage_type=sqlite), see lightcount.storage_sqlite.sql. Good for
+            a single node that keeps its data locally, or to try the interface without a database server. '''
+        def __init__(self, filename, pool_size=1):
+            import sqlite3
+            if not os.path.exists(filename):
+                raise DataException('SQLite database %s does not exist' % filename)
+            self.filename = filename
+            self.paramre = re.compile(r'%(?:\((\w+)\))?s|%%')
+            Data.Storage.__init__(self, sqlite3, pool_size)
+        def connect(self):
+            # The pool hands the connections to one thread at a time. Autocommit, like the MySQL connections.
+            try: return self.module.connect(self.filename, timeout=30, check_same_thread=False, isolation_level=None)
+            except self.module.OperationalError, e: raise DataException(e)
+        def prepare_query(self, query):
+            # MySQLdb takes %s and %(name)s parameters, sqlite3 takes ? and :name
+            def replace(match):
+                if match.group(0) == '%%': return '%'
+                if match.group(1): return ':' + match.group(1)
+                return '?'
+            return self.paramre.sub(replace, query)
+        def explain(self, query, params=None):
+            def read(cursor):
+                names = [column[0] for column in cursor.description]
+                return [dict(zip(names, row)) for row in cursor.fetchall()]
+            return self.execute(read, 'EXPLAIN QUERY PLAN ' + query, params)
 
 
     class Units(object):
@@ -112,60 +285,179 @@ class Data(object):
             return node_id, self.humnodemap[node_id]
         def canonicalize_vlan(self, vlan):
             return int(vlan), int(vlan)
+        def load_nodes(self):
+            ''' Fills the node caches at once, so canonicalize_node won't need the database afterwards. '''
+            for node_id, node_name in self.storage.fetch_all('SELECT node_id, node_name FROM node_tbl'):
+                self.cannodemap[str(node_name)] = long(node_id)
+                self.humnodemap[long(node_id)] = node_name
 
 
     class ExpressionParser(object):
-        ''' Parser for the custom queries (restrictions) on specific ip's, nets, nodes and vlans. '''
+        ''' Parser for the custom queries (restrictions) on specific ip's, nets, nodes and vlans. The expression is
+            compiled into a tree of column ranges that is simplified before it is written as SQL: nets become ip
+            ranges, overlapping and adjacent ranges are merged and negations are pushed down to the ranges. MySQL
+            can use the ip index for those, where it had to test every sample in the period for (ip & mask) = net. '''
+        # The tree nodes are ('and', [nodes]), ('or', [nodes]), ('const', bool) and ('range', column, begin, end,
+        # is_not). A range matches if begin <= column <= end, or if it does not when is_not is set.
         def __init__(self, units):
             self.units = units
             self.parsere = re.compile(r'(?:(\(|\)|[^\s()]+)\s*)')
 
         def parse(self, expression):
-            ''' Rewrites an expression like 'net 1.2.3.4/5 and not vlan 4' to the appropriate SQL. '''
+            ''' Rewrites an expression like 'net 1.2.3.4/5 and not vlan 4' to the appropriate SQL. Returns the SQL
+                and the canonicalized expression. '''
             if expression == '':
                 return None, 'everything'
-    
-            args, state, is_not, parens, query, human = self.parsere.findall(expression), None, None, 0, [], []
-
-            for arg in args:
-                lowarg = arg.lower()
-                if state == None:
-                    if lowarg == 'not': is_not = not is_not
-                    elif lowarg in ('host', 'ip', 'net', 'node', 'vlan'): state = lowarg
-                    elif lowarg == '(': query.append('(') ; human.append('(') ; parens += 1
-                    else: assert False, 'Unexpected keyword %s' % arg
-                elif state in ('host', 'ip', 'net', 'node', 'vlan'):
-                    cmp_oper, cmp_name = (('=', ''), ('<>', 'not '))[bool(is_not)]
-                    if state == 'host':
-                        ip, humhost = self.units.canonicalize_host4(arg)
-                        query.append('ip %s %s' % (cmp_oper, ip))
-                        human.append('%shost %s' % (cmp_name, humhost))
-                    elif state == 'ip':
-                        ip, humip = self.units.canonicalize_ip4(arg)
-                        query.append('ip %s %s' % (cmp_oper, ip))
-                        human.append('%sip %s' % (cmp_name, humip))
-                    elif state == 'net':
-                        ip, mask, humipmask = self.units.canonicalize_net4(arg)
-                        query.append('(ip & %s) %s %s' % (mask, cmp_oper, ip))
-                        human.append('%snet %s' % (cmp_name, humipmask))
-                    elif state == 'node':
-                        node, humnode = self.units.canonicalize_node(arg)
-                        query.append('node_id %s %s' % (cmp_oper, node))
-                        human.append('%snode %s' % (cmp_name, humnode))
-                    elif state == 'vlan':
-                        vlan, humvlan = self.units.canonicalize_vlan(arg)
-                        query.append('vlan_id %s %s' % (cmp_oper, vlan))
-                        human.append('%svlan %s' % (cmp_name, humvlan))
-                    state, is_not = 'oper', None
-                elif state == 'oper':
-                    if lowarg == ')': assert parens > 0, 'Uneven parentheses' ; query.append(')') ; human.append(')') ; parens -= 1
-                    elif lowarg in ('and', 'or'): query.append(lowarg.upper()) ; human.append(lowarg) ; state = None
-                    else: assert False, 'Unexpected keyword %s' % arg
+            tree, human = self.compile(expression)
+            return self.to_sql(tree), human
+
+        def compile(self, expression):
+            ''' Returns the simplified tree of expression and the canonicalized expression. '''
+            args, human = self.parsere.findall(expression), []
+            tree, pos = self.parse_or(args, 0, human)
+            if pos < len(args):
+                assert args[pos] != ')', 'Uneven parentheses'
+                assert False, 'Unexpected keyword %s' % args[pos]
+            return self.simplify(tree), ' '.join(human)
+
+        def parse_or(self, args, pos, human):
+            nodes = []
+            while True:
+                node, pos = self.parse_and(args, pos, human)
+                nodes.append(node)
+                if pos == len(args) or args[pos].lower() != 'or':
+                    return ('or', nodes), pos
+                human.append('or')
+                pos += 1
+        def parse_and(self, args, pos, human):
+            nodes = []
+            while True:
+                node, pos = self.parse_not(args, pos, human)
+                nodes.append(node)
+                if pos == len(args) or args[pos].lower() != 'and':
+                    return ('and', nodes), pos
+                human.append('and')
+                pos += 1
+        def parse_not(self, args, pos, human):
+            assert pos < len(args), 'Unexpected end of expression'
+            keyword = args[pos].lower()
+            if keyword == 'not':
+                human.append('not')
+                node, pos = self.parse_not(args, pos + 1, human)
+                return self.negate(node), pos
+            if keyword == '(':
+                human.append('(')
+                node, pos = self.parse_or(args, pos + 1, human)
+                assert pos < len(args) and args[pos] == ')', 'Uneven parentheses'
+                human.append(')')
+                return node, pos + 1
+            assert keyword in ('host', 'ip', 'net', 'node', 'vlan'), 'Unexpected keyword %s' % args[pos]
+            assert pos + 1 < len(args), 'Unexpected end of expression'
+            arg = args[pos + 1]
+            if keyword == 'host':
+                ip, humarg = self.units.canonicalize_host4(arg)
+                node = ('range', 'ip', ip, ip, False)
+            elif keyword == 'ip':
+                ip, humarg = self.units.canonicalize_ip4(arg)
+                node = ('range', 'ip', ip, ip, False)
+            elif keyword == 'net':
+                ip, mask, humarg = self.units.canonicalize_net4(arg)
+                node = ('range', 'ip', ip, ip | (~mask & 0xffffffff), False)
+            elif keyword == 'node':
+                node_id, humarg = self.units.canonicalize_node(arg)
+                node = ('range', 'node_id', node_id, node_id, False)
+            elif keyword == 'vlan':
+                vlan, humarg = self.units.canonicalize_vlan(arg)
+                node = ('range', 'vlan_id', vlan, vlan, False)
+            human.append('%s %s' % (keyword, humarg))
+            return node, pos + 2
+
+        def negate(self, node):
+            ''' Returns the negation of node, pushed down to the ranges (De Morgan). '''
+            if node[0] == 'range':
+                return node[:4] + (not node[4],)
+            if node[0] == 'const':
+                return ('const', not node[1])
+            return ({'and': 'or', 'or': 'and'}[node[0]], [self.negate(child) for child in node[1]])
+
+        def simplify(self, node):
+            ''' Flattens nested and/or nodes and merges the ranges on the same column within them. '''
+            if node[0] not in ('and', 'or'):
+                return node
+            op = node[0]
+            # The constant that decides the outcome: true for or, false for and
+            decisive = (op == 'or')
+            flat = []
+            for child in [self.simplify(child) for child in node[1]]:
+                if child[0] == op: flat.extend(child[1])
+                else: flat.append(child)
+            children, spans = [], {}
+            for child in flat:
+                if child[0] == 'const':
+                    if child[1] == decisive:
+                        return child
+                elif child[0] == 'range':
+                    spans.setdefault((child[1], child[4]), []).append(child[2:4])
+                else:
+                    children.append(child)
+            for (column, is_not), column_spans in sorted(spans.items()):
+                if is_not == (op == 'and'):
+                    # x in A or x in B, x not in A and x not in B: x (not) in the union
+                    for begin, end in self.merge_spans(column_spans):
+                        children.append(('range', column, begin, end, is_not))
+                else:
+                    # x in A and x in B, x not in A or x not in B: x (not) in the intersection
+                    begin, end = max([span[0] for span in column_spans]), min([span[1] for span in column_spans])
+                    if begin > end:
+                        return ('const', decisive)
+                    children.append(('range', column, begin, end, is_not))
+            if len(children) == 0:
+                return ('const', not decisive)
+            if len(children) == 1:
+                return children[0]
+            return (op, children)
+
+        def merge_spans(self, spans):
+            ''' Returns the sorted (begin, end) spans with the overlapping and adjacent ones merged. '''
+            merged = []
+            for begin, end in sorted(spans):
+                if merged and begin <= merged[-1][1] + 1:
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], end))
                 else:
-                    assert False, 'Programming error'
+                    merged.append((begin, end))
+            return merged
 
-            assert state is 'oper' and parens == 0 and is_not is None, 'Unexpected end of expression'
-            return ' '.join(query), ' '.join(human)
+        def to_sql(self, node, is_nested=False):
+            ''' Writes the tree as SQL. Single values on the same column are written as one IN list. '''
+            if node[0] == 'const':
+                return ('0', '1')[node[1]]
+            if node[0] == 'range':
+                kind, column, begin, end, is_not = node
+                if begin == end:
+                    return '%s %s %s' % (column, ('=', '<>')[is_not], begin)
+                if not is_not:
+                    return '%s BETWEEN %s AND %s' % (column, begin, end)
+                sql = '%s < %s OR %s > %s' % (column, begin, column, end)
+            else:
+                op, children = node
+                # (not) in lists for x = 1 or x = 2 and x <> 1 and x <> 2
+                values = {}
+                for child in children:
+                    if child[0] == 'range' and child[2] == child[3] and child[4] == (op == 'and'):
+                        values.setdefault(child[1], []).append(child[2])
+                parts = []
+                for child in children:
+                    if child[0] == 'range' and len(values.get(child[1], ())) > 1 and child[2] == child[3] \
+                            and child[4] == (op == 'and'):
+                        if child[2] == values[child[1]][0]:
+                            parts.append('%s %sIN (%s)' % (child[1], ('', 'NOT ')[child[4]],
+                                    ', '.join([str(value) for value in values[child[1]]])))
+                    else:
+                        parts.append(self.to_sql(child, True))
+                sql = (' %s ' % op.upper()).join(parts)
+            if is_nested:
+                return '(%s)' % sql
+            return sql
 
 
     class Period(object):
@@ -207,24 +499,195 @@ class Data(object):
             return self.canonical_end_date() - self.canonical_begin_date()
         def get_tzinfo(self):
             return self.begin_date.tzinfo
+        def get_resolution(self):
+            ''' Returns the coarsest sample resolution (in seconds) that still yields enough samples for this
+                period. The month period always uses the raw samples, because its billing value needs them. '''
+            if self.period == 'month':
+                return lightcount.INTERVAL_SECONDS
+            interval = self.get_interval()
+            for resolution in sorted(SAMPLE_TABLES.keys(), reverse=True):
+                if interval / resolution >= ROLLUP_MIN_SAMPLES:
+                    return resolution
+            return lightcount.INTERVAL_SECONDS
         def get_sample_times(self):
-            return range(self.canonical_begin_date(), self.canonical_end_date() + 1, lightcount.INTERVAL_SECONDS)
+            # The rollups are aligned on UTC hours/days, so the first sample may be before the begin date.
+            resolution = self.get_resolution()
+            begin_date = self.canonical_begin_date()
+            return range(begin_date - begin_date % resolution, self.canonical_end_date() + 1, resolution)
         def get_mpl_sample_times(self):
             # A bit of a hack: the data points are stored at the begin of the interval, but the usage is in the
             # middle. Returning the data points offset by half the interval yields more correct graphs
             # but this is only desirable for high resolution images (few data points).
-            if self.is_high_res(): offset = timedelta(seconds=lightcount.INTERVAL_SECONDS/2)
+            resolution = self.get_resolution()
+            if self.is_high_res(): offset = timedelta(seconds=resolution/2)
             else: offset = timedelta(seconds=0)
-            return mpl_range(self.begin_date + offset, self.end_date + offset + timedelta(seconds=1), timedelta(seconds=lightcount.INTERVAL_SECONDS))
+            begin_date = self.begin_date - timedelta(seconds=self.canonical_begin_date() % resolution)
+            return mpl_range(begin_date + offset, self.end_date + offset + timedelta(seconds=1), timedelta(seconds=resolution))
         def is_high_res(self):
             return self.period in ('3h', '12h')
         def __str__(self):
             return '<period (%s) between %s and %s>' % (self.period, self.begin_date, self.end_date)
 
             
+    class Summary(object):
+        ''' Totals of samples per key (ip, node_id or vlan_id). The totals are kept in numpy arrays sorted by key,
+            the distinct nodes and vlans per key are kept as sorted arrays of (key, node/vlan) pairs. '''
+        def __init__(self, key):
+            assert key in ('ip', 'node_id', 'vlan_id'), 'Cannot summarize by %s' % key
+            self.key_column = ('node_id', 'vlan_id', 'ip').index(key)
+            self.keys = numpy.zeros(0, dtype=numpy.int64)
+            self.sums = numpy.zeros((0, 4), dtype=numpy.int64) # in_pps, in_bps, out_pps, out_bps
+            self.node_pairs = numpy.zeros(0, dtype=numpy.uint64) # key << 32 | node_id (an ip key needs all 64 bits)
+            self.vlan_pairs = numpy.zeros(0, dtype=numpy.int64) # key << 12 | vlan_id
+            self.pending = [] # the added rows, merged into the totals when they are read
+        def add(self, rows):
+            ''' Adds (node_id, vlan_id, ip, in_pps, in_bps, out_pps, out_bps) rows to the totals. '''
+            if len(rows):
+                self.pending.append(numpy.array(rows, dtype=numpy.int64))
+        def merge(self):
+            ''' Merges the added rows into the totals, all at once. '''
+            if not self.pending:
+                return
+            rows = numpy.concatenate(self.pending)
+            self.pending = []
+            keys = rows[:, self.key_column]
+            self.keys, inverse = numpy.unique(numpy.concatenate((self.keys, keys)), return_inverse=True)
+            sums = numpy.zeros((len(self.keys), 4), dtype=numpy.int64)
+            numpy.add.at(sums, inverse, numpy.concatenate((self.sums, rows[:, 3:])))
+            self.sums = sums
+            self.node_pairs = numpy.union1d(self.node_pairs, (keys.astype(numpy.uint64) << 32) | rows[:, 0].astype(numpy.uint64))
+            self.vlan_pairs = numpy.union1d(self.vlan_pairs, (keys << 12) | rows[:, 1])
+        def get_rows(self, count=None):
+            ''' Returns (key, nodes, vlans, in_pps, in_bps, out_pps, out_bps) tuples ordered by bytes (in + out),
+                highest first. Pass count to get only the top count rows. '''
+            self.merge()
+            totals = self.sums[:, 1] + self.sums[:, 3]
+            order = numpy.arange(len(totals))
+            if count is not None and count < len(totals):
+                order = numpy.argpartition(-totals, count - 1)[:count] # select the top count in linear time
+            order = order[numpy.argsort(-totals[order], kind='mergesort')]
+            nodes = numpy.bincount(numpy.searchsorted(self.keys, (self.node_pairs >> 32).astype(numpy.int64)), minlength=len(self.keys))
+            vlans = numpy.bincount(numpy.searchsorted(self.keys, self.vlan_pairs >> 12), minlength=len(self.keys))
+            return [(long(self.keys[i]), int(nodes[i]), int(vlans[i])) + tuple([long(v) for v in self.sums[i]])
+                    for i in order]
+
+
+    class SeriesCache(object):
+        ''' Keeps the samples of every query and resolution in files in directory, so the values of an open period
+            only need the samples after the last cached one from the database. A file holds a header and the
+            summed sample rows for one consecutive range of sample times, from origin up to (not including) the
+            high-water mark origin + count * resolution. Disjoint periods of a query get files of their own, which
+            are merged once a range grows into the next one. Only samples older than settle_seconds (after the end
+            of their interval) are kept: younger ones may still change. Remove the files after changing old
+            samples in the database. '''
+        MAGIC = 'LCSERIES'
+        HEADER = struct.Struct('<8sIIqq') # magic, version, resolution, origin, count
+        HEADER_SIZE = 64 # rows start here
+        ROW_COLUMNS = 4 # in_pps, out_pps, in_bps, out_bps (sums, like the rollups)
+
+        def __init__(self, directory, settle_seconds):
+            self.directory = directory
+            self.settle_seconds = settle_seconds
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        def get_prefix(self, query, resolution):
+            return os.path.join(self.directory, sha1('%d %s' % (resolution, query or '')).hexdigest())
+
+        def get_rows(self, query, resolution, sample_times, fetch_rows):
+            ''' Returns the (unixtime, in_pps, out_pps, in_bps, out_bps) rows for every time in sample_times, which
+                must be consecutive. The rows after the high-water mark are fetched with fetch_rows(begin_date),
+                which returns the rows from begin_date up to the end of the period. '''
+            prefix = self.get_prefix(query, resolution)
+            lock = open(prefix + '.lock', 'a')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                ranges = self.read_ranges(prefix, resolution)
+                # Use the range the period starts in (or right after), or start a new one
+                for origin, count, filename in ranges:
+                    if origin <= sample_times[0] <= origin + count * resolution:
+                        break
+                else:
+                    origin, count, filename = sample_times[0], 0, '%s.%d.series' % (prefix, sample_times[0])
+                ranges = [r for r in ranges if r[0] > origin]
+                file = open(filename, 'r+b' if count else 'w+b')
+                try:
+                    high_water = origin + count * resolution
+                    rows = numpy.zeros((len(sample_times), 1 + self.ROW_COLUMNS), dtype=numpy.int64)
+                    rows[:, 0] = sample_times
+                    cached = min(len(sample_times), (high_water - sample_times[0]) / resolution)
+                    if cached > 0:
+                        first = (sample_times[0] - origin) / resolution
+                        rows[:cached, 1:] = self.map_rows(file, first + cached)[first:]
+                    if cached < len(sample_times):
+                        fetched = numpy.array(fetch_rows(sample_times[cached]), dtype=numpy.int64)
+                        if len(fetched):
+                            rows[(fetched[:, 0] - sample_times[0]) / resolution, 1:] = fetched[:, 1:]
+
+                    # Append the samples that won't change anymore
+                    settled = time() - resolution - self.settle_seconds
+                    append = rows[cached:][rows[cached:, 0] < settled][:, 1:]
+                    # Take over the rows of the later ranges that we reached
+                    high_water += len(append) * resolution
+                    for next_origin, next_count, next_filename in ranges:
+                        if next_origin > high_water:
+                            break
+                        skip = (high_water - next_origin) / resolution
+                        if skip < next_count:
+                            next_file = open(next_filename, 'rb')
+                            try:
+                                append = numpy.concatenate((append, self.map_rows(next_file, next_count, 'r')[skip:]))
+                            finally:
+                                next_file.close()
+                            high_water += (next_count - skip) * resolution
+                        os.unlink(next_filename)
+                    if len(append):
+                        file.truncate(self.HEADER_SIZE + (count + len(append)) * self.ROW_COLUMNS * 8)
+                        self.map_rows(file, count + len(append))[count:] = append
+                        count += len(append)
+                    self.write_header(file, resolution, origin, count)
+                    return rows
+                finally:
+                    file.close()
+            finally:
+                lock.close() # releases the lock
+        def read_ranges(self, prefix, resolution):
+            ''' Returns the (origin, count, filename) of the cached ranges of prefix, ordered by origin. '''
+            ranges = []
+            for name in os.listdir(self.directory):
+                filename = os.path.join(self.directory, name)
+                if filename.startswith(prefix + '.') and name.endswith('.series'):
+                    file = open(filename, 'rb')
+                    try:
+                        origin, count = self.read_header(file, resolution)
+                    finally:
+                        file.close()
+                    if origin is not None:
+                        ranges.append((origin, count, filename))
+            ranges.sort()
+            return ranges
+        def read_header(self, file, resolution):
+            ''' Returns the origin and count of the rows in file, or None and 0 if it holds none. '''
+            file.seek(0)
+            header = file.read(self.HEADER.size)
+            if len(header) != self.HEADER.size:
+                return None, 0
+            magic, version, file_resolution, origin, count = self.HEADER.unpack(header)
+            if magic != self.MAGIC or version != 1 or file_resolution != resolution:
+                return None, 0
+            return origin, count
+        def write_header(self, file, resolution, origin, count):
+            file.seek(0)
+            file.write(self.HEADER.pack(self.MAGIC, 1, resolution, origin, count).ljust(self.HEADER_SIZE, '\0'))
+            file.truncate(self.HEADER_SIZE + count * self.ROW_COLUMNS * 8)
+        def map_rows(self, file, count, mode='r+'):
+            return numpy.memmap(file, dtype=numpy.int64, mode=mode, offset=self.HEADER_SIZE, shape=(count, self.ROW_COLUMNS))
+
+
     class Result(object):
-        def __init__(self, storage, expression_parser, query, period): # append calc_95p option here
+        def __init__(self, storage, expression_parser, query, period, series_cache=None): # append calc_95p option here
             self.storage = storage
+            self.series_cache = series_cache
+            self.siblings = [] # the results of the same parse_queries() call
             self.query, self.human_query = expression_parser.parse(query)
             self.period = period
             self.values = None
@@ -234,106 +697,138 @@ class Data(object):
             return self.period
         def load_values(self):
             if self.values is None:
-                self.values = self.get_values_from_db()
+                # Load the values of the other results of the query list along with ours, in one scan. (Unless they
+                # are cached: then only the samples after the cached ones are fetched, per result.)
+                siblings = [result for result in self.siblings if result.values is None and result is not self]
+                if siblings and self.series_cache is None:
+                    Data.Result.load_values_combined([self] + siblings[:QUERIES_PER_SCAN - 1])
+                else:
+                    self.values = self.get_values_from_db()
         def get_values_from_db(self):
-            ''' Get values from database. '''
+            ''' Get values from database. Uses the coarsest rollup table that suits the period. With a series cache,
+                only the samples it does not have yet are fetched. '''
+            if self.series_cache is not None:
+                values = self.series_cache.get_rows(self.query, self.period.get_resolution(),
+                        self.period.get_sample_times(),
+                        lambda begin_date: self.storage.fetch_all(*self.get_values_query(begin_date)))
+            else:
+                values = self.storage.fetch_all(*self.get_values_query())
+            return self.get_values_from_rows(values)
+        def get_values_query(self, begin_date=None):
+            ''' Returns the query and its parameters that get_values_from_db runs. Pass begin_date to get only the
+                samples from begin_date on. '''
+            resolution = self.period.get_resolution()
+            sample_times = self.period.get_sample_times()
             # Create query (MySQLdb does not like %i/%d... %s should work fine though)
             # Get "inclusive" end_date.. we want both fence posts on the graph.
             q = ['''SELECT unixtime, SUM(in_pps), SUM(out_pps), SUM(in_bps), SUM(out_bps)
-                    FROM sample_tbl
-                    WHERE (%(begin_date)s <= unixtime AND unixtime <= %(end_date)s)''']
-            d = {'begin_date': self.period.canonical_begin_date(), 'end_date': self.period.canonical_end_date()}
+                    FROM %s
+                    WHERE (%%(begin_date)s <= unixtime AND unixtime <= %%(end_date)s)''' % SAMPLE_TABLES[resolution]]
+            d = {'begin_date': sample_times[0], 'end_date': self.period.canonical_end_date()}
+            if begin_date is not None:
+                d['begin_date'] = begin_date
             # Add optional query restrictions
             if self.query != None:
                 q.append('AND (%s)' % self.query)
             # Add query order
             q.append('''GROUP BY unixtime ORDER BY unixtime''')
-            # Execute query
-            values = self.storage.fetch_all(' '.join(q), d)
             #print '\n(', re.sub(r'\s+', ' ', ' '.join(q) % d), ' -- ', self.human_query, ')\n'
+            return ' '.join(q), d
+        def get_values_from_rows(self, values):
+            ''' Converts the (unixtime, in_pps, out_pps, in_bps, out_bps) rows from the database to the values: a
+                masked array with those five columns and one row for every sample time. Unknown values are masked. '''
+            resolution = self.period.get_resolution()
+            sample_times = numpy.array(self.period.get_sample_times(), dtype=numpy.int64)
             # Make sure every sample in the period interval exists (0 if not found).
-            # We can't predict the future, so we add None's after now.
-            now = time() - 1.5 * lightcount.INTERVAL_SECONDS # multiply by 1.5 to allow for some clock skew
-            new_values = [
-                (long(t), (0L, None)[t >= now], (0L, None)[t >= now], (0L, None)[t >= now], (0L, None)[t >= now])
-                for t in self.period.get_sample_times()
-            ]
-            i = 0
-            for t, in_pps, out_pps, in_bps, out_bps in values:
-                while new_values[i][0] < t: i += 1
-                assert new_values[i][0] == t
-                new_values[i] = (long(t), long(in_pps), long(out_pps), long(in_bps), long(out_bps))
+            new_values = numpy.zeros((len(sample_times), 5), dtype=numpy.int64)
+            new_values[:, 0] = sample_times
+            if len(values):
+                # The rollups hold sums of samples, divide them (rounded) to get the averages.
+                samples = resolution / lightcount.INTERVAL_SECONDS
+                values = numpy.array(values, dtype=numpy.int64)
+                index = (values[:, 0] - sample_times[0]) / resolution
+                assert (sample_times[index] == values[:, 0]).all()
+                new_values[index, 1:] = (values[:, 1:] + samples / 2) / samples
+            # We can't predict the future, so we mask the values after now. A rollup sample is only
+            # complete when its last raw sample is in.
+            now = time() - resolution - 0.5 * lightcount.INTERVAL_SECONDS # add 0.5 to allow for some clock skew
+            mask = numpy.zeros(new_values.shape, dtype=bool)
+            mask[sample_times >= now, 1:] = True
             # Return the values
-            return new_values
+            return numpy.ma.array(new_values, mask=mask)
+
+        def load_values_combined(result_list, queries_per_scan=QUERIES_PER_SCAN):
+            ''' Loads the values of all results in result_list (which must share the same period) with one scan over
+                the samples for every queries_per_scan results, instead of one scan per result. '''
+            result_list = [result for result in result_list if result.values is None]
+            for i in range(0, len(result_list), queries_per_scan):
+                batch = result_list[i:i + queries_per_scan]
+                period = batch[0].period
+                assert len([r for r in batch if r.period is not period]) == 0, 'All results must share the period'
+                sample_times = period.get_sample_times()
+                # Sum the values for every query in separate columns (no query matches everything)
+                matches = [result.query or '1' for result in batch]
+                columns = []
+                for match in matches:
+                    for column in ('in_pps', 'out_pps', 'in_bps', 'out_bps'):
+                        columns.append('SUM(CASE WHEN %s THEN %s ELSE 0 END)' % (match, column))
+                q = ['''SELECT unixtime, %s
+                        FROM %s
+                        WHERE (%%(begin_date)s <= unixtime AND unixtime <= %%(end_date)s)''' % (
+                            ', '.join(columns), SAMPLE_TABLES[period.get_resolution()])]
+                d = {'begin_date': sample_times[0], 'end_date': period.canonical_end_date()}
+                if '1' not in matches:
+                    q.append('AND ((%s))' % ') OR ('.join(matches))
+                q.append('''GROUP BY unixtime ORDER BY unixtime''')
+                values = batch[0].storage.fetch_all(' '.join(q), d)
+                for n, result in enumerate(batch):
+                    result.values = result.get_values_from_rows([(row[0],) + tuple(row[4 * n + 1:4 * n + 5]) for row in values])
+        load_values_combined = staticmethod(load_values_combined)
 
         def get_times(self):
             if 'times' not in self.cache:
                 self.load_values()
-                self.cache['times'] = tuple([t for t, _, _, _, _ in self.values])
+                self.cache['times'] = self.values[:, 0].data
             return self.cache['times']
 
         def get_in_bps(self):
             if 'in_bps' not in self.cache:
                 self.load_values()
-                in_bps = [i for t, _, _, i, o in self.values]
-                for i in range(len(in_bps)):
-                    if in_bps[i] is not None: in_bps[i] <<= 3 # bits => *8
-                self.cache['in_bps'] = tuple(in_bps)
+                self.cache['in_bps'] = self.values[:, 3] * 8 # bits => *8
             return self.cache['in_bps']
         def get_out_bps(self):
             if 'out_bps' not in self.cache:
                 self.load_values()
-                out_bps = [o for t, _, _, i, o in self.values]
-                for i in range(len(out_bps)):
-                    if out_bps[i] is not None: out_bps[i] <<= 3 # bits => *8
-                self.cache['out_bps'] = tuple(out_bps)
+                self.cache['out_bps'] = self.values[:, 4] * 8 # bits => *8
             return self.cache['out_bps']
         def get_io_bps(self):
             if 'io_bps' not in self.cache:
-                self.load_values()
-                io_bps = []
-                input, output = self.get_in_bps(), self.get_out_bps()
-                for i in range(len(input)):
-                    if input[i] is None or output[i] is None: io_bps.append(None)
-                    else: io_bps.append(input[i] + output[i])
-                self.cache['io_bps'] = tuple(io_bps)
+                self.cache['io_bps'] = self.get_in_bps() + self.get_out_bps()
             return self.cache['io_bps']
 
         def get_in_pps(self):
             if 'in_pps' not in self.cache:
                 self.load_values()
-                self.cache['in_pps'] = tuple([i for t, i, o, _, _ in self.values])
+                self.cache['in_pps'] = self.values[:, 1]
             return self.cache['in_pps']
         def get_out_pps(self):
             if 'out_pps' not in self.cache:
                 self.load_values()
-                self.cache['out_pps'] = tuple([o for t, i, o, _, _ in self.values])
+                self.cache['out_pps'] = self.values[:, 2]
             return self.cache['out_pps']
         def get_io_pps(self):
             if 'io_pps' not in self.cache:
-                self.load_values()
-                io_pps = []
-                input, output = self.get_in_pps(), self.get_out_pps()
-                for i in range(len(input)):
-                    if input[i] is None or output[i] is None: io_pps.append(None)
-                    else: io_pps.append(input[i] + output[i])
-                self.cache['io_pps'] = tuple(io_pps)
+                self.cache['io_pps'] = self.get_in_pps() + self.get_out_pps()
             return self.cache['io_pps']
 
         def get_max_io_bps(self):
-            io_bps = max(self.get_io_bps())
-            self.load_values()
-            for t, _, _, i, o in self.values:
-                if (i + o) << 3 == io_bps:
-                    return datetime.fromtimestamp(t, self.period.get_tzinfo()), i << 3, o << 3
-            assert False, 'Programming error'
+            i = self.get_io_bps().filled(0).argmax()
+            return datetime.fromtimestamp(self.get_times()[i], self.period.get_tzinfo()), \
+                    long(self.get_in_bps().filled(0)[i]), long(self.get_out_bps().filled(0)[i])
         def get_max_io_pps(self):
-            io_pps = max(self.get_io_pps())
-            self.load_values()
-            for t, i, o, _, _ in self.values:
-                if i + o == io_pps:
-                    return datetime.fromtimestamp(t, self.period.get_tzinfo()), i, o
-            assert False, 'Programming error'
+            i = self.get_io_pps().filled(0).argmax()
+            return datetime.fromtimestamp(self.get_times()[i], self.period.get_tzinfo()), \
+                    long(self.get_in_pps().filled(0)[i]), long(self.get_out_pps().filled(0)[i])
             
         def get_billing_values(self):
             if self.period.get_period() != 'month': return None
@@ -342,37 +837,27 @@ class Data(object):
 
                 estimate = self.period.get_end_date() > self.period.get_now()
 
-                results = [] # holds in/out
-                for y in (list(self.get_in_bps()), list(self.get_out_bps())):
-                    if not estimate:
-                        # drop fencepost for next month
-                        y.pop()
-                    else:
-                        # drop all future values
-                        for i in range(self.period.canonical_now(), self.period.canonical_end_date(), lightcount.INTERVAL_SECONDS):
-                            y.pop()
-                    y.sort()
-                    results.append(y)
-
-                sample95 = int(math.ceil(len(results[0]) * float(self.billing_percentile) / 100.0) - 1)
-                yin95, yout95 = results[0][sample95], results[1][sample95]
-                if yin95 is None: yin95 = 0L
-                if yout95 is None: yout95 = 0L
-                self.cache['billing_value'] = (yin95, yout95, estimate)
+                samples = len(self.get_times())
+                if not estimate:
+                    # drop fencepost for next month
+                    samples -= 1
+                else:
+                    # drop all future values
+                    samples -= len(range(self.period.canonical_now(), self.period.canonical_end_date(), lightcount.INTERVAL_SECONDS))
+
+                # Unknown values would be sorted first, so they are the same as zeroes here
+                results = [select_percentile(y[:samples].filled(0), self.billing_percentile)
+                           for y in (self.get_in_bps(), self.get_out_bps())] # holds in/out
+
+                self.cache['billing_value'] = (results[0], results[1], estimate)
             return self.cache['billing_value']
 
         def get_totals(self):
             if 'totals' not in self.cache:
                 self.load_values()
-                totals = {'in_packets': 0, 'in_bytes': 0, 'out_packets': 0, 'out_bytes': 0}
-                for t, ip, op, ib, ob in self.values:
-                    if ip is not None: totals['in_packets'] += ip
-                    if ib is not None: totals['in_bytes'] += ib
-                    if op is not None: totals['out_packets'] += op
-                    if ob is not None: totals['out_bytes'] += ob
-                for k, v in totals.iteritems():
-                    totals[k] = v * lightcount.INTERVAL_SECONDS
-                self.cache['totals'] = totals
+                in_packets, out_packets, in_bytes, out_bytes = self.values[:, 1:].filled(0).sum(axis=0) * self.period.get_resolution()
+                self.cache['totals'] = {'in_packets': long(in_packets), 'in_bytes': long(in_bytes),
+                                        'out_packets': long(out_packets), 'out_bytes': long(out_bytes)}
             return self.cache['totals']
 
         def __str__(self):
@@ -381,9 +866,18 @@ class Data(object):
 
     def __init__(self, config):
         ''' Supply a Config object to get configuration from. '''
-        self.storage = Data.Storage('my', config.storage_host, config.storage_port, config.storage_user, config.storage_pass, config.storage_dbase)
+        if config.storage_type == 'my':
+            self.storage = Data.MyStorage(config.storage_host, config.storage_port, config.storage_user,
+                    config.storage_pass, config.storage_dbase, config.storage_pool_size)
+        elif config.storage_type == 'sqlite':
+            self.storage = Data.SqliteStorage(config.storage_file, config.storage_pool_size)
+        else:
+            raise DataException('Unknown storage_type %s, use my or sqlite' % config.storage_type)
         self.units = Data.Units(self.storage)
         self.expparser = Data.ExpressionParser(self.units)
+        self.series_cache = None
+        if config.series_cache_dir:
+            self.series_cache = Data.SeriesCache(config.series_cache_dir, int(config.series_cache_settle_seconds))
 
     def parse_period(self, begin_date=None, end_date=None, period=None, time_zone=None):
         return Data.Period(begin_date=begin_date, end_date=end_date, period=period, time_zone=time_zone)
@@ -392,9 +886,44 @@ class Data(object):
         queries = queries or ['']
         result_list = []
         for query in queries:
-            result_list.append(Data.Result(self.storage, self.expparser, query, period))
+            result_list.append(Data.Result(self.storage, self.expparser, query, period, self.series_cache))
+        for result in result_list:
+            result.siblings = result_list
         return result_list
 
+    def explain(self, result):
+        ''' Returns the rows of the query plan of the query that loads the values of result, as dictionaries. For
+            MySQL their key column shows the index the query uses, for SQLite their detail column does. '''
+        return self.storage.explain(*result.get_values_query())
+
+    def get_billing_values(self, period, queries, progress_callback=None, queries_per_scan=QUERIES_PER_SCAN):
+        ''' Returns a list of (result, (in_bps, out_bps, estimate)) tuples with the 95th percentile billing values for
+            every query over the (month) period. The samples are fetched for queries_per_scan queries at a time. '''
+        assert period.get_period() == 'month', 'Billing values are only calculated over a month'
+        result_list = self.parse_queries(period=period, queries=queries)
+        for i in range(0, len(result_list), queries_per_scan):
+            if progress_callback:
+                progress_callback(i, len(result_list))
+            batch = result_list[i:i + queries_per_scan]
+            Data.Result.load_values_combined(batch, queries_per_scan=queries_per_scan)
+            for result in batch:
+                # Keep only the billing value, drop the samples to save memory
+                result.cache = {'billing_value': result.get_billing_values()}
+                result.values = None
+        if progress_callback:
+            progress_callback(len(result_list), len(result_list))
+        return [(result, result.get_billing_values()) for result in result_list]
+
+    def summarize_billing(self, period, queries, dest_file, progress_callback=None):
+        ''' Writes the 95th percentile billing values (in bit/s) of every query over the (month) period to
+            dest_file as CSV. '''
+        dest_file.write('query,in_bps,out_bps,billing_bps,estimate\n')
+        for result, (in_bps, out_bps, estimate) in self.get_billing_values(period, queries, progress_callback):
+            dest_file.write('"%s",%d,%d,%d,%d\n' % (
+                result.human_query.replace('"', '""'),
+                in_bps, out_bps, max(in_bps, out_bps), estimate
+            ))
+
     def serialize(self, result, dest_file, progress_callback=None):
         where = ''
         if result.query: where = 'AND (%s)' % result.query
@@ -412,12 +941,15 @@ class Data(object):
         end_date = result.get_period().canonical_end_date()
         seconds_at_a_time = 3 * 3600
 
+        # The rows are streamed from the database, so we can't look up node names while reading them
+        self.units.load_nodes()
+
         # Use a smaller period and several queries to get our results
         dest_file.write('unixtime,node,vlan,ip,in_pps,in_bps,out_pps,out_bps\n')
         for date in range(begin_date, end_date, seconds_at_a_time): # [begin_date, end_date)
             if progress_callback:
                 progress_callback(date - begin_date, end_date - begin_date)
-            for row in self.storage.fetch_all(query, {'begin_date': date, 'end_date': min(end_date, date + seconds_at_a_time)}):
+            for row in self.storage.fetch_iter(query, {'begin_date': date, 'end_date': min(end_date, date + seconds_at_a_time)}):
                 dest_file.write('%d,"%s",%d,"%s",%d,%d,%d,%d\n' % (
                     row[0],
                     self.units.canonicalize_node(row[1])[1].replace('"', '""'),
@@ -425,68 +957,117 @@ class Data(object):
                     self.units.canonicalize_ip4(row[3])[1].replace('"', '""'),
                     row[4], row[5], row[6], row[7]
                 ))
-                # Be friendly to the database, and increase chance that new data can get written
-                sleep(0) # sleep 0 behaves like yield
+            # Be friendly to the database, and increase chance that new data can get written. (Not while
+            # streaming the rows: the server keeps the table locked until we've read them all.)
+            sleep(0) # sleep 0 behaves like yield
         if progress_callback:
             progress_callback(end_date - begin_date, end_date - begin_date)
 
-    def summarize_ip(self, result, dest_file, progress_callback=None):
+    def serialize_series(self, result_list, dest_file, buckets=640):
+        ''' Writes the bit/s and packet/s series of the results (which must share the same period) to dest_file as
+            JSON. Every series is reduced to at most buckets buckets with the minimum, maximum and average of their
+            samples, so the peaks survive. Unknown values are written as null. '''
+        import json
+        period = result_list[0].get_period()
+        times = result_list[0].get_times()
+        size = downsample.bucket_size(len(times), buckets)
+        document = {
+            'period': period.get_period(),
+            'begin_date': period.canonical_begin_date(),
+            'end_date': period.canonical_end_date(),
+            'resolution': period.get_resolution() * size, # seconds per bucket
+            'times': [long(t) for t in times[::size]], # begin of every bucket
+            'series': [],
+        }
+        for result in result_list:
+            series = {'query': result.human_query}
+            for name, values in (('in_bps', result.get_in_bps()), ('out_bps', result.get_out_bps()),
+                                 ('in_pps', result.get_in_pps()), ('out_pps', result.get_out_pps())):
+                mins, maxs, avgs = downsample.minmaxavg(values, size)[:3]
+                series[name] = {'min': mins.tolist(), 'max': maxs.tolist(), 'avg': numpy.ma.round(avgs).astype(numpy.int64).tolist()}
+            document['series'].append(series)
+        json.dump(document, dest_file, sort_keys=True)
+        dest_file.write('\n')
+
+    def summarize(self, result, key, progress_callback=None):
+        ''' Returns a Data.Summary with the totals per key ('ip', 'node_id' or 'vlan_id') of the samples that match
+            the result query over its period: the samples whose interval overlaps it, like the stat totals (but
+            without the sample at the end date). The aligned middle of the period is read from the rollup tables,
+            the edges from the finer tables, in one streamed query per table. '''
+        begin_date = result.get_period().canonical_begin_date()
+        end_date = result.get_period().canonical_end_date()
+
         where = ''
         if result.query: where = 'AND (%s)' % result.query
 
-        # We do node_id => node_name and ip => dotted-ip conversion in python
-        # to save bandwidth and sql resources
+        # Only group by ip if we need to
         query = '''
-            SELECT node_id, vlan_id, ip, SUM(in_pps), SUM(in_bps), SUM(out_pps), SUM(out_bps)
-            FROM sample_tbl
-            WHERE (%%(begin_date)s <= unixtime AND unixtime < %%(end_date)s) %s
-            GROUP BY node_id, vlan_id, ip
-        ''' % where
-
-        begin_date = result.get_period().canonical_begin_date()
-        end_date = result.get_period().canonical_end_date()
-        seconds_at_a_time = 3 * 3600
+            SELECT node_id, vlan_id, %s, SUM(in_pps), SUM(in_bps), SUM(out_pps), SUM(out_bps)
+            FROM %%s
+            WHERE (%%%%(begin_date)s <= unixtime AND unixtime < %%%%(end_date)s) %s
+            GROUP BY node_id, vlan_id%s
+        ''' % (('0', 'ip')[key == 'ip'], where, ('', ', ip')[key == 'ip'])
 
-        # Use a smaller period and several queries to get our results
-        # Store the results in a temporary dictionary
-        results = {}
-        for date in range(begin_date, end_date, seconds_at_a_time): # [begin_date, end_date)
+        # Collect the rows a chunk at a time, the summary merges them once
+        ranges = Data.split_sample_range(begin_date - begin_date % lightcount.INTERVAL_SECONDS,
+                end_date + (-end_date % lightcount.INTERVAL_SECONDS))
+        summary = Data.Summary(key)
+        for i, (resolution, range_begin, range_end) in enumerate(ranges):
             if progress_callback:
-                progress_callback(date - begin_date, 1.1 * (end_date - begin_date))
-            for row in self.storage.fetch_all(query, {'begin_date': date, 'end_date': min(end_date, date + seconds_at_a_time)}):
-                if row[2] not in results:
-                    results[row[2]] = [set(), set(), 0, 0, 0, 0]
-                results[row[2]][0].add(row[0])
-                results[row[2]][1].add(row[1])
-                results[row[2]][2] += row[3]
-                results[row[2]][3] += row[4]
-                results[row[2]][4] += row[5]
-                results[row[2]][5] += row[6]
-                # Be friendly to the database, and increase chance that new data can get written
-                sleep(0) # sleep 0 behaves like yield
+                progress_callback(i, len(ranges))
+            rows = []
+            for row in self.storage.fetch_iter(query % SAMPLE_TABLES[resolution],
+                                               {'begin_date': range_begin, 'end_date': range_end}):
+                rows.append(row)
+                if len(rows) == 10000:
+                    summary.add(rows)
+                    rows = []
+            summary.add(rows)
         if progress_callback:
-            progress_callback(end_date - begin_date, 1.1 * (end_date - begin_date))
+            progress_callback(len(ranges), len(ranges))
+        return summary
+
+    @staticmethod
+    def split_sample_range(begin_date, end_date):
+        ''' Splits the sample times [begin_date, end_date) (aligned on INTERVAL_SECONDS) into (resolution, begin,
+            end) ranges: the coarsest rollup that fits in the middle, finer ones towards the edges. '''
+        ranges, pending = [], [(begin_date, end_date)]
+        for resolution in sorted(SAMPLE_TABLES.keys(), reverse=True):
+            edges = []
+            for range_begin, range_end in pending:
+                aligned_begin = range_begin + (-range_begin % resolution)
+                aligned_end = range_end - range_end % resolution
+                if aligned_begin < aligned_end:
+                    ranges.append((resolution, aligned_begin, aligned_end))
+                    edges.extend([(range_begin, aligned_begin), (aligned_end, range_end)])
+                else:
+                    edges.append((range_begin, range_end))
+            pending = [(range_begin, range_end) for range_begin, range_end in edges if range_begin < range_end]
+        return ranges
 
-        # Flatten dictionary
+    def get_top(self, result, key, count):
+        ''' Returns the count keys ('ip', 'node_id' or 'vlan_id') with the most bytes for the samples that match
+            the result query over its period. '''
+        return [row[0] for row in self.summarize(result, key).get_rows(count)]
+
+    def summarize_ip(self, result, dest_file, progress_callback=None, count=None):
+        ''' Writes the totals per IP of the samples that match the result query to dest_file as CSV, ordered by
+            bytes. Pass count to get only the top count IPs. '''
+        def summarize_progress(current, end):
+            progress_callback(current, 1.1 * end)
+
+        begin_date = result.get_period().canonical_begin_date()
+        end_date = result.get_period().canonical_end_date()
+        summary = self.summarize(result, 'ip', (None, summarize_progress)[bool(progress_callback)])
+
+        # Write output (we do ip => dotted-ip conversion in python to save bandwidth and sql resources)
         unixtimes = '%d..%d' % (begin_date, end_date)
-        flat = []
-        for ip in results:
-            flat.append((
+        dest_file.write('unixtimes,ip,nodes,vlans,in_pps,in_bps,out_pps,out_bps\n')
+        for ip, nodes, vlans, in_pps, in_bps, out_pps, out_bps in summary.get_rows(count):
+            dest_file.write('"%s","%s",%d,%d,%d,%d,%d,%d\n' % (
                 unixtimes,
                 self.units.canonicalize_ip4(ip)[1].replace('"', '""'),
-                len(results[ip][0]),
-                len(results[ip][1]),
-                results[ip][2], results[ip][3],
-                results[ip][4], results[ip][5]
+                nodes, vlans, in_pps, in_bps, out_pps, out_bps
             ))
-   
-        # Sort dictionary
-        flat.sort(cmp=lambda x, y: -cmp(x[5] + x[7], y[5] + y[7]))
-
-        # Write output
-        dest_file.write('unixtimes,ip,nodes,vlans,in_pps,in_bps,out_pps,out_bps\n')
-        for row in flat:
-            dest_file.write('"%s","%s",%d,%d,%d,%d,%d,%d\n' % row)
         if progress_callback:
             progress_callback(1.1 * (end_date - begin_date), 1.1 * (end_date - begin_date))
-
@@ -0,0 +1,50 @@
+# vim: set ts=8 sw=4 sts=4 et:
+#=======================================================================
+# Copyright (C) 2009 OSSO B.V. <walter+lightcount@osso.nl>
+# This file is part of LightCount.
+#
+# LightCount is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LightCount is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LightCount.  If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+from numpy import arange, asarray, column_stack, ma, maximum, minimum
+
+
+def bucket_size(count, buckets):
+    ''' Returns the number of consecutive samples per bucket that reduces count samples to at most buckets
+        buckets. '''
+    return max(1, -(-count // max(1, buckets)))
+
+def minmaxavg(values, size):
+    ''' Splits the masked array values into buckets of size consecutive values (the last one may be shorter) and
+        returns the minimum, maximum and average of every bucket, and the indexes of the minimum and maximum in
+        values. Unknown values are skipped, the results of a bucket of unknown values only are masked. '''
+    values = ma.asarray(values)
+    buckets = -(-len(values) // size)
+    padded = ma.masked_all((buckets * size,), dtype=values.dtype)
+    padded[:len(values)] = values
+    padded = padded.reshape((buckets, size))
+    offsets = arange(buckets) * size
+    # (For a bucket of unknown values, argmin and argmax point at its first value, which is unknown as well.)
+    return padded.min(axis=1), padded.max(axis=1), padded.mean(axis=1), \
+            padded.argmin(axis=1) + offsets, padded.argmax(axis=1) + offsets
+
+def peaks(x, y, buckets):
+    ''' Reduces the line through x and y to the minimum and the maximum of every bucket, in the order they occur.
+        Drawn buckets pixels wide, it looks like the full line: an average would flatten the peaks (like the
+        ones the billing value depends on), these keep them. Returns at most 2 * buckets points. '''
+    size = bucket_size(len(y), buckets)
+    if size <= 2:
+        return x, y
+    imin, imax = minmaxavg(y, size)[3:]
+    index = column_stack((minimum(imin, imax), maximum(imin, imax))).ravel()
+    return asarray(x)[index], ma.asarray(y)[index]
@@ -16,13 +16,21 @@
 # You should have received a copy of the GNU General Public License
 # along with LightCount.  If not, see <http://www.gnu.org/licenses/>.
 #=======================================================================
-import lightcount
-from lightcount import bits, graphutil
+import lightcount, threading
+from cStringIO import StringIO
+from multiprocessing import Pool
+from lightcount import bits, downsample, graphutil
 from lightcount.timeutil import *
 from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
 from matplotlib.figure import Figure
 from matplotlib.dates import date2num
-from numpy import ndarray
+from numpy import flatnonzero, ma, ndarray
+
+# The image formats we can output and their MIME types.
+CONTENT_TYPES = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+}
 
 
 class StandardGraph:
@@ -40,19 +48,36 @@ class StandardGraph:
         self.log_scale = bool(log_scale)
         self.use_packets_not_bytes = bool(use_packets_not_bytes)
 
-    def create_figure(self):
+    def get_cache_key(self):
+        ''' Returns a key that is equal for graphs that would render the same image. '''
+        period = self.period
+        return (
+            tuple([(result.query, result.human_query, result.billing_percentile) for result in self.result_list]),
+            period.get_period(), period.canonical_begin_date(), period.canonical_end_date(), str(period.get_tzinfo()),
+            self.width, self.height, self.show_billing_line, self.log_scale, self.use_packets_not_bytes,
+        )
+
+    def get_expiry_time(self):
+        ''' Returns the unixtime after which the image may change or None if the period is closed and the image
+            never changes. '''
+        now = long(time())
+        # The last sample is complete (stored) one sample after its start
+        if self.period.canonical_end_date() + self.period.get_resolution() + lightcount.INTERVAL_SECONDS <= now:
+            return None
+        return now - now % lightcount.INTERVAL_SECONDS + lightcount.INTERVAL_SECONDS
+
+    def create_figure(self, fig=None):
+        ''' Draws the graph on a new figure or clears and reuses fig. '''
         def plot_lines(ax, xvalues, result_list, high_res=False):
             def fix_data(x, y, is_log=False):
-                # Drop trailing None's (happens when querying "current" graphs because we align on sensible periods)
-                x, y = list(x), list(y)
-                while len(y) and y[-1] is None:
-                    x.pop()
-                    y.pop()
+                # Drop trailing unknown values (happens when querying "current" graphs because we align on sensible periods)
+                valid = flatnonzero(~ma.getmaskarray(y))
+                x, y = x[:valid[-1] + 1], y[:valid[-1] + 1]
                 # If we're in log-mode, we can't draw on 0, so we change that to 1.
                 if is_log:
-                    y = map(lambda y: (y, 1)[y==0], y)
-                
-                return x, y
+                    y = ma.where(y == 0, 1, y)
+                # We can't draw more than a sample per pixel, keep only the lows and peaks of every pixel
+                return downsample.peaks(x, y, self.width)
                 
             # If only one query is specified, we can show both input and output in the same graph.
             show_input_output_separately = len(result_list) == 1
@@ -105,9 +130,10 @@ class StandardGraph:
 
             # Draw the traffic lines
             for line in lines:
-                # Draw the line, unless there are only None-values
-                if len(set(line['y']) - set((None,))) != 0:
-                    x, y = fix_data(line.pop('x'), line.pop('y'), is_log=(ax.get_yscale()=='log'))
+                # Draw the line, unless there are only unknown values
+                y = ma.asarray(line.pop('y'))
+                if y.count() != 0:
+                    x, y = fix_data(line.pop('x'), y, is_log=(ax.get_yscale()=='log'))
                     ax.plot(x, y, **line)
 
         def format_x_axis(ax):
@@ -180,8 +206,12 @@ class StandardGraph:
 
 
         # Initialize figure
-        fig = Figure(figsize=(self.width / self.dpi, self.height / self.dpi), dpi=self.dpi)
-        canvas = FigureCanvas(fig)
+        if fig is None:
+            fig = Figure(figsize=(self.width / self.dpi, self.height / self.dpi), dpi=self.dpi)
+            canvas = FigureCanvas(fig)
+        else:
+            fig.clf()
+            fig.set_size_inches(self.width / self.dpi, self.height / self.dpi)
         ax = fig.add_axes([4 / self.dpi, 4 / self.dpi, 60 / self.dpi, 60 / self.dpi], frame_on=False)
 
         # Select log/normal scale
@@ -198,15 +228,127 @@ class StandardGraph:
         # It is done
         return fig
 
-    def output(self):
-        ''' Return the image data as binary png data. '''
-        import os
-        tmpfile = os.tmpfile()
-        self.write(tmpfile)
-        tmpfile.seek(0)
-        return tmpfile.read() # destructor will clean up any would-be temporary files
-
-    def write(self, filename_or_fileobj):
-        ''' Write the image to filename on the local file system or to a file object. '''
-        f = self.create_figure()
-        f.savefig(filename_or_fileobj, dpi=self.dpi)
+    def output(self, format='png'):
+        ''' Return the image data as binary png data (or as svg data). It is rendered in memory. '''
+        buffer = StringIO()
+        self.write(buffer, format=format)
+        return buffer.getvalue()
+
+    def write(self, filename_or_fileobj, format=None, fig=None):
+        ''' Write the image to filename on the local file system or to a file object (anything with a write method,
+            like the mod_python request). The format (png or svg) defaults to the filename extension or png. Pass
+            a fig from an earlier create_figure() to draw on that. '''
+        if format is None and not isinstance(filename_or_fileobj, basestring):
+            format = 'png'
+        assert format is None or format in CONTENT_TYPES, 'Unsupported image format %s' % format
+        if not isinstance(filename_or_fileobj, basestring) and not hasattr(filename_or_fileobj, 'seek'):
+            # Matplotlib wants a real file, render into memory first
+            filename_or_fileobj.write(self.output(format))
+            return
+        f = self.create_figure(fig)
+        f.savefig(filename_or_fileobj, dpi=self.dpi, format=format)
+        return f
+
+
+# The graphs and filenames write_batch() is working on and the figure every
+# (forked) worker draws on. Globals, so the workers get them without pickling.
+batch_jobs = None
+batch_figure = None
+
+def write_batch(graphs, filenames, processes=None):
+    ''' Writes every graph to its filename, spreading the rendering over processes worker processes (default: one
+        per CPU). Load the values of the results beforehand, preferably with Data.Result.load_values_combined(), so
+        the workers don't need the database. '''
+    global batch_jobs
+    assert len(graphs) == len(filenames), 'Supply as many filenames as graphs'
+    batch_jobs = zip(graphs, filenames)
+    try:
+        if processes == 1:
+            map(batch_write, range(len(batch_jobs)))
+        else:
+            pool = Pool(processes)
+            try:
+                pool.map(batch_write, range(len(batch_jobs)))
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        batch_jobs = None
+
+def batch_write(n):
+    ''' Writes the n'th graph of batch_jobs, reusing the figure of the previous one. '''
+    global batch_figure
+    graph, filename = batch_jobs[n]
+    batch_figure = graph.write(filename, fig=batch_figure)
+
+
+class GraphCache:
+    ''' A thread-safe cache of rendered graphs. Graphs of closed periods are kept until they are the least recently
+        used when the cache is full, graphs of open periods expire at the next sample interval. Share one object
+        between requests. '''
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.entries = {} # key => [image data, expiry time or None, last use]
+        self.lock = threading.Lock()
+
+    def output(self, format='png', **kwargs):
+        ''' Returns the same image data as StandardGraph(**kwargs).output(format). Only renders the graph (and
+            queries the database) if it isn't cached. '''
+        graph = StandardGraph(**kwargs)
+        key = (format,) + graph.get_cache_key()
+        data = self.get(key)
+        if data is None:
+            data = graph.output(format)
+            self.put(key, data, graph.get_expiry_time())
+        return data
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] is not None and entry[1] <= time():
+                self.remove(key)
+                return None
+            entry[2] = time()
+            return entry[0]
+        finally:
+            self.lock.release()
+
+    def put(self, key, data, expiry_time):
+        if len(data) > self.max_bytes:
+            return
+        self.lock.acquire()
+        try:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = [data, expiry_time, time()]
+            self.bytes += len(data)
+            self.evict()
+        finally:
+            self.lock.release()
+
+    def remove(self, key):
+        ''' Removes key from the cache. Call with the lock held. '''
+        self.bytes -= len(self.entries.pop(key)[0])
+
+    def evict(self):
+        ''' Removes the expired entries and then the least recently used ones until the cache fits. Call with the
+            lock held. '''
+        if self.bytes <= self.max_bytes:
+            return
+        now = time()
+        for key, entry in self.entries.items():
+            if entry[1] is not None and entry[1] <= now:
+                self.remove(key)
+        if self.bytes <= self.max_bytes:
+            return
+        lru = [(entry[2], key) for key, entry in self.entries.items()]
+        lru.sort()
+        for last_use, key in lru:
+            if self.bytes <= self.max_bytes:
+                break
+            self.remove(key)
@@ -17,19 +17,29 @@
 # along with LightCount.  If not, see <http://www.gnu.org/licenses/>.
 #=======================================================================
 
-import os, sys
+import os, sys, threading
 if __name__ != '__main__':
     os.environ['HOME'] = '/tmp' # matplotlib
 from lightcount import Config
 from lightcount.timeutil import *
 from lightcount.data import Data
-from lightcount.graph import StandardGraph
+from lightcount.graph import CONTENT_TYPES, GraphCache
 
 # The root of the handler in the request uri. (E.g. if you've defined
 # <Location /traffic/> in your apache configuration, you want to set
 # this to '/traffic/'.)
 WEB_ROOT = '/'
 
+# The Data object is shared by all requests handled by this process, so
+# the database connections and the node name caches are kept. Set
+# storage_pool_size in lightcount.conf to the number of threads that
+# may query the database at once.
+shared_data = None
+shared_data_lock = threading.Lock()
+
+# Rendered graphs, shared by all requests handled by this process.
+graph_cache = GraphCache(max_bytes=32 * 1024 * 1024)
+
 
 def handler(req):
     try:
@@ -52,18 +62,32 @@ def handler(req):
         return current_day(req, ip='91.194.225.75', log=False)
     elif uri == 'wjd.osso.nl-current-day-log.png':
         return current_day(req, ip='91.194.225.75', log=True)
+    elif uri == 'wjd.osso.nl-current-day-linear.svg':
+        return current_day(req, ip='91.194.225.75', log=False, format='svg')
 
     req.content_type = 'text/plain'
     req.write('Try:\n%scode.osso.nl-current-day-linear.png' % (WEB_ROOT,))
     return 0
 
 
-def current_day(req, ip, log=False):
+def get_data():
+    ''' Returns the Data object shared by this process, creating it on first use. '''
+    global shared_data
+    shared_data_lock.acquire()
+    try:
+        if shared_data is None:
+            shared_data = Data(Config(os.path.dirname(__file__) + '/lightcount.conf'))
+        return shared_data
+    finally:
+        shared_data_lock.release()
+
+
+def current_day(req, ip, log=False, format='png'):
     tz = timezone_default() # timezone('UTC') for python2.4
-    data = Data(Config(os.path.dirname(__file__) + '/lightcount.conf'))
+    data = get_data()
     period = data.parse_period(begin_date=None, end_date=datetime.now(tz), period='day', time_zone=tz)
     result_list = data.parse_queries(period=period, queries=['ip %s' % ip])
 
-    req.content_type = 'image/png'
-    req.write(StandardGraph(result_list=result_list, log_scale=log).output())
+    req.content_type = CONTENT_TYPES[format]
+    req.write(graph_cache.output(format=format, result_list=result_list, log_scale=log))
     return 0
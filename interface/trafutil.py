@@ -20,9 +20,10 @@
 
 from getopt import GetoptError, gnu_getopt as getopt
 from lightcount import Config, graphutil
+from lightcount.bits import inet_ltoa
 from lightcount.timeutil import timezone_default, known_periods
 from lightcount.data import Data
-from lightcount.graph import StandardGraph
+from lightcount.graph import StandardGraph, write_batch
 
 
 class ParameterError(GetoptError):
@@ -38,9 +39,9 @@ def main(cli_arguments):
     # Read command line options
     optlist, args = getopt(
         cli_arguments,
-        'c:q:g:t:z:h',
-        ('config-file=', 'query=', 'write-graph=', 'time-zone=', 'period=', 'begin-date=',
-                'end-date=', 'log', 'linear', 'quiet', 'help', 'version')
+        'c:q:g:t:z:I:N:V:j:b:h',
+        ('config-file=', 'query=', 'query-file=', 'write-graph=', 'time-zone=', 'period=', 'begin-date=',
+                'end-date=', 'top-ips=', 'top-nodes=', 'top-vlans=', 'jobs=', 'buckets=', 'log', 'linear', 'quiet', 'help', 'version')
     )
     scratchpad = {
         'date': {},
@@ -50,6 +51,9 @@ def main(cli_arguments):
     for key, value in optlist:
         if key in ('-c', '--config-file'): set_or_raise(scratchpad, 'config_file', value, 'configuration filename')
         elif key in ('-q', '--query'): scratchpad['queries'].append(value)
+        elif key == '--query-file':
+            try: scratchpad['queries'].extend(read_query_file(value))
+            except IOError, e: raise ParameterError('Error reading query file: %s' % e)
         elif key in ('-g', '--write-graph'): set_or_raise(scratchpad, 'graph_file', value, 'graph filename')
         elif key in ('-z', '--time-zone'): set_or_raise(scratchpad, 'time_zone', value, 'time zone') # XXX of pytz.timezone(value)
         elif key in ('-t', '--period'):
@@ -57,6 +61,17 @@ def main(cli_arguments):
             if value not in known_periods(): raise ParameterError('Specify one of %s as period' % (', '.join(known_periods())))
         elif key == '--begin-date': set_or_raise(scratchpad['date'], 'begin_date', value, 'begin date')
         elif key == '--end-date': set_or_raise(scratchpad['date'], 'end_date', value, 'end date')
+        elif key in ('-I', '--top-ips'): set_or_raise(scratchpad, 'top', ('ip', parse_count(value)), 'automatic selection')
+        elif key in ('-N', '--top-nodes'): set_or_raise(scratchpad, 'top', ('node_id', parse_count(value)), 'automatic selection')
+        elif key in ('-V', '--top-vlans'): set_or_raise(scratchpad, 'top', ('vlan_id', parse_count(value)), 'automatic selection')
+        elif key in ('-j', '--jobs'):
+            try: set_or_raise(scratchpad, 'jobs', int(value), 'number of jobs')
+            except ValueError: raise ParameterError('Specify a number of jobs')
+            if scratchpad['jobs'] <= 0: raise ParameterError('Specify a positive number of jobs')
+        elif key in ('-b', '--buckets'):
+            try: set_or_raise(scratchpad, 'buckets', int(value), 'number of buckets')
+            except ValueError: raise ParameterError('Specify a number of buckets')
+            if scratchpad['buckets'] <= 0: raise ParameterError('Specify a positive number of buckets')
         elif key in ('--linear', '--log'): 
             if 'log_scale' in scratchpad:
                 raise ParameterError('Specify either --linear or --log and do it once')
@@ -68,12 +83,16 @@ def main(cli_arguments):
 
     # Check parameters
     if len(args) == 0: raise ParameterError('Please supply a command or -h for help')
-    elif len(args) == 1 and args[0] == 'stat': command = args[0]
-    elif len(args) == 2 and args[0] in ('dump', 'graph', 'graphstat', 'statgraph', 'sumip'): command = args[0]
+    elif len(args) == 1 and args[0] in ('explain', 'stat'): command = args[0]
+    elif len(args) == 2 and args[0] in ('billing', 'dump', 'graph', 'graphbatch', 'graphstat', 'json', 'statgraph', 'sumip'): command = args[0]
     else: raise ParameterError('Invalid command or too many/few parameters')
 
     # Check invalid option combinations
     if len(scratchpad['date']) == 3: raise ParameterError('Specify at most one date and a period or two dates')
+    if 'top' in scratchpad:
+        if len(scratchpad['queries']) > 1: raise ParameterError('Automatic selection can take only one query')
+        if command in ('billing', 'dump', 'explain', 'graphbatch', 'json'): raise ParameterError('Automatic selection cannot be used with the %s command' % command)
+        if command == 'sumip' and scratchpad['top'][0] != 'ip': raise ParameterError('Sum command can only select the top IPs')
     
     # Set defaults
     if 'config_file' not in scratchpad: scratchpad['config_file'] = 'lightcount.conf'
@@ -83,6 +102,8 @@ def main(cli_arguments):
         if name not in scratchpad['date']:
             scratchpad['date'][name] = None
     if 'quiet' not in scratchpad: scratchpad['quiet'] = False
+    if 'jobs' not in scratchpad: scratchpad['jobs'] = None
+    if 'buckets' not in scratchpad: scratchpad['buckets'] = 640
         
     # Get data object
     try: data = Data(Config(scratchpad['config_file']))
@@ -94,13 +115,81 @@ def main(cli_arguments):
     except ValueError, e: raise ParameterError('Error parsing time/period: %s' % e)
 
     # Process request
-    if command == 'dump': do_dump(data=data, period=period, options=scratchpad, file=args[1])
+    if command == 'billing': do_billing(data=data, period=period, options=scratchpad, file=args[1])
+    elif command == 'dump': do_dump(data=data, period=period, options=scratchpad, file=args[1])
+    elif command == 'explain': do_explain(data=data, period=period, options=scratchpad)
     elif command == 'graph': do_statgraph(data=data, period=period, options=scratchpad, graph=args[1])
+    elif command == 'graphbatch': do_graphbatch(data=data, period=period, options=scratchpad, file=args[1])
     elif command == 'stat': do_statgraph(data=data, period=period, options=scratchpad, stat='-')
     elif command in ('graphstat', 'statgraph'): do_statgraph(data=data, period=period, options=scratchpad, stat='-', graph=args[1])
+    elif command == 'json': do_json(data=data, period=period, options=scratchpad, file=args[1])
     elif command == 'sumip': do_sumip(data=data, period=period, options=scratchpad, file=args[1])
 
 
+def parse_count(value):
+    ''' Returns the positive number of items for the automatic selection. '''
+    try: count = int(value)
+    except ValueError: count = 0
+    if count <= 0: raise ParameterError('Specify a positive number for the automatic selection')
+    return count
+
+def read_query_file(file):
+    ''' Returns the queries in file, one per line. Empty lines and lines starting with a # are skipped. '''
+    queries = []
+    for line in open(file, 'r'):
+        line = line.strip()
+        if line and not line.startswith('#'):
+            queries.append(line)
+    return queries
+
+def do_billing(data, period, options, file):
+    def print_percent(current, end):
+        print '\b\b\b\b\b%3d%%' % (100.0 * float(current) / float(max(end, 1))),
+
+    if period.get_period() != 'month': raise ParameterError('Billing command can only be used with the month period')
+    # Write the billing value of every query (or of everything)
+    csv = open(file, 'w')
+    if not options['quiet']: print 'Writing billing values to %s ...   0%%' % file,
+    try: data.summarize_billing(period=period, queries=options['queries'], dest_file=csv,
+            progress_callback=(print_percent, None)[options['quiet']])
+    except (AssertionError, ValueError), e: raise ParameterError('Error parsing query: %s' % e)
+    if not options['quiet']: print 'done'
+
+def do_explain(data, period, options):
+    # Show how the queries are compiled and which index MySQL picks for them
+    try: result_list = data.parse_queries(period=period, queries=options['queries'])
+    except (AssertionError, ValueError), e: raise ParameterError('Error parsing query: %s' % e)
+    for result in result_list:
+        print 'Query: %s' % result.human_query
+        print 'SQL:   %s' % (result.query or '(none)')
+        for row in data.explain(result):
+            if 'detail' in row: print 'Plan:  %s' % row['detail'] # SQLite
+            else: print 'Table: %s, type: %s, key: %s, rows: %s' % (row.get('table'), row.get('type'), row.get('key'), row.get('rows'))
+        print
+
+def do_graphbatch(data, period, options, file, graphs_per_fetch=256):
+    def print_percent(current, end):
+        print '\b\b\b\b\b%3d%%' % (100.0 * float(current) / float(max(end, 1))),
+
+    if len(options['queries']) != 0: raise ParameterError('Graph batch command takes its queries from the file')
+    # Read "FILENAME [QUERY]" lines
+    try: lines = [(line.split(None, 1) + [''])[:2] for line in read_query_file(file)]
+    except IOError, e: raise ParameterError('Error reading graph batch file: %s' % e)
+    try: result_list = data.parse_queries(period=period, queries=[line[1] for line in lines])
+    except (AssertionError, ValueError), e: raise ParameterError('Error parsing query: %s' % e)
+    # Fetch the values of many graphs at once, then render them in parallel
+    if not options['quiet']: print 'Writing %d graphs ...   0%%' % len(lines),
+    for i in range(0, len(result_list), graphs_per_fetch):
+        batch = result_list[i:i + graphs_per_fetch]
+        Data.Result.load_values_combined(batch)
+        graphs = [StandardGraph(result_list=[result], log_scale=options['log_scale'], show_billing_line=True)
+                for result in batch]
+        write_batch(graphs, [line[0] for line in lines[i:i + graphs_per_fetch]], processes=options['jobs'])
+        for result in batch:
+            result.values, result.cache = None, {}
+        if not options['quiet']: print_percent(i + len(batch), len(result_list))
+    if not options['quiet']: print 'done'
+
 def do_dump(data, period, options, file):
     def print_percent(current, end):
         print '\b\b\b\b\b%3d%%' % (100.0 * float(current) / float(end)),
@@ -116,6 +205,14 @@ def do_dump(data, period, options, file):
     data.serialize(result=result, dest_file=csv, progress_callback=(print_percent, None)[options['quiet']])
     if not options['quiet']: print 'done'
 
+def do_json(data, period, options, file):
+    try: result_list = data.parse_queries(period=period, queries=options['queries'])
+    except (AssertionError, ValueError), e: raise ParameterError('Error parsing query: %s' % e)
+    # Write the series, reduced to the number of buckets (like the pixels of a graph)
+    if not options['quiet']: print 'Writing series to %s ...' % file,
+    data.serialize_series(result_list=result_list, dest_file=open(file, 'w'), buckets=options['buckets'])
+    if not options['quiet']: print 'done'
+
 def do_sumip(data, period, options, file):
     def print_percent(current, end):
         print '\b\b\b\b\b%3d%%' % (100.0 * float(current) / float(end)),
@@ -127,17 +224,27 @@ def do_sumip(data, period, options, file):
     # Work on the summary
     csv = open(file, 'w')
     if not options['quiet']: print 'Summarizing data by IP ...   0%',
-    data.summarize_ip(result=result, dest_file=csv, progress_callback=(print_percent, None)[options['quiet']])
+    data.summarize_ip(result=result, dest_file=csv, progress_callback=(print_percent, None)[options['quiet']],
+            count=options.get('top', (None, None))[1])
     if not options['quiet']: print 'done'
 
 def do_help(): 
     print '''Usage: trafutil.py COMMAND PARAMETERS OPTIONS
 Perform analysis, backups or drawing of lightcount data.
 Commands available are:
+  billing       Writes the 95th percentile billing values of the queries (-q or
+                --query-file) over a month to a CSV file. Parameters: filename
   dump          Dumps all data or only that supplied by a single query (-q) to
                 a CSV file. Parameters: filename
-  graph         Draws a graph of the optional queries (-q) to a PNG file.
-                Parameters: graph filename
+  explain       Shows the SQL of the optional queries (-q) and the index the
+                database uses to find their samples. Parameters: none
+  graph         Draws a graph of the optional queries (-q) to a PNG file (or
+                SVG if the filename ends in .svg). Parameters: graph filename
+  graphbatch    Draws many graphs at once. Every line of the file holds a
+                graph filename and an optional query. Parameters: filename
+  json          Writes the bit/s and packet/s series of the optional queries
+                (-q) to a JSON file, as the minimum, maximum and average of
+                at most N buckets (-b). Parameters: filename
   stat          Write statistics about optional queries (-q) to standard out.
                 Parameters: none
   statgraph     A combination of the stat and graph commands. Parameters: graph
@@ -158,6 +265,7 @@ Value selection:
   -q, --query=Q         specify an expression Q using (host, ip, net, node,
                         vlan) and the operators (and, or, not and the
                         parentheses) (may be specified multiple times)
+      --query-file=F    read queries from file F, one per line
 
 Automatic selection (you may specify at most one query):
   -I, --top-ips=N       show the top N byte users by IP address
@@ -165,9 +273,13 @@ Automatic selection (you may specify at most one query):
   -V, --top-vlans=N     show the top N byte users by VLAN
 
 Graph options:
+  -j, --jobs=N          render graph batches with N processes (dfl: #CPUs)
       --linear          display the graph with a linear scale (default)
       --log             display the graph with a logarithmic scale
 
+Export options:
+  -b, --buckets=N       reduce the JSON series to N buckets (dfl: 640)
+
 Other options:
       --quiet           hide obvious output like completion counters
 
@@ -178,12 +290,22 @@ specified as IP addresses with a trailing slash and a netmask number.
 
 def do_statgraph(data, period, options, stat=None, graph=None):
     # XXX add select-packet-count instead of bytes option
-    if True:
-        try: result_list = data.parse_queries(period=period, queries=options['queries'])
+    try: result_list = data.parse_queries(period=period, queries=options['queries'])
+    except (AssertionError, ValueError), e: raise ParameterError('Error parsing query: %s' % e)
+
+    if 'top' in options:
+        # Replace the (optional) base query by one query per top user
+        key, count = options['top']
+        if not options['quiet'] and graph is not None: print 'Selecting the top %d by %s ...' % (count, key),
+        top = data.get_top(result=result_list[0], key=key, count=count)
+        if not options['quiet'] and graph is not None: print 'done'
+        if len(top) == 0: raise ParameterError('Automatic selection found no traffic in the selected period')
+        keyword = {'ip': 'ip', 'node_id': 'node', 'vlan_id': 'vlan'}[key]
+        if key == 'ip': top = [inet_ltoa(i) for i in top]
+        queries = ['%s %s' % (keyword, i) for i in top]
+        if len(options['queries']) != 0: queries = ['(%s) and %s' % (options['queries'][0], i) for i in queries]
+        try: result_list = data.parse_queries(period=period, queries=queries)
         except (AssertionError, ValueError), e: raise ParameterError('Error parsing query: %s' % e)
-    else:
-        # XXX add checking for Top-N stuff..
-        pass
 
     if stat is not None:
         print 'Selected period (%s) between %s and %s:' % (period.get_period(), period.get_begin_date(), period.get_end_date())
@@ -40,9 +40,89 @@ CREATE TABLE sample_tbl (
 	PRIMARY KEY (unixtime, node_id, vlan_id, ip),
 	KEY (node_id),
 	KEY (vlan_id),
-	KEY (ip)
+	KEY (ip, unixtime)
 );
 
+-- The hour and day rollup tables hold the sums of the sample_tbl values per
+-- node/vlan/ip. The unixtime is the (UTC aligned) begin of the hour or day.
+-- They are kept up to date by the triggers below and are not pruned along with
+-- sample_tbl, so the interface can draw week/year graphs from them quickly.
+DROP TABLE IF EXISTS sample_hour_tbl;
+CREATE TABLE sample_hour_tbl (
+	unixtime INT NOT NULL,
+	node_id TINYINT UNSIGNED NOT NULL REFERENCES node_tbl (node_id),
+	vlan_id SMALLINT UNSIGNED NOT NULL,
+	ip INT UNSIGNED NOT NULL,
+	in_pps INT UNSIGNED NOT NULL, -- sum of packets/second in
+	in_bps BIGINT UNSIGNED NOT NULL, -- sum of bytes/second in
+	out_pps INT UNSIGNED NOT NULL, -- sum of packets/second out
+	out_bps BIGINT UNSIGNED NOT NULL, -- sum of bytes/second out
+	PRIMARY KEY (unixtime, node_id, vlan_id, ip),
+	KEY (node_id),
+	KEY (vlan_id),
+	KEY (ip, unixtime)
+);
+
+DROP TABLE IF EXISTS sample_day_tbl;
+CREATE TABLE sample_day_tbl (
+	unixtime INT NOT NULL,
+	node_id TINYINT UNSIGNED NOT NULL REFERENCES node_tbl (node_id),
+	vlan_id SMALLINT UNSIGNED NOT NULL,
+	ip INT UNSIGNED NOT NULL,
+	in_pps INT UNSIGNED NOT NULL, -- sum of packets/second in
+	in_bps BIGINT UNSIGNED NOT NULL, -- sum of bytes/second in
+	out_pps INT UNSIGNED NOT NULL, -- sum of packets/second out
+	out_bps BIGINT UNSIGNED NOT NULL, -- sum of bytes/second out
+	PRIMARY KEY (unixtime, node_id, vlan_id, ip),
+	KEY (node_id),
+	KEY (vlan_id),
+	KEY (ip, unixtime)
+);
+
+DROP TRIGGER IF EXISTS sample_tbl_rollup_trg;
+DELIMITER //
+CREATE TRIGGER sample_tbl_rollup_trg AFTER INSERT ON sample_tbl
+FOR EACH ROW BEGIN
+	INSERT INTO sample_hour_tbl (unixtime, node_id, vlan_id, ip, in_pps, in_bps, out_pps, out_bps)
+	VALUES (NEW.unixtime - NEW.unixtime % 3600, NEW.node_id, NEW.vlan_id, NEW.ip,
+		NEW.in_pps, NEW.in_bps, NEW.out_pps, NEW.out_bps)
+	ON DUPLICATE KEY UPDATE
+		in_pps = in_pps + VALUES(in_pps), in_bps = in_bps + VALUES(in_bps),
+		out_pps = out_pps + VALUES(out_pps), out_bps = out_bps + VALUES(out_bps);
+	INSERT INTO sample_day_tbl (unixtime, node_id, vlan_id, ip, in_pps, in_bps, out_pps, out_bps)
+	VALUES (NEW.unixtime - NEW.unixtime % 86400, NEW.node_id, NEW.vlan_id, NEW.ip,
+		NEW.in_pps, NEW.in_bps, NEW.out_pps, NEW.out_bps)
+	ON DUPLICATE KEY UPDATE
+		in_pps = in_pps + VALUES(in_pps), in_bps = in_bps + VALUES(in_bps),
+		out_pps = out_pps + VALUES(out_pps), out_bps = out_bps + VALUES(out_bps);
+END//
+DELIMITER ;
+
+-- The daemon replaces rows that are stored already (ON DUPLICATE KEY UPDATE),
+-- for instance when it replays its spool. That fires this trigger instead,
+-- which moves the sums by the difference. (The casts keep the unsigned
+-- subtraction from going out of range when a value drops.)
+DROP TRIGGER IF EXISTS sample_tbl_rollup_upd_trg;
+DELIMITER //
+CREATE TRIGGER sample_tbl_rollup_upd_trg AFTER UPDATE ON sample_tbl
+FOR EACH ROW BEGIN
+	UPDATE sample_hour_tbl SET
+		in_pps = in_pps + CAST(NEW.in_pps AS SIGNED) - CAST(OLD.in_pps AS SIGNED),
+		in_bps = in_bps + CAST(NEW.in_bps AS SIGNED) - CAST(OLD.in_bps AS SIGNED),
+		out_pps = out_pps + CAST(NEW.out_pps AS SIGNED) - CAST(OLD.out_pps AS SIGNED),
+		out_bps = out_bps + CAST(NEW.out_bps AS SIGNED) - CAST(OLD.out_bps AS SIGNED)
+	WHERE unixtime = NEW.unixtime - NEW.unixtime % 3600 AND node_id = NEW.node_id
+		AND vlan_id = NEW.vlan_id AND ip = NEW.ip;
+	UPDATE sample_day_tbl SET
+		in_pps = in_pps + CAST(NEW.in_pps AS SIGNED) - CAST(OLD.in_pps AS SIGNED),
+		in_bps = in_bps + CAST(NEW.in_bps AS SIGNED) - CAST(OLD.in_bps AS SIGNED),
+		out_pps = out_pps + CAST(NEW.out_pps AS SIGNED) - CAST(OLD.out_pps AS SIGNED),
+		out_bps = out_bps + CAST(NEW.out_bps AS SIGNED) - CAST(OLD.out_bps AS SIGNED)
+	WHERE unixtime = NEW.unixtime - NEW.unixtime % 86400 AND node_id = NEW.node_id
+		AND vlan_id = NEW.vlan_id AND ip = NEW.ip;
+END//
+DELIMITER ;
+
 DROP VIEW IF EXISTS ip_range_vw;
 CREATE VIEW ip_range_vw AS
 SELECT
@@ -70,7 +150,10 @@ FROM sample_tbl LEFT JOIN node_tbl USING (node_id);
 -- CREATE USER 'traffic_w'@'%' IDENTIFIED BY 'somepassword';
 -- GRANT SELECT ON ip_range_tbl TO 'traffic_w'@'%';
 -- GRANT SELECT, INSERT ON node_tbl TO 'traffic_w'@'%';
--- GRANT INSERT ON sample_tblTO 'traffic_w'@'%';
+-- GRANT INSERT, UPDATE ON sample_tbl TO 'traffic_w'@'%';
+--
+-- (The daemon replaces rows that are stored already, for instance when it
+-- replays its spool, so it needs UPDATE as well.)
 
 
 --
@@ -102,3 +185,43 @@ FROM sample_tbl LEFT JOIN node_tbl USING (node_id);
 --     AND t.ip_begin is null;
 --
 -- Query OK, 18 rows affected (1.48 sec)
+
+
+--
+-- Maintenance tip #3
+-- FINDING THE SAMPLES OF AN IP OR NET QUICKLY
+--
+
+-- The interface writes nets as ip ranges (ip BETWEEN begin AND end), so
+-- MySQL can look up the samples of a customer in the (ip, unixtime) key
+-- instead of scanning every sample in the period. Databases created before
+-- had a key on ip alone; replace it with:
+--
+-- ALTER TABLE sample_tbl DROP KEY ip, ADD KEY (ip, unixtime);
+-- ALTER TABLE sample_hour_tbl DROP KEY ip, ADD KEY (ip, unixtime);
+-- ALTER TABLE sample_day_tbl DROP KEY ip, ADD KEY (ip, unixtime);
+--
+-- Run 'trafutil.py explain -q QUERY' to see the key a query uses.
+
+
+--
+-- Maintenance tip #4
+-- FILLING THE ROLLUP TABLES FROM AN EXISTING sample_tbl
+--
+
+-- The triggers only see new samples. When upgrading an existing database,
+-- create the rollup tables and the triggers (above) and fill them once with
+-- the samples that are already there:
+--
+-- SET @trigger_created = UNIX_TIMESTAMP('2009-09-01 12:00:00');
+--
+-- INSERT INTO sample_hour_tbl
+-- SELECT unixtime - unixtime % 3600, node_id, vlan_id, ip,
+--     SUM(in_pps), SUM(in_bps), SUM(out_pps), SUM(out_bps)
+-- FROM sample_tbl WHERE unixtime < @trigger_created
+-- GROUP BY unixtime - unixtime % 3600, node_id, vlan_id, ip
+-- ON DUPLICATE KEY UPDATE
+--     in_pps = in_pps + VALUES(in_pps), in_bps = in_bps + VALUES(in_bps),
+--     out_pps = out_pps + VALUES(out_pps), out_bps = out_bps + VALUES(out_bps);
+--
+-- (And the same for sample_day_tbl, using 86400 instead of 3600.)
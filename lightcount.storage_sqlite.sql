@@ -0,0 +1,115 @@
+--
+-- SQLite lightcount SQL create script
+-- The same tables as lightcount.storage_my.sql, for the storage_sqlite
+-- daemon module and storage_type=sqlite in the interface. Create the
+-- database file with:
+--   sqlite3 /var/lib/lightcount/lightcount.db < lightcount.storage_sqlite.sql
+-- (The upserts below need SQLite 3.24 or later.)
+--
+
+DROP TABLE IF EXISTS node_tbl;
+CREATE TABLE node_tbl (
+	node_id INTEGER PRIMARY KEY AUTOINCREMENT,
+	node_name VARCHAR(255) NOT NULL,
+	-- See lightcount.storage_my.sql.
+	expect_data_interval INT NULL DEFAULT NULL -- seconds
+);
+CREATE INDEX node_tbl_node_name ON node_tbl (node_name);
+
+DROP TABLE IF EXISTS ip_range_tbl;
+CREATE TABLE ip_range_tbl (
+	ip_begin INT NOT NULL,
+	ip_end INT NOT NULL,
+	node_id INT NULL REFERENCES node_tbl (node_id)
+);
+CREATE INDEX ip_range_tbl_ip ON ip_range_tbl (ip_begin, ip_end);
+CREATE INDEX ip_range_tbl_node_id ON ip_range_tbl (node_id);
+INSERT INTO ip_range_tbl VALUES (0, 4294967295, NULL); -- 0.0.0.0 - 255.255.255.255
+
+DROP TABLE IF EXISTS sample_tbl;
+CREATE TABLE sample_tbl (
+	-- unixtime holds measurement-start-time (interval is defined in timer module)
+	unixtime INT NOT NULL,
+	node_id INT NOT NULL REFERENCES node_tbl (node_id),
+	vlan_id INT NOT NULL,
+	ip INT NOT NULL,
+	in_pps INT NOT NULL, -- packets/second in
+	in_bps INT NOT NULL, -- bytes/second in
+	out_pps INT NOT NULL, -- packets/second out
+	out_bps INT NOT NULL, -- bytes/second out
+	PRIMARY KEY (unixtime, node_id, vlan_id, ip)
+);
+CREATE INDEX sample_tbl_node_id ON sample_tbl (node_id);
+CREATE INDEX sample_tbl_vlan_id ON sample_tbl (vlan_id);
+CREATE INDEX sample_tbl_ip ON sample_tbl (ip, unixtime);
+
+-- The hour and day rollup tables hold the sums of the sample_tbl values per
+-- node/vlan/ip, see lightcount.storage_my.sql.
+DROP TABLE IF EXISTS sample_hour_tbl;
+CREATE TABLE sample_hour_tbl (
+	unixtime INT NOT NULL,
+	node_id INT NOT NULL REFERENCES node_tbl (node_id),
+	vlan_id INT NOT NULL,
+	ip INT NOT NULL,
+	in_pps INT NOT NULL, -- sum of packets/second in
+	in_bps INT NOT NULL, -- sum of bytes/second in
+	out_pps INT NOT NULL, -- sum of packets/second out
+	out_bps INT NOT NULL, -- sum of bytes/second out
+	PRIMARY KEY (unixtime, node_id, vlan_id, ip)
+);
+CREATE INDEX sample_hour_tbl_node_id ON sample_hour_tbl (node_id);
+CREATE INDEX sample_hour_tbl_vlan_id ON sample_hour_tbl (vlan_id);
+CREATE INDEX sample_hour_tbl_ip ON sample_hour_tbl (ip, unixtime);
+
+DROP TABLE IF EXISTS sample_day_tbl;
+CREATE TABLE sample_day_tbl (
+	unixtime INT NOT NULL,
+	node_id INT NOT NULL REFERENCES node_tbl (node_id),
+	vlan_id INT NOT NULL,
+	ip INT NOT NULL,
+	in_pps INT NOT NULL, -- sum of packets/second in
+	in_bps INT NOT NULL, -- sum of bytes/second in
+	out_pps INT NOT NULL, -- sum of packets/second out
+	out_bps INT NOT NULL, -- sum of bytes/second out
+	PRIMARY KEY (unixtime, node_id, vlan_id, ip)
+);
+CREATE INDEX sample_day_tbl_node_id ON sample_day_tbl (node_id);
+CREATE INDEX sample_day_tbl_vlan_id ON sample_day_tbl (vlan_id);
+CREATE INDEX sample_day_tbl_ip ON sample_day_tbl (ip, unixtime);
+
+-- Like in MySQL, these triggers keep the rollups up to date: the first for new
+-- samples, the second for samples the daemon replaces (ON CONFLICT DO UPDATE).
+DROP TRIGGER IF EXISTS sample_tbl_rollup_trg;
+CREATE TRIGGER sample_tbl_rollup_trg AFTER INSERT ON sample_tbl
+FOR EACH ROW BEGIN
+	INSERT INTO sample_hour_tbl (unixtime, node_id, vlan_id, ip, in_pps, in_bps, out_pps, out_bps)
+	VALUES (NEW.unixtime - NEW.unixtime % 3600, NEW.node_id, NEW.vlan_id, NEW.ip,
+		NEW.in_pps, NEW.in_bps, NEW.out_pps, NEW.out_bps)
+	ON CONFLICT (unixtime, node_id, vlan_id, ip) DO UPDATE SET
+		in_pps = in_pps + excluded.in_pps, in_bps = in_bps + excluded.in_bps,
+		out_pps = out_pps + excluded.out_pps, out_bps = out_bps + excluded.out_bps;
+	INSERT INTO sample_day_tbl (unixtime, node_id, vlan_id, ip, in_pps, in_bps, out_pps, out_bps)
+	VALUES (NEW.unixtime - NEW.unixtime % 86400, NEW.node_id, NEW.vlan_id, NEW.ip,
+		NEW.in_pps, NEW.in_bps, NEW.out_pps, NEW.out_bps)
+	ON CONFLICT (unixtime, node_id, vlan_id, ip) DO UPDATE SET
+		in_pps = in_pps + excluded.in_pps, in_bps = in_bps + excluded.in_bps,
+		out_pps = out_pps + excluded.out_pps, out_bps = out_bps + excluded.out_bps;
+END;
+
+DROP TRIGGER IF EXISTS sample_tbl_rollup_upd_trg;
+CREATE TRIGGER sample_tbl_rollup_upd_trg AFTER UPDATE ON sample_tbl
+FOR EACH ROW BEGIN
+	UPDATE sample_hour_tbl SET
+		in_pps = in_pps + NEW.in_pps - OLD.in_pps, in_bps = in_bps + NEW.in_bps - OLD.in_bps,
+		out_pps = out_pps + NEW.out_pps - OLD.out_pps, out_bps = out_bps + NEW.out_bps - OLD.out_bps
+	WHERE unixtime = NEW.unixtime - NEW.unixtime % 3600 AND node_id = NEW.node_id
+		AND vlan_id = NEW.vlan_id AND ip = NEW.ip;
+	UPDATE sample_day_tbl SET
+		in_pps = in_pps + NEW.in_pps - OLD.in_pps, in_bps = in_bps + NEW.in_bps - OLD.in_bps,
+		out_pps = out_pps + NEW.out_pps - OLD.out_pps, out_bps = out_bps + NEW.out_bps - OLD.out_bps
+	WHERE unixtime = NEW.unixtime - NEW.unixtime % 86400 AND node_id = NEW.node_id
+		AND vlan_id = NEW.vlan_id AND ip = NEW.ip;
+END;
+
+-- Run ANALYZE once the tables hold some samples: without statistics SQLite
+-- prefers the primary key over the (ip, unixtime) indexes for IP queries.